@@ -0,0 +1,94 @@
+import argparse
+import multiprocessing
+import resource
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+
+from unifold.data import data_ops
+
+
+def make_sample(num_seqs, num_res, seed=0):
+    # a deep multimer MSA, with mostly empty deletion counts.
+    rng = np.random.RandomState(seed)
+    deletion_matrix = rng.poisson(0.05, size=(num_seqs, num_res)).astype(np.float32)
+    return {
+        "msa": torch.from_numpy(rng.randint(22, size=(num_seqs, num_res)).astype(np.uint8)),
+        "deletion_matrix": torch.from_numpy(deletion_matrix),
+    }
+
+
+def msa_bytes(protein):
+    names = data_ops.MSA_FEATURE_NAMES + ["extra_" + k for k in data_ops.MSA_FEATURE_NAMES]
+    return sum(v.numel() * v.element_size() for k, v in protein.items() if k in names)
+
+
+def run(args, compact, queue):
+    np.random.seed(0)
+    protein = make_sample(args.num_seqs, args.num_res)
+    masked_msa = SimpleNamespace(profile_prob=0.1, same_prob=0.1, uniform_prob=0.1)
+    nonensembled = [
+        data_ops.cast_to_64bit_ints,
+        data_ops.correct_msa_restypes,
+        data_ops.compact_msa_features,
+        data_ops.make_msa_mask,
+        data_ops.make_hhblits_profile_v2,
+    ]
+    if not compact:
+        # the dtypes the pipeline used to carry: int64 tokens, float32 deletions.
+        nonensembled.append(data_ops.widen_msa_features)
+    ensembled = [
+        data_ops.sample_msa(args.max_msa_clusters, keep_extra=True),
+        data_ops.make_masked_msa(masked_msa, 0.15),
+        data_ops.nearest_neighbor_clusters_v2(),
+        data_ops.make_msa_feat_v2,
+        data_ops.make_extra_msa_feat(args.max_extra_msa),
+    ]
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for f in nonensembled:
+        protein = f(protein)
+    nonensembled_bytes = msa_bytes(protein)
+    for _ in range(args.num_ensembles):
+        d = dict(protein)
+        for f in ensembled:
+            d = f(d)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((nonensembled_bytes, (peak_rss - base_rss) / 2**10))
+
+
+def measure(args, compact):
+    queue = multiprocessing.Queue()
+    p = multiprocessing.Process(target=run, args=(args, compact, queue))
+    p.start()
+    result = queue.get()
+    p.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MSA Feature Memory Benchmark")
+    parser.add_argument("--num-seqs", default=16384, type=int, help="Number of MSA rows")
+    parser.add_argument("--num-res", default=1536, type=int, help="Number of residues")
+    parser.add_argument("--max-msa-clusters", default=252, type=int, help="Number of MSA clusters")
+    parser.add_argument("--max-extra-msa", default=1152, type=int, help="Number of extra MSA rows")
+    parser.add_argument("--num-ensembles", default=4, type=int, help="Number of recycles sampled")
+    args = parser.parse_args()
+
+    wide_bytes, wide_peak = measure(args, compact=False)
+    compact_bytes, compact_peak = measure(args, compact=True)
+    print(
+        " MSA: {:d} x {:d}, non-ensembled MSA features: {:.1f} MB -> {:.1f} MB, "
+        "peak RSS increase: {:.1f} MB -> {:.1f} MB".format(
+            args.num_seqs,
+            args.num_res,
+            wide_bytes / 2**20,
+            compact_bytes / 2**20,
+            wide_peak,
+            compact_peak,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import time
+
+import numpy as np
+
+from unifold.data.msa_subsampling import get_eff, subsample_msa_sequentially
+
+
+def subsample_msa_sequentially_loop(msa, neff=10, eff_cutoff=0.8, cap_msa=True):
+    # the implementation recomputing `get_eff` of the whole selection per step.
+    indices = [0]
+    idx = np.arange(msa.shape[0] - 1) + 1
+    np.random.shuffle(idx)
+    new = [msa[0]]
+    for i in idx:
+        new.append(msa[i])
+        indices.append(i)
+        neff_ = get_eff(np.array(new), eff_cutoff=eff_cutoff).sum()
+        if neff_ > neff or (cap_msa and len(new) > 254):
+            new.pop()
+            indices.pop()
+            break
+    return np.array(indices)
+
+
+def make_msa(num_seqs, num_res, num_families, rng):
+    # rows are mutated copies of a few family consensus sequences, so that
+    # many of them fall within the identity cutoff of each other.
+    families = rng.randint(21, size=(num_families, num_res))
+    msa = families[rng.randint(num_families, size=num_seqs)]
+    rates = rng.uniform(0.0, 0.4, size=(num_seqs, 1))
+    mutate = rng.uniform(size=(num_seqs, num_res)) < rates
+    msa = np.where(mutate, rng.randint(21, size=(num_seqs, num_res)), msa)
+    return msa.astype(np.int32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sequential MSA Subsampling Benchmark")
+    parser.add_argument("--num-seqs", default=5000, type=int, help="Number of MSA rows")
+    parser.add_argument("--num-res", default=256, type=int, help="Number of residues")
+    parser.add_argument("--num-families", default=200, type=int, help="Number of sequence families")
+    parser.add_argument("--neff", default=100, type=float, help="Target Neff")
+    parser.add_argument("--cap-msa", action="store_true", help="Keep at most 254 sequences")
+    args = parser.parse_args()
+
+    msa = make_msa(args.num_seqs, args.num_res, args.num_families, np.random.RandomState(0))
+
+    t0 = time.perf_counter()
+    np.random.seed(0)
+    ref = subsample_msa_sequentially_loop(msa, args.neff, cap_msa=args.cap_msa)
+    t_loop = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    np.random.seed(0)
+    out = subsample_msa_sequentially(msa, args.neff, cap_msa=args.cap_msa)
+    t_inc = time.perf_counter() - t0
+
+    identical = np.array_equal(ref, out)
+    assert identical, "incremental Neff selection diverged from the get_eff loop"
+    print(
+        " Rows: {:d}, residues: {:d}, selected: {:d}, get_eff loop: {:.3f} s, "
+        "incremental: {:.3f} s, speedup {:.1f}x, identical: {}".format(
+            args.num_seqs,
+            args.num_res,
+            len(out),
+            t_loop,
+            t_inc,
+            t_loop / t_inc,
+            identical,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
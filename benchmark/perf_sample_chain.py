@@ -0,0 +1,72 @@
+import argparse
+import time
+
+import numpy as np
+
+from unicore.data import data_utils
+
+from unifold.data.utils import make_sample_cdf, weighted_choice
+
+
+def sample_with_choice(num_prot, sample_prob, seed, indices):
+    ret = []
+    for idx in indices:
+        with data_utils.numpy_seed(seed, idx, key="data_sample"):
+            ret.append(int(np.random.choice(num_prot, p=sample_prob)))
+    return ret
+
+
+def sample_with_cdf(sample_cdf, seed, indices):
+    ret = []
+    for idx in indices:
+        with data_utils.numpy_seed(seed, idx, key="data_sample"):
+            ret.append(weighted_choice(sample_cdf))
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description="UnifoldDataset.sample_chain Benchmark")
+    parser.add_argument(
+        "--num-chains", default=500000, type=int, help="Number of chains to sample from"
+    )
+    parser.add_argument(
+        "--num-samples", default=200, type=int, help="Number of indices to sample"
+    )
+    parser.add_argument("--seed", default=81, type=int, help="Dataset seed")
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    sample_weight = rng.uniform(0.01, 1.0, args.num_chains)
+    # as in `cal_sample_weight`, the probabilities are a python list.
+    sum_weight = sum(sample_weight)
+    sample_prob = [w / sum_weight for w in sample_weight]
+    indices = list(range(args.num_samples))
+
+    t0 = time.perf_counter()
+    sample_cdf = make_sample_cdf(sample_prob)
+    t_build = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    ref = sample_with_choice(args.num_chains, sample_prob, args.seed, indices)
+    t_choice = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    out = sample_with_cdf(sample_cdf, args.seed, indices)
+    t_cdf = time.perf_counter() - t0
+
+    assert ref == out, "cdf sampling diverged from np.random.choice"
+    print(
+        " Chains: {:d}, np.random.choice: {:.3f} ms / index, cdf searchsorted: {:.3f} ms / index "
+        "(one-off build {:.3f} ms), speedup {:.1f}x, identical indices: {}".format(
+            args.num_chains,
+            t_choice * 1e3 / args.num_samples,
+            t_cdf * 1e3 / args.num_samples,
+            t_build * 1e3,
+            t_choice / t_cdf,
+            ref == out,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from unifold.data import data_ops
+from unifold.data import residue_constants as rc
+
+
+def make_assembly(num_chains, chain_len, seed=0):
+    # chains as random walks of 3.8A steps, started on a grid 20A apart.
+    rng = np.random.RandomState(seed)
+    side = int(np.ceil(num_chains ** (1 / 3)))
+    starts = np.stack(np.meshgrid(*[np.arange(side)] * 3), -1).reshape(-1, 3)[:num_chains]
+    steps = rng.normal(size=(num_chains, chain_len, 3))
+    steps *= 3.8 / np.linalg.norm(steps, axis=-1, keepdims=True)
+    ca = (starts[:, None, :] * 20.0 + np.cumsum(steps, axis=1)).reshape(-1, 3)
+    num_res = num_chains * chain_len
+    all_atom_positions = np.zeros((num_res, rc.atom_type_num, 3), dtype=np.float32)
+    all_atom_positions[:, rc.atom_order["CA"]] = ca
+    all_atom_mask = np.zeros((num_res, rc.atom_type_num), dtype=np.float32)
+    all_atom_mask[:, rc.atom_order["CA"]] = rng.rand(num_res) > 0.02
+    return {
+        "all_atom_positions": torch.from_numpy(all_atom_positions),
+        "all_atom_mask": torch.from_numpy(all_atom_mask),
+        "asym_id": torch.arange(num_chains).repeat_interleave(chain_len) + 1,
+        "asym_len": torch.full((num_chains,), chain_len),
+        "aatype": torch.zeros(num_res, dtype=torch.long),
+    }
+
+
+def dense_spatial_crop_idx(protein, crop_size, random_seed, ca_ca_threshold, inf=3e4):
+    # the previous implementation, on the full distance matrix.
+    ca_idx = rc.atom_order["CA"]
+    ca_coords = protein["all_atom_positions"][..., ca_idx, :]
+    ca_mask = protein["all_atom_mask"][..., ca_idx].bool()
+    pair_mask = ca_mask[..., None] * ca_mask[..., None, :]
+    ca_distances = data_ops.get_pairwise_distances(ca_coords)
+    interface_candidates = data_ops.get_interface_candidates(
+        ca_distances, protein["asym_id"], pair_mask, ca_ca_threshold
+    )
+    with data_ops.numpy_seed(random_seed, key="multimer_spatial_crop"):
+        target_res = int(np.random.choice(interface_candidates))
+    to_target_distances = ca_distances[target_res]
+    to_target_distances[~ca_mask] = inf
+    to_target_distances += torch.arange(0, to_target_distances.shape[-1]).float() * 1e-3
+    ret = torch.argsort(to_target_distances)[:crop_size]
+    return ret.sort().values
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spatial Crop Benchmark")
+    parser.add_argument("--num-chains", default=24, type=int, help="Number of chains")
+    parser.add_argument("--chain-len", default=400, type=int, help="Residues per chain")
+    parser.add_argument("--crop-size", default=384, type=int, help="Crop size")
+    parser.add_argument("--threshold", default=10.0, type=float, help="CA-CA interface threshold")
+    parser.add_argument("--seeds", default=5, type=int, help="Number of crops")
+    args = parser.parse_args()
+
+    protein = make_assembly(args.num_chains, args.chain_len)
+    dense_time = sparse_time = 0.0
+    for seed in range(args.seeds):
+        t = time.perf_counter()
+        dense = dense_spatial_crop_idx(protein, args.crop_size, seed, args.threshold)
+        dense_time += time.perf_counter() - t
+        t = time.perf_counter()
+        sparse = data_ops.get_spatial_crop_idx(protein, args.crop_size, seed, args.threshold)
+        sparse_time += time.perf_counter() - t
+        assert torch.equal(dense, sparse), f"crops differ for seed {seed}"
+    print(
+        f"{args.num_chains * args.chain_len} residues: "
+        f"dense {dense_time / args.seeds * 1e3:.1f} ms, "
+        f"kd-tree {sparse_time / args.seeds * 1e3:.1f} ms per crop"
+    )
+
+
+if __name__ == "__main__":
+    main()
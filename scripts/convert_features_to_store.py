@@ -0,0 +1,83 @@
+"""Pack `<name>.<suffix>.pkl.gz` trees into memory-mapped feature stores.
+
+usage: python scripts/convert_features_to_store.py DATA_DIR [NUM_SHARDS] [NUM_WORKERS]
+
+For every tree found under DATA_DIR (pdb_features, pdb_uniprots, pdb_labels,
+sd_features, sd_labels) a sibling `<tree>.store` directory is written, which
+`unifold.dataset` picks up in place of the pickle tree.
+"""
+
+import os
+import sys
+import glob
+import gzip
+import pickle
+from functools import partial
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+from unifold.data import feature_store
+from unifold.data.utils import uncompress_features
+
+TREES = {
+    "pdb_features": "feature",
+    "pdb_uniprots": "uniprot",
+    "pdb_labels": "label",
+    "sd_features": "feature",
+    "sd_labels": "label",
+}
+
+
+def __load_from_file__(path):
+    open_fn = gzip.open if path.endswith(".gz") else open
+    with open_fn(path, "rb") as f:
+        return uncompress_features(pickle.load(f))
+
+
+def iter_entries(files, suffix):
+    for path in files:
+        entry_id = os.path.basename(path)[: -len(f".{suffix}.pkl.gz")]
+        yield entry_id, __load_from_file__(path)
+
+
+def write_one_shard(job, store_dir, suffix):
+    shard_idx, files = job
+    return feature_store.write_shard(
+        os.path.join(store_dir, feature_store.shard_name(shard_idx)),
+        iter_entries(files, suffix),
+    )
+
+
+def convert_tree(data_dir, tree, suffix, num_shards, num_workers):
+    files = sorted(glob.glob(os.path.join(data_dir, tree, f"*.{suffix}.pkl.gz")))
+    if not files:
+        return
+    store_dir = os.path.join(data_dir, tree + feature_store.STORE_SUFFIX)
+    os.makedirs(store_dir, exist_ok=True)
+
+    shards = [[] for _ in range(num_shards)]
+    for path in files:
+        entry_id = os.path.basename(path)[: -len(f".{suffix}.pkl.gz")]
+        shards[feature_store.get_shard_idx(entry_id, num_shards)].append(path)
+
+    func = partial(write_one_shard, store_dir=store_dir, suffix=suffix)
+    num_entries = 0
+    with Pool(num_workers) as pool:
+        for n in tqdm(
+            pool.imap_unordered(func, enumerate(shards)), total=num_shards, desc=tree
+        ):
+            num_entries += n
+    # written last, so that a partially converted tree is never picked up.
+    feature_store.write_meta(
+        store_dir, num_shards, source=tree, suffix=suffix, num_entries=num_entries
+    )
+    print(f"{tree}: packed {num_entries} entries into {num_shards} shards.")
+
+
+if __name__ == "__main__":
+    data_dir = sys.argv[1]
+    num_shards = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    num_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    for tree, suffix in TREES.items():
+        convert_tree(data_dir, tree, suffix, num_shards, num_workers)
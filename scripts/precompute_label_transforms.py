@@ -0,0 +1,77 @@
+"""Store the outputs of `label_transform_fn` next to the ground truth labels.
+
+usage: python scripts/precompute_label_transforms.py DATA_DIR [NUM_WORKERS]
+
+The atom14 positions, rigid group frames and torsion angles of a label only
+depend on its structure, so they are computed once here instead of for every
+training sample. Both label trees (pdb_labels, sd_labels) are updated in
+place, as packed stores if they have been converted, or as pickles otherwise.
+Entries that already have the tensors are skipped, so the script can be
+re-run after adding labels.
+"""
+
+import os
+import sys
+import glob
+import gzip
+import pickle
+from multiprocessing import Pool
+
+from tqdm import tqdm
+
+from unifold.data import feature_store
+from unifold.data.process import compute_label_transforms, has_label_transforms
+
+TREES = ["pdb_labels", "sd_labels"]
+
+
+def add_label_transforms(label):
+    if not has_label_transforms(label):
+        label = dict(label)
+        label.update(compute_label_transforms(label))
+    return label
+
+
+def update_pickle(path):
+    with gzip.open(path, "rb") as f:
+        label = pickle.load(f)
+    if has_label_transforms(label):
+        return 0
+    label = add_label_transforms(label)
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wb") as f:
+        pickle.dump(label, f, protocol=4)
+    os.replace(tmp_path, path)
+    return 1
+
+
+def update_shard(path):
+    shard = feature_store.FeatureShard(path)
+    if all(has_label_transforms(shard.index[e]) for e in shard.index):
+        return 0
+    entries = ((e, add_label_transforms(shard.load(e))) for e in shard.index)
+    return feature_store.write_shard(path, entries)
+
+
+def update_tree(data_dir, tree, num_workers):
+    store_dir = os.path.join(data_dir, tree + feature_store.STORE_SUFFIX)
+    if feature_store.is_store(store_dir):
+        files = sorted(glob.glob(os.path.join(store_dir, "shard_*.ufs")))
+        func = update_shard
+    else:
+        files = sorted(glob.glob(os.path.join(data_dir, tree, "*.label.pkl.gz")))
+        func = update_pickle
+    if not files:
+        return
+    num_updated = 0
+    with Pool(num_workers) as pool:
+        for n in tqdm(pool.imap_unordered(func, files), total=len(files), desc=tree):
+            num_updated += n
+    print(f"{tree}: updated {num_updated} of {len(files)} files.")
+
+
+if __name__ == "__main__":
+    data_dir = sys.argv[1]
+    num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    for tree in TREES:
+        update_tree(data_dir, tree, num_workers)
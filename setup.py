@@ -32,7 +32,6 @@ setup(
         "biopython",
         "ml-collections",
         "numpy",
-        "pandas",
         "scipy",
     ],
     classifiers=[
@@ -1,3 +1,4 @@
+from unifold.chunk_tuner import ChunkSizeTuner, automatic_chunk_size
 from unifold.config import model_config
 from unifold.modules.alphafold import AlphaFold
 from unifold.data import residue_constants, protein
@@ -17,6 +18,7 @@ import math,time
 import numpy as np
 import pickle,gzip,os,json
 from unifold.dataset import process_ap
+from unifold.data.process import NonensembledCache
 # from https://github.com/deepmind/alphafold/blob/main/run_alphafold.py
 
 RELAX_MAX_ITERATIONS = 0
@@ -29,6 +31,9 @@ MAX_RECYCLING_ITERS = 3
 NUM_ENSEMBLES = 1
 SAMPLE_TEMPLATES = False
 DATA_RANDOM_SEED = 42
+# profile the chunk sizes on the model device, see `ChunkSizeTuner`. Off by
+# default, as with --autotune_chunk_size in inference.py.
+AUTOTUNE_CHUNK_SIZE = False
 
 
 def prepare_model_runner(param_path,bf16 = False,model_device=''):
@@ -50,35 +55,6 @@ def prepare_model_runner(param_path,bf16 = False,model_device=''):
         model.bfloat16()
     return model
 
-def get_device_mem(device):
-    if device != "cpu" and torch.cuda.is_available():
-        cur_device = torch.cuda.current_device()
-        prop = torch.cuda.get_device_properties("cuda:{}".format(cur_device))
-        total_memory_in_GB = prop.total_memory / 1024 / 1024 / 1024
-        return total_memory_in_GB
-    else:
-        return 40
-    
-def automatic_chunk_size(seq_len, device, is_bf16 = False):
-    total_mem_in_GB = get_device_mem(device)
-    factor = math.sqrt(total_mem_in_GB/40.0*(0.55 * is_bf16 + 0.45))*0.95
-    if seq_len < int(1024*factor):
-        chunk_size = 256
-        block_size = None
-    elif seq_len < int(2048*factor):
-        chunk_size = 128
-        block_size = None
-    elif seq_len < int(3072*factor):
-        chunk_size = 64
-        block_size = None
-    elif seq_len < int(4096*factor):
-        chunk_size = 32
-        block_size = 512
-    else:
-        chunk_size = 4
-        block_size = 256
-    return chunk_size, block_size
-
 def remove_recycling_dimensions(batch, out):
         def to_float(x):
             if x.dtype == torch.bfloat16 or x.dtype == torch.half:
@@ -116,6 +92,10 @@ def predict_iterations(feature_dict,output_dir='',param_path='',input_seqs=[],
     else:
         model_device = 'cpu'
     model = prepare_model_runner(param_path,model_device=model_device)
+    tuner = None
+    if AUTOTUNE_CHUNK_SIZE:
+        tuner = ChunkSizeTuner(model, configs.data, model_device)
+    nonensembled_cache = NonensembledCache()
     
     for it in range(num_inference):
         cur_seed = hash((DATA_RANDOM_SEED, it)) % 100000
@@ -125,13 +105,14 @@ def predict_iterations(feature_dict,output_dir='',param_path='',input_seqs=[],
                            seed=cur_seed,batch_idx=None,
                            data_idx=None,is_distillation=False,
                            chain_id_map = chain_id_map,
-                           crosslinks = crosslinks)
+                           crosslinks = crosslinks,
+                           nonensembled_cache = nonensembled_cache)
         # faster prediction with large chunk/block size
         seq_len = batch["aatype"].shape[-1]
-        chunk_size, block_size = automatic_chunk_size(
-                                    seq_len,
-                                    model_device
-                                )
+        if tuner is not None:
+            chunk_size, block_size = tuner.get(seq_len)
+        else:
+            chunk_size, block_size = automatic_chunk_size(seq_len, model_device, False)
         model.globals.chunk_size = chunk_size
         model.globals.block_size = block_size
 
@@ -150,14 +131,18 @@ def predict_iterations(feature_dict,output_dir='',param_path='',input_seqs=[],
                     k: v for k, v in raw_out.items()
                     if k.startswith("final_") or k in score
                 }
+            num_res = batch["aatype"].shape[-1]
+            xl_idx = batch.pop("xl_idx").reshape(-1, 2)
+            xl_idx = xl_idx[batch.pop("xl_value").reshape(-1) > 0].long().cpu()
+            asym_id = batch["asym_id"].reshape(-1, num_res)[-1].cpu()
             batch, out = remove_recycling_dimensions(batch,out)
             ca_idx = rc.atom_order["CA"]
             ca_coords = torch.from_numpy(out["final_atom_positions"][..., ca_idx, :])
-            distances = get_pairwise_distances(ca_coords)#[0]#[0,0]
-            xl = torch.from_numpy(batch['xl'][...,0].astype(np.int32) > 0)
-            interface = torch.from_numpy(batch['asym_id'][..., None] != batch['asym_id'][..., None, :])
-            satisfied = torch.sum(distances[xl[0] & interface[0]] <= cutoff) / 2
-            total_xl = torch.sum(xl & interface) / 2
+            distances = get_pairwise_distances(ca_coords.reshape(-1, num_res, 3)[0])
+            interface = asym_id[xl_idx[:, 0]] != asym_id[xl_idx[:, 1]]
+            xl_distances = distances[xl_idx[:, 0], xl_idx[:, 1]][interface]
+            satisfied = torch.sum(xl_distances <= cutoff) / 2
+            total_xl = torch.sum(interface) / 2
             if np.mean(out["iptm+ptm"]) > best_iptm:
                 best_iptm = np.mean(out["iptm+ptm"])
                 best_out = out
@@ -0,0 +1,241 @@
+"""Chunk and block sizes of the model, chosen by measuring them.
+
+`automatic_chunk_size` guesses them from the length and the device memory.
+`ChunkSizeTuner` instead runs one block of the Evoformer and of the extra MSA
+stack on random inputs of each length bucket, with each of `CANDIDATES`, and
+keeps the fastest setting whose peak memory fits the device. The choices are
+saved in a json file, keyed by the model config, the device and the dtype, so
+each bucket is only profiled once per machine.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+
+import torch
+
+from unifold.modules.attentions import gen_msa_attn_mask, gen_tri_attn_mask
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "unifold", "chunk_sizes.json"
+)
+
+# (chunk_size, block_size), from the fastest to the leanest.
+CANDIDATES = [
+    (None, None),
+    (256, None),
+    (128, None),
+    (64, None),
+    (32, 512),
+    (16, 256),
+    (4, 256),
+]
+
+
+def get_device_mem(device):
+    if device != "cpu" and torch.cuda.is_available():
+        cur_device = torch.cuda.current_device()
+        prop = torch.cuda.get_device_properties("cuda:{}".format(cur_device))
+        total_memory_in_GB = prop.total_memory / 1024 / 1024 / 1024
+        return total_memory_in_GB
+    else:
+        return 40
+
+
+def automatic_chunk_size(seq_len, device, is_bf16):
+    total_mem_in_GB = get_device_mem(device)
+    factor = math.sqrt(total_mem_in_GB/40.0*(0.55 * is_bf16 + 0.45))*0.95
+    if seq_len < int(1024*factor):
+        chunk_size = 256
+        block_size = None
+    elif seq_len < int(2048*factor):
+        chunk_size = 128
+        block_size = None
+    elif seq_len < int(3072*factor):
+        chunk_size = 64
+        block_size = None
+    elif seq_len < int(4096*factor):
+        chunk_size = 32
+        block_size = 512
+    else:
+        chunk_size = 4
+        block_size = 256
+    return chunk_size, block_size
+
+
+def is_out_of_memory(ex):
+    return isinstance(ex, RuntimeError) and "out of memory" in str(ex)
+
+
+class ChunkSizeTuner:
+    """Chunk and block sizes per length bucket, profiled on first use.
+
+    `memory_fraction` is the share of the memory left after loading the model
+    that one block may peak at; the rest is kept for the representations the
+    model holds around it. On CPU, `automatic_chunk_size` is used.
+    """
+
+    def __init__(
+        self,
+        model,
+        data_config,
+        device,
+        cache_path=DEFAULT_CACHE_PATH,
+        bucket_size=128,
+        memory_fraction=0.6,
+    ):
+        self.model = model
+        self.device = torch.device(device)
+        self.bucket_size = bucket_size
+        self.memory_fraction = memory_fraction
+        self.cache_path = cache_path
+        self.num_msa = data_config.predict.max_msa_clusters
+        if model.config.template.embed_angles:
+            self.num_msa += data_config.predict.max_templates
+        self.num_extra_msa = data_config.common.max_extra_msa
+        self.key_prefix = self.make_key_prefix()
+        self.cache = self.load_cache()
+
+    def make_key_prefix(self):
+        model_config = json.dumps(self.model.config.to_dict(), sort_keys=True, default=str)
+        config_hash = hashlib.sha1(model_config.encode()).hexdigest()[:16]
+        if self.device.type == "cuda":
+            prop = torch.cuda.get_device_properties(self.device)
+            device_name = f"{prop.name}-{prop.total_memory >> 20}MB"
+        else:
+            device_name = self.device.type
+        return f"{config_hash}/{device_name}/{self.model.dtype}/{self.num_msa}/{self.num_extra_msa}"
+
+    def load_cache(self):
+        if self.cache_path is None or not os.path.isfile(self.cache_path):
+            return {}
+        with open(self.cache_path) as f:
+            return json.load(f)
+
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+        tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.cache, f, indent=4, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+    def get_bucket(self, seq_len):
+        return int(math.ceil(seq_len / self.bucket_size)) * self.bucket_size
+
+    def get(self, seq_len):
+        """(chunk_size, block_size) for a target of `seq_len` residues."""
+        if self.device.type != "cuda":
+            return automatic_chunk_size(
+                seq_len, str(self.device), self.model.dtype == torch.bfloat16
+            )
+        bucket = self.get_bucket(seq_len)
+        key = f"{self.key_prefix}/{bucket}"
+        if key not in self.cache:
+            self.cache.update(self.load_cache())
+        if key not in self.cache:
+            self.cache[key] = self.tune(bucket)
+            self.save_cache()
+        chunk_size, block_size = self.cache[key]["chunk_size"], self.cache[key]["block_size"]
+        return chunk_size, block_size
+
+    def tune(self, bucket):
+        torch.cuda.empty_cache()
+        base_memory = torch.cuda.memory_allocated(self.device)
+        free_memory = torch.cuda.get_device_properties(self.device).total_memory - base_memory
+        budget = self.memory_fraction * free_memory
+        best = None
+        for chunk_size, block_size in CANDIDATES:
+            try:
+                latency, peak_memory = self.profile(bucket, chunk_size, block_size)
+            except RuntimeError as ex:
+                if not is_out_of_memory(ex):
+                    raise
+                torch.cuda.empty_cache()
+                logger.info(f"bucket {bucket}: {chunk_size}/{block_size} out of memory")
+                continue
+            peak_memory -= base_memory
+            logger.info(
+                f"bucket {bucket}: {chunk_size}/{block_size} "
+                f"{latency * 1e3:.1f} ms, {peak_memory / 2**30:.2f} GB"
+            )
+            if peak_memory <= budget and (best is None or latency < best["latency"]):
+                best = {
+                    "chunk_size": chunk_size,
+                    "block_size": block_size,
+                    "latency": latency,
+                    "peak_memory": peak_memory,
+                }
+        if best is None:
+            chunk_size, block_size = CANDIDATES[-1]
+            best = {"chunk_size": chunk_size, "block_size": block_size}
+        logger.info(f"bucket {bucket}: using {best['chunk_size']}/{best['block_size']}")
+        return best
+
+    def make_inputs(self, num_seq, num_res, d_msa, d_pair):
+        kwargs = {"dtype": self.model.dtype, "device": self.device}
+        m = torch.randn(1, num_seq, num_res, d_msa, **kwargs)
+        z = torch.randn(1, num_res, num_res, d_pair, **kwargs)
+        msa_mask = torch.ones(1, num_seq, num_res, **kwargs)
+        pair_mask = torch.ones(1, num_res, num_res, **kwargs)
+        return m, z, msa_mask, pair_mask
+
+    def run_block(self, block, inputs, chunk_size, block_size, is_extra_msa):
+        m, z, msa_mask, pair_mask = inputs
+        inf = self.model.inf
+        if is_extra_msa:
+            msa_row_attn_mask = gen_msa_attn_mask(msa_mask, inf=inf, gen_col_mask=False)
+            msa_col_attn_mask = None
+        else:
+            msa_row_attn_mask, msa_col_attn_mask = gen_msa_attn_mask(msa_mask, inf=inf)
+        tri_start_attn_mask, tri_end_attn_mask = gen_tri_attn_mask(pair_mask, inf)
+        return block(
+            m.clone(),
+            z.clone(),
+            msa_mask=msa_mask,
+            pair_mask=pair_mask,
+            msa_row_attn_mask=msa_row_attn_mask,
+            msa_col_attn_mask=msa_col_attn_mask,
+            tri_start_attn_mask=tri_start_attn_mask,
+            tri_end_attn_mask=tri_end_attn_mask,
+            chunk_size=chunk_size,
+            block_size=block_size,
+        )
+
+    @torch.no_grad()
+    def profile(self, num_res, chunk_size, block_size):
+        """Latency and peak memory of one Evoformer and one extra MSA block."""
+        config = self.model.config
+        d_pair = config.evoformer_stack.d_pair
+        blocks = [
+            (self.model.evoformer.blocks[0], self.num_msa, config.evoformer_stack.d_msa, False)
+        ]
+        if config.extra_msa.enabled:
+            blocks.append(
+                (
+                    self.model.extra_msa_stack.blocks[0],
+                    self.num_extra_msa,
+                    config.extra_msa.extra_msa_stack.d_msa,
+                    True,
+                )
+            )
+        latency, peak_memory = 0.0, 0
+        for block, num_seq, d_msa, is_extra_msa in blocks:
+            inputs = self.make_inputs(num_seq, num_res, d_msa, d_pair)
+            # the first run warms up the kernels and the allocator.
+            self.run_block(block, inputs, chunk_size, block_size, is_extra_msa)
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            t = time.perf_counter()
+            self.run_block(block, inputs, chunk_size, block_size, is_extra_msa)
+            torch.cuda.synchronize(self.device)
+            latency += time.perf_counter() - t
+            peak_memory = max(peak_memory, torch.cuda.max_memory_allocated(self.device))
+            del inputs
+        return latency, peak_memory
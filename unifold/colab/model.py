@@ -78,7 +78,7 @@ def colab_inference(
         model.globals.chunk_size = chunk_size
         model.globals.block_size = block_size
 
-        print("using %d crosslink(s)" %(torch.sum((batch['xl'] > 0) / 2)))
+        print("using %d crosslink(s)" %(torch.sum(batch['xl_value'] > 0) / 2))
 
         with torch.no_grad():
             batch = {
@@ -159,8 +159,8 @@ def colab_inference(
 
     distances = get_pairwise_distances(ca_coords)
 
-    xl = batch['xl'][...,0] > 0
+    xl_idx = batch['xl_idx'][batch['xl_value'] > 0]
 
-    best_result['xl'] = [(i.item(),j.item(),distances[i,j].item()) for i,j in torch.nonzero(torch.from_numpy(xl)) if i < j ]
+    best_result['xl'] = [(i,j,distances[i,j].item()) for i,j in sorted(map(tuple,xl_idx.tolist())) if i < j ]
     
     return best_result
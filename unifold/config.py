@@ -7,6 +7,7 @@ N_RES = "number of residues"
 N_MSA = "number of MSA sequences"
 N_EXTRA_MSA = "number of extra MSA sequences"
 N_TPL = "number of templates"
+N_XL = "number of crosslinks"
 
 
 d_pair = mlc.FieldReference(128, field_type=int)
@@ -97,6 +98,8 @@ def base_config():
                         "asym_len": [None],
                         "cluster_bias_mask": [N_MSA],
                         "xl": [N_RES, N_RES, None],
+                        "xl_idx": [N_XL, None],
+                        "xl_value": [N_XL],
                     },
                     "masked_msa": {
                         "profile_prob": 0.1,
@@ -136,6 +139,8 @@ def base_config():
                         "num_recycling_iters",
                         "crop_and_fix_size_seed",
                         "xl",
+                        "xl_idx",
+                        "xl_value",
                         "real",
                     ],
                     "recycling_features": [
@@ -185,6 +190,7 @@ def base_config():
                     "max_msa_clusters": 128,
                     "max_templates": 4,
                     "num_ensembles": 2,
+                    "ensemble_workers": 0,
                     "crop": False,
                     "crop_size": None,
                     "supervised": False,
@@ -200,6 +206,7 @@ def base_config():
                     "max_msa_clusters": 128,
                     "max_templates": 4,
                     "num_ensembles": 1,
+                    "ensemble_workers": 0,
                     "crop": False,
                     "crop_size": None,
                     "spatial_crop_prob": 0.5,
@@ -217,6 +224,7 @@ def base_config():
                     "max_msa_clusters": 128,
                     "max_templates": 4,
                     "num_ensembles": 1,
+                    "ensemble_workers": 0,
                     "crop": True,
                     "crop_size": 256,
                     "spatial_crop_prob": 0.5,
@@ -241,6 +249,21 @@ def base_config():
                 "max_recycling_iters": max_recycling_iters,
                 "alphafold_original_mode": False,
                 "use_flash_attn": True,
+                # inference only, 0 runs all the recycles.
+                "recycle_early_stop_tolerance": 0.0,
+                "min_recycling_iters": 0,
+                # inference only, skip the side chains before the last recycle.
+                "backbone_only_recycles": False,
+                # per-op chunk sizes of the stacks (see `ChunkSizes`), None
+                # uses chunk_size, or block_size for tri_mul.
+                "chunk_sizes": {
+                    "msa_row": None,
+                    "msa_col": None,
+                    "opm": None,
+                    "tri_att": None,
+                    "tri_mul": None,
+                    "transition": None,
+                },
             },
             "model": {
                 "is_multimer": is_multimer,
@@ -1,12 +1,15 @@
+import contextlib
 import itertools
+import threading
 from functools import reduce, wraps
 from operator import add
 from typing import List, Optional, MutableMapping
 
 import numpy as np
 import torch
+from scipy.spatial import cKDTree
 
-from unifold.config import N_RES, N_EXTRA_MSA, N_TPL, N_MSA
+from unifold.config import N_RES, N_EXTRA_MSA, N_TPL, N_MSA, N_XL
 from unifold.data import residue_constants as rc
 from unifold.modules.frame import Rotation, Frame
 from unicore.utils import (
@@ -20,6 +23,47 @@ from unicore.data import data_utils
 NumpyDict = MutableMapping[str, np.ndarray]
 TorchDict = MutableMapping[str, np.ndarray]
 
+_thread_random = threading.local()
+_numpy_seed_lock = threading.Lock()
+
+
+def np_random():
+    """The numpy random state the data ops draw from.
+
+    This is the global one, unless the calling thread runs in `thread_random_state`.
+    """
+    state = getattr(_thread_random, "state", None)
+    return np.random if state is None else state
+
+
+@contextlib.contextmanager
+def thread_random_state(seed):
+    """Let the data ops of the calling thread draw from their own `RandomState`."""
+    _thread_random.state = np.random.RandomState(seed)
+    try:
+        yield
+    finally:
+        _thread_random.state = None
+
+
+@contextlib.contextmanager
+def numpy_seed(seed, *addl_seeds, key=None):
+    """`data_utils.numpy_seed` for the random state of `np_random()`."""
+    if getattr(_thread_random, "state", None) is None or seed is None:
+        with data_utils.numpy_seed(seed, *addl_seeds, key=key):
+            yield
+        return
+    # seed the global state as usual, and hand a copy of it to this thread.
+    with _numpy_seed_lock:
+        with data_utils.numpy_seed(seed, *addl_seeds, key=key):
+            seeded = np.random.RandomState()
+            seeded.set_state(np.random.get_state())
+    state, _thread_random.state = _thread_random.state, seeded
+    try:
+        yield
+    finally:
+        _thread_random.state = state
+
 protein: TorchDict
 
 MSA_FEATURE_NAMES = [
@@ -33,25 +77,133 @@ MSA_FEATURE_NAMES = [
 ]
 
 
+# kept in narrow dtypes until `make_msa_feat`, see `compact_msa_features`.
+COMPACT_MSA_FEATURE_NAMES = ["msa", "deletion_matrix"]
+
+# number of elements of the per-row temporaries (int64 indices, gathers and
+# one-hots) built for one chunk of MSA rows.
+MSA_CHUNK_ELEMENTS = 1 << 24
+
+
+def _msa_row_chunks(num_seq, num_res, width):
+    chunk_size = max(1, MSA_CHUNK_ELEMENTS // max(1, num_res * width))
+    for start in range(0, num_seq, chunk_size):
+        yield slice(start, start + chunk_size)
+
+
+# Row selections of the MSA features (`MSA_FEATURE_NAMES`, or their `extra_`
+# versions) are composed into one pending index, stored under
+# `<prefix>msa_row_index`, and gathered once by the first op reading the rows.
+def msa_row_index_key(prefix=""):
+    return prefix + "msa_row_index"
+
+
+def num_msa_rows(protein, prefix=""):
+    """Number of rows of the MSA features, counting a pending selection."""
+    key = msa_row_index_key(prefix)
+    if key in protein:
+        return protein[key].shape[0]
+    return protein[prefix + "msa"].shape[0]
+
+
+def select_msa_rows(protein, index, prefix=""):
+    """Select `index` of the current rows of the MSA features, without copying them."""
+    key = msa_row_index_key(prefix)
+    protein[key] = protein[key][index] if key in protein else index
+    return protein
+
+
+def gather_msa_rows(protein, prefix=""):
+    """Materialize the pending row selection of the MSA features, if any."""
+    index = protein.pop(msa_row_index_key(prefix), None)
+    if index is not None:
+        for k in MSA_FEATURE_NAMES:
+            if prefix + k in protein:
+                protein[prefix + k] = torch.index_select(protein[prefix + k], 0, index)
+    return protein
+
+
+def msa_rows(protein, key, rows, prefix=""):
+    """`rows` (a slice) of the MSA feature `prefix + key`, through the pending selection."""
+    index = protein.get(msa_row_index_key(prefix))
+    if index is None:
+        return protein[prefix + key][rows]
+    return torch.index_select(protein[prefix + key], 0, index[rows])
+
+
+def gather_all_msa_rows(protein):
+    gather_msa_rows(protein)
+    return gather_msa_rows(protein, prefix="extra_")
+
+
 def cast_to_64bit_ints(protein):
     # We keep all ints as int64
     for k, v in protein.items():
         if k.endswith("_mask"):
             protein[k] = v.type(torch.float32)
+        elif k in COMPACT_MSA_FEATURE_NAMES:
+            continue
         elif v.dtype in (torch.int32, torch.uint8, torch.int8):
             protein[k] = v.type(torch.int64)
 
     return protein
 
 
+def compact_deletion_matrix(deletion_matrix):
+    """The deletion counts in the narrowest integer type holding them.
+
+    Matrices with fractional or negative values are returned unchanged.
+    """
+    if deletion_matrix.numel() == 0:
+        return deletion_matrix.to(torch.uint8)
+    if deletion_matrix.is_floating_point() and not torch.equal(
+        deletion_matrix, torch.round(deletion_matrix)
+    ):
+        return deletion_matrix
+    min_value, max_value = deletion_matrix.min(), deletion_matrix.max()
+    if min_value < 0:
+        return deletion_matrix
+    if max_value <= torch.iinfo(torch.uint8).max:
+        return deletion_matrix.to(torch.uint8)
+    if max_value <= torch.iinfo(torch.int16).max:
+        return deletion_matrix.to(torch.int16)
+    return deletion_matrix.to(torch.int32)
+
+
+def compact_msa_features(protein):
+    """Keep the MSA as uint8 and the deletion counts as uint8 or int16.
+
+    The MSA ops up to clustering work on these; `make_msa_feat`,
+    `crop_extra_msa` and `make_extra_msa_feat` widen what the model takes.
+    """
+    protein["msa"] = protein["msa"].to(torch.uint8)
+    if "deletion_matrix" in protein:
+        protein["deletion_matrix"] = compact_deletion_matrix(protein["deletion_matrix"])
+    return protein
+
+
+def widen_msa_features(protein, prefix=""):
+    """Cast the MSA features compacted by `compact_msa_features` back to int64 and float32."""
+    for k in ["msa", "true_msa"]:
+        if prefix + k in protein:
+            protein[prefix + k] = protein[prefix + k].long()
+    if prefix + "deletion_matrix" in protein:
+        protein[prefix + "deletion_matrix"] = protein[prefix + "deletion_matrix"].float()
+    return protein
+
+
 def make_seq_mask(protein):
-    protein["seq_mask"] = torch.ones(protein["aatype"].shape, dtype=torch.float32)
+    protein["seq_mask"] = torch.ones(
+        protein["aatype"].shape, dtype=torch.float32, device=protein["aatype"].device
+    )
     return protein
 
 
 def make_template_mask(protein):
     protein["template_mask"] = torch.ones(
-        protein["template_aatype"].shape[0], dtype=torch.float32
+        protein["template_aatype"].shape[0],
+        dtype=torch.float32,
+        device=protein["template_aatype"].device,
     )
     return protein
 
@@ -68,14 +220,14 @@ def curry1(f):
 
 def correct_msa_restypes(protein):
     """Correct MSA restype to have the same order as rc."""
-    protein["msa"] = protein["msa"].long()
-    new_order_list = rc.MAP_HHBLITS_AATYPE_TO_OUR_AATYPE
-    new_order = (
-        torch.tensor(new_order_list, dtype=torch.int8)
-        .unsqueeze(-1)
-        .expand(-1, protein["msa"].shape[1])
+    msa = protein["msa"]
+    new_order = torch.tensor(
+        rc.MAP_HHBLITS_AATYPE_TO_OUR_AATYPE, dtype=torch.uint8, device=msa.device
     )
-    protein["msa"] = torch.gather(new_order, 0, protein["msa"]).long()
+    # the indices are widened to int64 one chunk of rows at a time.
+    protein["msa"] = torch.empty(msa.shape, dtype=torch.uint8, device=msa.device)
+    for rows in _msa_row_chunks(msa.shape[0], msa.shape[-1], 1):
+        protein["msa"][rows] = new_order[msa[rows].long()]
 
     return protein
 
@@ -118,14 +270,14 @@ def squeeze_features(protein):
 def randomly_replace_msa_with_unknown(protein, replace_proportion):
     """Replace a portion of the MSA with 'X'."""
     if replace_proportion > 0.0:
-        msa_mask = np.random.rand(protein["msa"].shape) < replace_proportion
+        msa_mask = np_random().rand(protein["msa"].shape) < replace_proportion
         x_idx = 20
         gap_idx = 21
         msa_mask = torch.logical_and(msa_mask, protein["msa"] != gap_idx)
         protein["msa"] = torch.where(
             msa_mask, torch.ones_like(protein["msa"]) * x_idx, protein["msa"]
         )
-        aatype_mask = np.random.rand(protein["aatype"].shape) < replace_proportion
+        aatype_mask = np_random().rand(protein["aatype"].shape) < replace_proportion
 
         protein["aatype"] = torch.where(
             aatype_mask,
@@ -135,16 +287,17 @@ def randomly_replace_msa_with_unknown(protein, replace_proportion):
     return protein
 
 
-def gumbel_noise(shape):
+def gumbel_noise(shape, device=None):
     """Generate Gumbel Noise of given Shape.
     This generates samples from Gumbel(0, 1).
     Args:
         shape: Shape of noise to return.
+        device: Device of the returned noise, drawn on the host in any case.
     Returns:
         Gumbel noise of given shape.
     """
     epsilon = 1e-6
-    uniform_noise = torch.from_numpy(np.random.uniform(0, 1, shape))
+    uniform_noise = torch.as_tensor(np_random().uniform(0, 1, shape), device=device)
     gumbel = -torch.log(-torch.log(uniform_noise + epsilon) + epsilon)
     return gumbel
 
@@ -158,7 +311,7 @@ def gumbel_max_sample(logits):
     Returns:
         Sample from logprobs in one-hot form.
     """
-    z = gumbel_noise(logits.shape)
+    z = gumbel_noise(logits.shape, logits.device)
     return torch.argmax(logits + z, dim=-1)
 
 
@@ -174,13 +327,13 @@ def gumbel_argsort_sample_idx(logits):
     Returns:
         Sample from logprobs in index
     """
-    z = gumbel_noise(logits.shape)
+    z = gumbel_noise(logits.shape, logits.device)
     return torch.argsort(logits + z, dim=-1, descending=True)
 
 
-def uniform_permutation(num_seq):
-    shuffled = torch.from_numpy(np.random.permutation(num_seq - 1) + 1)
-    return torch.cat((torch.tensor([0]), shuffled), dim=0)
+def uniform_permutation(num_seq, device=None):
+    shuffled = torch.as_tensor(np_random().permutation(num_seq - 1) + 1, device=device)
+    return torch.cat((torch.tensor([0], device=device), shuffled), dim=0)
 
 
 def gumbel_permutation(msa_mask, msa_chains=None):
@@ -194,12 +347,12 @@ def gumbel_permutation(msa_mask, msa_chains=None):
     logits = logits[1:]
     has_msa = has_msa[1:]
     if logits.shape[0] == 0:
-        return torch.tensor([0])
+        return torch.tensor([0], device=msa_mask.device)
     if msa_chains is not None:
         # skip first row
         msa_chains = msa_chains[1:].reshape(-1)
         msa_chains[~has_msa] = 0
-        keys, counts = np.unique(msa_chains, return_counts=True)
+        keys = torch.unique(msa_chains)
         num_has_msa = has_msa.sum()
         num_pair = (msa_chains == 1).sum()
         num_unpair = num_has_msa - num_pair
@@ -214,7 +367,7 @@ def gumbel_permutation(msa_mask, msa_chains=None):
                     logits[cur_mask] *= num_unpair / (num_chains * cur_cnt)
         logits = torch.log(logits + 1e-6)
     shuffled = gumbel_argsort_sample_idx(logits) + 1
-    return torch.cat((torch.tensor([0]), shuffled), dim=0)
+    return torch.cat((torch.tensor([0], device=msa_mask.device), shuffled), dim=0)
 
 
 @curry1
@@ -222,11 +375,12 @@ def sample_msa(
     protein, max_seq, keep_extra, gumbel_sample=False, biased_msa_by_chain=False
 ):
     """Sample MSA randomly, remaining sequences are stored are stored as `extra_*`."""
-    num_seq = protein["msa"].shape[0]
+    num_seq = num_msa_rows(protein)
     num_sel = min(max_seq, num_seq)
     if not gumbel_sample:
-        index_order = uniform_permutation(num_seq)
+        index_order = uniform_permutation(num_seq, protein["msa"].device)
     else:
+        gather_msa_rows(protein)
         msa_chains = (
             protein["msa_chains"]
             if (biased_msa_by_chain and "msa_chains" in protein)
@@ -236,11 +390,16 @@ def sample_msa(
     num_sel = min(max_seq, num_seq)
     sel_seq, not_sel_seq = torch.split(index_order, [num_sel, num_seq - num_sel])
 
-    for k in MSA_FEATURE_NAMES:
-        if k in protein:
-            if keep_extra:
-                protein["extra_" + k] = torch.index_select(protein[k], 0, not_sel_seq)
-            protein[k] = torch.index_select(protein[k], 0, sel_seq)
+    if keep_extra:
+        # the extra rows are selected from the same (not yet gathered) features.
+        for k in MSA_FEATURE_NAMES:
+            if k in protein:
+                protein["extra_" + k] = protein[k]
+        protein.pop(msa_row_index_key("extra_"), None)
+        if msa_row_index_key() in protein:
+            protein[msa_row_index_key("extra_")] = protein[msa_row_index_key()]
+        select_msa_rows(protein, not_sel_seq, prefix="extra_")
+    select_msa_rows(protein, sel_seq)
 
     return protein
 
@@ -252,42 +411,56 @@ def sample_msa_distillation(protein, max_seq):
     return protein
 
 
+def get_random_delete_msa_idx(num_seq, seq_len, config) -> Optional[np.ndarray]:
+    """Rows kept by `random_delete_msa`, or None if all rows are kept.
+
+    Shared with the lazy MSA loading in `unifold.dataset`, which selects rows
+    before decoding them, so both paths must draw exactly the same numbers.
+    """
+    max_seq = config.max_msa_entry // seq_len
+    if num_seq <= max_seq:
+        return None
+    keep_index = np_random().choice(num_seq - 1, max_seq - 1, replace=False) + 1
+    keep_index = np.sort(keep_index)
+    return np.concatenate(([0], keep_index))
+
+
 @curry1
 def random_delete_msa(protein, config):
     # to reduce the cost of msa features
     num_seq = protein["msa"].shape[0]
     seq_len = protein["msa"].shape[1]
-    max_seq = config.max_msa_entry // seq_len
-    if num_seq > max_seq:
-        keep_index = (
-            torch.from_numpy(
-                np.random.choice(num_seq - 1, max_seq - 1, replace=False)
-            ).long()
-            + 1
-        )
-        keep_index = torch.sort(keep_index)[0]
-        keep_index = torch.cat((torch.tensor([0]), keep_index), dim=0)
-        for k in MSA_FEATURE_NAMES:
-            if k in protein:
-                protein[k] = torch.index_select(protein[k], 0, keep_index)
-    return protein
+    keep_index = get_random_delete_msa_idx(num_seq, seq_len, config)
+    if keep_index is not None:
+        keep_index = torch.as_tensor(keep_index, device=protein["msa"].device)
+        select_msa_rows(protein, keep_index.long())
+    return gather_msa_rows(protein)
 
 
 @curry1
 def crop_extra_msa(protein, max_extra_msa):
-    num_seq = protein["extra_msa"].shape[0]
+    num_seq = num_msa_rows(protein, prefix="extra_")
     num_sel = min(max_extra_msa, num_seq)
-    select_indices = torch.from_numpy(np.random.permutation(num_seq)[:num_sel])
-    for k in MSA_FEATURE_NAMES:
-        if "extra_" + k in protein:
-            protein["extra_" + k] = torch.index_select(
-                protein["extra_" + k], 0, select_indices
-            )
+    select_indices = torch.as_tensor(
+        np_random().permutation(num_seq)[:num_sel], device=protein["extra_msa"].device
+    )
+    select_msa_rows(protein, select_indices, prefix="extra_")
+    gather_msa_rows(protein, prefix="extra_")
+    widen_msa_features(protein, prefix="extra_")
 
+    if "extra_deletion_matrix" in protein:
+        extra_deletion_matrix = protein["extra_deletion_matrix"]
+        protein["extra_msa_has_deletion"] = torch.clip(
+            extra_deletion_matrix, 0.0, 1.0
+        )
+        protein["extra_msa_deletion_value"] = torch.atan(
+            extra_deletion_matrix / 3.0
+        ) * (2.0 / np.pi)
     return protein
 
 
 def delete_extra_msa(protein):
+    protein.pop(msa_row_index_key("extra_"), None)
     for k in MSA_FEATURE_NAMES:
         if "extra_" + k in protein:
             del protein["extra_" + k]
@@ -298,7 +471,7 @@ def delete_extra_msa(protein):
 def block_delete_msa(protein, config):
     if "is_distillation" in protein and protein["is_distillation"] == 1:
         return protein
-    num_seq = protein["msa"].shape[0]
+    num_seq = num_msa_rows(protein)
     if num_seq <= config.min_num_msa:
         return protein
     block_num_seq = torch.floor(
@@ -306,54 +479,74 @@ def block_delete_msa(protein, config):
     ).to(torch.int32)
 
     if config.randomize_num_blocks:
-        nb = np.random.randint(0, config.num_blocks + 1)
+        nb = np_random().randint(0, config.num_blocks + 1)
     else:
         nb = config.num_blocks
 
-    del_block_starts = torch.from_numpy(np.random.randint(0, num_seq, [nb]))
-    del_blocks = del_block_starts[:, None] + torch.arange(0, block_num_seq)
-    del_blocks = torch.clip(del_blocks, 0, num_seq - 1)
-    del_indices = torch.unique(del_blocks.view(-1))
-    # add zeros to ensure cnt_zero > 1
-    combined = torch.hstack(
-        (torch.arange(0, num_seq)[None], del_indices[None], torch.zeros(2)[None])
-    ).long()
-    uniques, counts = combined.unique(return_counts=True)
-    difference = uniques[counts == 1]
-    intersection = uniques[counts > 1]
-    keep_indices = difference.view(-1)
-    keep_indices = torch.hstack([torch.zeros(1).long()[None], keep_indices[None]]).view(
-        -1
+    device = protein["msa"].device
+    del_block_starts = torch.as_tensor(
+        np_random().randint(0, num_seq, [nb]), device=device
     )
+    del_blocks = del_block_starts[:, None] + torch.arange(
+        0, int(block_num_seq), device=device
+    )
+    del_blocks = torch.clip(del_blocks, 0, num_seq - 1)
+    # the query row is always kept.
+    keep = torch.ones(num_seq, dtype=torch.bool, device=device)
+    keep[del_blocks.view(-1).long()] = False
+    keep[0] = True
+    keep_indices = torch.nonzero(keep).view(-1)
     assert int(keep_indices[0]) == 0
-    for k in MSA_FEATURE_NAMES:
-        if k in protein:
-            protein[k] = torch.index_select(protein[k], 0, index=keep_indices)
-    return protein
+    return select_msa_rows(protein, keep_indices)
 
 
-@curry1
-def nearest_neighbor_clusters(protein, gap_agreement_weight=0.0):
-    weights = torch.cat(
-        [torch.ones(21), gap_agreement_weight * torch.ones(1), torch.zeros(1)],
-        0,
+def _cluster_agreement_table(msa, msa_mask, gap_agreement_weight):
+    """(num_res, 23, num_seq) weighted agreement of each residue type with the sampled MSA.
+
+    Gathering it on the extra MSA tokens gives the rows of
+    `einsum('mrc,nrc,c->mn', extra_one_hot, sample_one_hot, weights)`
+    without one-hot encoding the extra MSA.
+    """
+    # Determine how much weight we assign to each agreement.  In theory, we could
+    # use a full blosum matrix here, but right now let's just down-weight gap
+    # agreement because it could be spurious.
+    # Never put weight on agreeing on BERT mask.
+    weights = torch.tensor(
+        [1.0] * 21 + [gap_agreement_weight] + [0.0],
+        dtype=torch.float32,
+        device=msa.device,
     )
+    sample_one_hot = (msa_mask * weights[msa.long()])[:, :, None] * one_hot(msa, 23)
+    return sample_one_hot.permute(1, 2, 0).contiguous()
 
-    msa_one_hot = one_hot(protein["msa"], 23)
-    sample_one_hot = protein["msa_mask"][:, :, None] * msa_one_hot
-    extra_msa_one_hot = one_hot(protein["extra_msa"], 23)
-    extra_one_hot = protein["extra_msa_mask"][:, :, None] * extra_msa_one_hot
 
-    num_seq, num_res, _ = sample_one_hot.shape
-    extra_num_seq, _, _ = extra_one_hot.shape
+def _cluster_agreement(table, extra_msa, extra_mask):
+    # (rows, num_seq) agreement of a chunk of extra MSA rows.
+    num_res = extra_msa.shape[1]
+    residues = torch.arange(num_res, device=extra_msa.device)
+    gathered = table[residues[None, :], extra_msa.long()]
+    return torch.bmm(extra_mask[:, None, :].float(), gathered).squeeze(1)
+
+
+@curry1
+def nearest_neighbor_clusters(protein, gap_agreement_weight=0.0):
+    gather_msa_rows(protein)
+    table = _cluster_agreement_table(
+        protein["msa"], protein["msa_mask"], gap_agreement_weight
+    )
+    num_res, _, num_seq = table.shape
+    extra_num_seq = num_msa_rows(protein, prefix="extra_")
 
-    # Compute tf.einsum('mrc,nrc,c->mn', sample_one_hot, extra_one_hot, weights)
-    # in an optimized fashion to avoid possible memory or computation blowup.
-    a = extra_one_hot.view(extra_num_seq, num_res * 23)
-    b = (sample_one_hot * weights).view(num_seq, num_res * 23).transpose(0, 1)
-    agreement = a @ b
     # Assign each sequence in the extra sequences to the closest MSA sample
-    protein["extra_cluster_assignment"] = torch.argmax(agreement, dim=1).long()
+    assignment = torch.empty(extra_num_seq, dtype=torch.long, device=table.device)
+    for rows in _msa_row_chunks(extra_num_seq, num_res, num_seq):
+        agreement = _cluster_agreement(
+            table,
+            msa_rows(protein, "msa", rows, prefix="extra_"),
+            msa_rows(protein, "msa_mask", rows, prefix="extra_"),
+        )
+        assignment[rows] = torch.argmax(agreement, dim=1)
+    protein["extra_cluster_assignment"] = assignment
 
     return protein
 
@@ -363,28 +556,47 @@ def unsorted_segment_sum(data, segment_ids, num_segments):
     segment_ids = segment_ids.view(segment_ids.shape[0], *((1,) * len(data.shape[1:])))
     segment_ids = segment_ids.expand(data.shape)
     shape = [num_segments] + list(data.shape[1:])
-    tensor = torch.zeros(*shape).scatter_add_(0, segment_ids, data.float())
+    tensor = torch.zeros(*shape, device=data.device)
+    tensor = tensor.scatter_add_(0, segment_ids, data.float())
     tensor = tensor.type(data.dtype)
     return tensor
 
 
 def summarize_clusters(protein):
     """Produce profile and deletion_matrix_mean within each cluster."""
-    num_seq = protein["msa"].shape[0]
-
-    def csum(x):
-        return unsorted_segment_sum(x, protein["extra_cluster_assignment"], num_seq)
-
-    mask = protein["extra_msa_mask"]
-    mask_counts = 1e-6 + protein["msa_mask"] + csum(mask)  # Include center
-
-    # TODO: this line is very slow
-    msa_sum = csum(mask[:, :, None] * one_hot(protein["extra_msa"], 23))
+    gather_msa_rows(protein)
+    num_seq, num_res = protein["msa"].shape
+    assignment = protein["extra_cluster_assignment"]
+
+    # the extra rows are read one chunk at a time, through their pending
+    # selection. The masks of the extra rows are added into the flattened
+    # (cluster, residue, token) cells they hit, instead of summing their
+    # one-hot encodings.
+    device = protein["msa"].device
+    mask_sum = torch.zeros(num_seq, num_res, dtype=torch.float32, device=device)
+    del_sum = torch.zeros(num_seq, num_res, dtype=torch.float32, device=device)
+    msa_sum = torch.zeros(num_seq * num_res * 23, dtype=torch.float32, device=device)
+    residue_offset = torch.arange(num_res, device=device) * 23
+    for rows in _msa_row_chunks(assignment.shape[0], num_res, 1):
+        mask = msa_rows(protein, "msa_mask", rows, prefix="extra_").float()
+        cell = (
+            assignment[rows, None] * (num_res * 23)
+            + residue_offset
+            + msa_rows(protein, "msa", rows, prefix="extra_").long()
+        )
+        msa_sum.index_add_(0, cell.view(-1), mask.reshape(-1))
+        mask_sum.index_add_(0, assignment[rows], mask)
+        del_sum.index_add_(
+            0,
+            assignment[rows],
+            mask * msa_rows(protein, "deletion_matrix", rows, prefix="extra_"),
+        )
+    mask_counts = 1e-6 + protein["msa_mask"] + mask_sum  # Include center
+    msa_sum = msa_sum.view(num_seq, num_res, 23)
     msa_sum += one_hot(protein["msa"], 23)  # Original sequence
     protein["cluster_profile"] = msa_sum / mask_counts[:, :, None]
     del msa_sum
 
-    del_sum = csum(mask * protein["extra_deletion_matrix"])
     del_sum += protein["deletion_matrix"]  # Original sequence
     protein["cluster_deletion_mean"] = del_sum / mask_counts
     del del_sum
@@ -395,61 +607,57 @@ def summarize_clusters(protein):
 @curry1
 def nearest_neighbor_clusters_v2(batch, gap_agreement_weight=0.0):
     """Assign each extra MSA sequence to its nearest neighbor in sampled MSA."""
-
-    # Determine how much weight we assign to each agreement.  In theory, we could
-    # use a full blosum matrix here, but right now let's just down-weight gap
-    # agreement because it could be spurious.
-    # Never put weight on agreeing on BERT mask.
-
-    weights = torch.tensor(
-        [1.0] * 21 + [gap_agreement_weight] + [0.0], dtype=torch.float32
-    )
+    gather_msa_rows(batch)
 
     msa_mask = batch["msa_mask"]
-    extra_mask = batch["extra_msa_mask"]
-    msa_one_hot = one_hot(batch["msa"], 23)
-    extra_one_hot = one_hot(batch["extra_msa"], 23)
-
-    msa_one_hot_masked = msa_mask[:, :, None] * msa_one_hot
-    extra_one_hot_masked = extra_mask[:, :, None] * extra_one_hot
-
-    t1 = weights * msa_one_hot_masked
-    t1 = t1.view(t1.shape[0], t1.shape[1] * t1.shape[2])
-    t2 = extra_one_hot_masked.view(
-        extra_one_hot.shape[0], extra_one_hot.shape[1] * extra_one_hot.shape[2]
-    )
-    agreement = t1 @ t2.T
-
-    cluster_assignment = torch.nn.functional.softmax(1e3 * agreement, dim=0)
-    cluster_assignment *= torch.einsum("mr, nr->mn", msa_mask, extra_mask)
-
-    cluster_count = torch.sum(cluster_assignment, dim=-1)
-    cluster_count += 1.0  # We always include the sequence itself.
-
-    msa_sum = torch.einsum("nm, mrc->nrc", cluster_assignment, extra_one_hot_masked)
-    msa_sum += msa_one_hot_masked
-
-    cluster_profile = msa_sum / cluster_count[:, None, None]
-
-    deletion_matrix = batch["deletion_matrix"]
-    extra_deletion_matrix = batch["extra_deletion_matrix"]
+    table = _cluster_agreement_table(batch["msa"], msa_mask, gap_agreement_weight)
+    num_res, _, num_seq = table.shape
+    extra_num_seq = num_msa_rows(batch, prefix="extra_")
+
+    # the extra rows are read through their pending selection, and the soft
+    # assignment and the one-hot extra rows are only built for one chunk of
+    # extra rows at a time.
+    # We always include the sequence itself.
+    cluster_count = torch.ones(num_seq, device=msa_mask.device)
+    msa_sum = msa_mask[:, :, None] * one_hot(batch["msa"], 23)
+    del_sum = batch["deletion_matrix"].float()  # Original sequence.
+    for rows in _msa_row_chunks(extra_num_seq, num_res, max(num_seq, 23)):
+        extra_msa = msa_rows(batch, "msa", rows, prefix="extra_")
+        extra_mask_chunk = msa_rows(batch, "msa_mask", rows, prefix="extra_")
+        agreement = _cluster_agreement(table, extra_msa, extra_mask_chunk).T
+
+        cluster_assignment = torch.nn.functional.softmax(1e3 * agreement, dim=0)
+        cluster_assignment *= torch.einsum("mr, nr->mn", msa_mask, extra_mask_chunk)
+
+        cluster_count += torch.sum(cluster_assignment, dim=-1)
+
+        extra_one_hot_masked = extra_mask_chunk[:, :, None] * one_hot(extra_msa, 23)
+        msa_sum += torch.einsum(
+            "nm, mrc->nrc", cluster_assignment, extra_one_hot_masked
+        )
+        del_sum += torch.einsum(
+            "nm, mc->nc",
+            cluster_assignment,
+            extra_mask_chunk
+            * msa_rows(batch, "deletion_matrix", rows, prefix="extra_"),
+        )
 
-    del_sum = torch.einsum(
-        "nm, mc->nc", cluster_assignment, extra_mask * extra_deletion_matrix
-    )
-    del_sum += deletion_matrix  # Original sequence.
-    cluster_deletion_mean = del_sum / cluster_count[:, None]
-    batch["cluster_profile"] = cluster_profile
-    batch["cluster_deletion_mean"] = cluster_deletion_mean
+    batch["cluster_profile"] = msa_sum / cluster_count[:, None, None]
+    batch["cluster_deletion_mean"] = del_sum / cluster_count[:, None]
 
     return batch
 
 
 def make_msa_mask(protein):
     """Mask features are all ones, but will later be zero-padded."""
+    device = protein["msa"].device
     if "msa_mask" not in protein:
-        protein["msa_mask"] = torch.ones(protein["msa"].shape, dtype=torch.float32)
-    protein["msa_row_mask"] = torch.ones((protein["msa"].shape[0]), dtype=torch.float32)
+        protein["msa_mask"] = torch.ones(
+            protein["msa"].shape, dtype=torch.float32, device=device
+        )
+    protein["msa_row_mask"] = torch.ones(
+        (protein["msa"].shape[0]), dtype=torch.float32, device=device
+    )
     return protein
 
 
@@ -503,8 +711,9 @@ def shaped_categorical(probs, epsilon=1e-10):
     ds = probs.shape
     num_classes = ds[-1]
     probs = torch.reshape(probs + epsilon, [-1, num_classes])
-    gen = torch.Generator()
-    gen.manual_seed(np.random.randint(65535))
+    # a generator of another device draws other samples from the same seed.
+    gen = torch.Generator(device=probs.device)
+    gen.manual_seed(np_random().randint(65535))
     counts = torch.multinomial(probs, 1, generator=gen)
     return torch.reshape(counts, ds[:-1])
 
@@ -515,19 +724,33 @@ def make_hhblits_profile(protein):
         return protein
 
     # Compute the profile for every residue (over all MSA sequences).
-    msa_one_hot = one_hot(protein["msa"], 22)
+    msa_counts = msa_token_counts(protein["msa"], 22)
 
-    protein["hhblits_profile"] = torch.mean(msa_one_hot, dim=0)
+    protein["hhblits_profile"] = msa_counts / protein["msa"].shape[0]
     return protein
 
 
+def msa_token_counts(msa, num_classes, weights=None):
+    """`(one_hot(msa, num_classes) * weights[..., None]).sum(0)` without the one-hot."""
+    num_res = msa.shape[1]
+    counts = torch.zeros(num_res * num_classes, dtype=torch.float32, device=msa.device)
+    offset = torch.arange(num_res, device=msa.device) * num_classes
+    for rows in _msa_row_chunks(msa.shape[0], num_res, 1):
+        cell = offset + msa[rows].long()
+        if weights is None:
+            values = torch.ones(cell.shape, dtype=torch.float32, device=msa.device)
+        else:
+            values = weights[rows].float()
+        counts.index_add_(0, cell.view(-1), values.reshape(-1))
+    return counts.view(num_res, num_classes)
+
+
 def make_msa_profile(batch):
     """Compute the MSA profile."""
     # Compute the profile for every residue (over all MSA sequences).
-    oh = one_hot(batch["msa"], 22)
-    mask = batch["msa_mask"][:, :, None]
-    oh *= mask
-    return oh.sum(dim=0) / (mask.sum(dim=0) + 1e-10)
+    mask = batch["msa_mask"]
+    msa_counts = msa_token_counts(batch["msa"], 22, weights=mask)
+    return msa_counts / (mask.sum(dim=0)[:, None] + 1e-10)
 
 
 def make_hhblits_profile_v2(protein):
@@ -561,8 +784,11 @@ def make_masked_msa(
     protein, config, replace_fraction, gumbel_sample=False, share_mask=False
 ):
     """Create data for BERT on raw MSA."""
+    gather_msa_rows(protein)
     # Add a random amino acid uniformly.
-    random_aa = torch.tensor([0.05] * 20 + [0.0, 0.0], dtype=torch.float32)
+    random_aa = torch.tensor(
+        [0.05] * 20 + [0.0, 0.0], dtype=torch.float32, device=protein["msa"].device
+    )
 
     categorical_probs = (
         config.uniform_prob * random_aa
@@ -581,7 +807,9 @@ def make_masked_msa(
         categorical_probs, pad_shapes, value=mask_prob
     )
     sh = protein["msa"].shape
-    mask_position = torch.from_numpy(np.random.rand(*sh) < replace_fraction)
+    mask_position = torch.as_tensor(
+        np_random().rand(*sh) < replace_fraction, device=protein["msa"].device
+    )
     mask_position &= protein["msa_mask"].bool()
 
     if "bert_mask" in protein:
@@ -594,8 +822,8 @@ def make_masked_msa(
         bert_msa = gumbel_max_sample(logits)
     else:
         bert_msa = shaped_categorical(categorical_probs)
-    bert_msa = torch.where(mask_position, bert_msa, protein["msa"])
-    bert_msa *= protein["msa_mask"].long()
+    bert_msa = torch.where(mask_position, bert_msa.to(protein["msa"].dtype), protein["msa"])
+    bert_msa *= protein["msa_mask"].to(bert_msa.dtype)
 
     # Mix real and masked MSA
     protein["bert_mask"] = mask_position.to(torch.float32)
@@ -637,6 +865,9 @@ def make_fixed_size(
         N_EXTRA_MSA: extra_msa_size,
         N_TPL: num_templates,
     }
+    if "xl_idx" in protein:
+        # padded links point at (0, 0) with a zero value, which embeds as no link.
+        pad_size_map[N_XL] = get_pad_size(protein["xl_idx"].shape[0], 8)
 
     for k, v in protein.items():
         # Don't transfer this to the accelerator.
@@ -684,6 +915,8 @@ def make_target_feat(protein):
 
 def make_msa_feat(protein):
     """Create and concatenate MSA features."""
+    gather_msa_rows(protein)
+    widen_msa_features(protein)
     msa_1hot = one_hot(protein["msa"], 23)
     has_deletion = torch.clip(protein["deletion_matrix"], 0.0, 1.0)
     deletion_value = torch.atan(protein["deletion_matrix"] / 3.0) * (2.0 / np.pi)
@@ -703,20 +936,14 @@ def make_msa_feat(protein):
             ]
         )
 
-    if "extra_deletion_matrix" in protein:
-        protein["extra_msa_has_deletion"] = torch.clip(
-            protein["extra_deletion_matrix"], 0.0, 1.0
-        )
-        protein["extra_msa_deletion_value"] = torch.atan(
-            protein["extra_deletion_matrix"] / 3.0
-        ) * (2.0 / np.pi)
-
     protein["msa_feat"] = torch.cat(msa_feat, dim=-1)
     return protein
 
 
 def make_msa_feat_v2(batch):
     """Create and concatenate MSA features."""
+    gather_msa_rows(batch)
+    widen_msa_features(batch)
     msa_1hot = one_hot(batch["msa"], 23)
     deletion_matrix = batch["deletion_matrix"]
     has_deletion = torch.clip(deletion_matrix, 0.0, 1.0)[..., None]
@@ -740,13 +967,18 @@ def make_msa_feat_v2(batch):
 @curry1
 def make_extra_msa_feat(batch, num_extra_msa):
     # 23 = 20 amino acids + 'X' for unknown + gap + bert mask
-    extra_msa = batch["extra_msa"][:num_extra_msa]
-    deletion_matrix = batch["extra_deletion_matrix"][:num_extra_msa]
+    # only the kept rows are gathered.
+    num_sel = min(num_extra_msa, num_msa_rows(batch, prefix="extra_"))
+    select_msa_rows(
+        batch,
+        torch.arange(num_sel, device=batch["extra_msa"].device),
+        prefix="extra_",
+    )
+    gather_msa_rows(batch, prefix="extra_")
+    widen_msa_features(batch, prefix="extra_")
+    deletion_matrix = batch["extra_deletion_matrix"]
     has_deletion = torch.clip(deletion_matrix, 0.0, 1.0)
     deletion_value = torch.atan(deletion_matrix / 3.0) * (2.0 / np.pi)
-    extra_msa_mask = batch["extra_msa_mask"][:num_extra_msa]
-    batch["extra_msa"] = extra_msa
-    batch["extra_msa_mask"] = extra_msa_mask
     batch["extra_msa_has_deletion"] = has_deletion
     batch["extra_msa_deletion_value"] = deletion_value
     return batch
@@ -863,6 +1095,14 @@ def make_atom14_positions(protein):
     return protein
 
 
+def cast_label_dtypes(protein):
+    """The casts of `make_atom14_positions`, for labels with precomputed transforms."""
+    protein["aatype"] = protein["aatype"].long()
+    protein["all_atom_mask"] = protein["all_atom_mask"].float()
+    protein["all_atom_positions"] = protein["all_atom_positions"].float()
+    return protein
+
+
 def atom37_to_frames(protein, eps=1e-8):
     # TODO: extract common part and put them into residue constants.
     aatype = protein["aatype"]
@@ -1143,8 +1383,14 @@ def atom37_to_torsion_angles(
         # consistent to uni-fold. use [1, 0] placeholder
         placeholder_torsions = torch.stack(
             [
-                torch.ones(torsion_angles_sin_cos.shape[:-1]),
-                torch.zeros(torsion_angles_sin_cos.shape[:-1]),
+                torch.ones(
+                    torsion_angles_sin_cos.shape[:-1],
+                    device=torsion_angles_sin_cos.device,
+                ),
+                torch.zeros(
+                    torsion_angles_sin_cos.shape[:-1],
+                    device=torsion_angles_sin_cos.device,
+                ),
             ],
             dim=-1,
         )
@@ -1194,15 +1440,18 @@ def crop_templates(
     if num_templates > 0:
         if subsample_templates:
             # af2's sampling, min(4, uniform[0, n])
-            max_templates = min(max_templates, np.random.randint(0, num_templates + 1))
+            max_templates = min(max_templates, np_random().randint(0, num_templates + 1))
             template_idx = torch.tensor(
-                np.random.choice(num_templates, max_templates, replace=False),
+                np_random().choice(num_templates, max_templates, replace=False),
                 dtype=torch.int64,
+                device=protein["template_mask"].device,
             )
         else:
             # use top templates
             template_idx = torch.arange(
-                min(num_templates, max_templates), dtype=torch.int64
+                min(num_templates, max_templates),
+                dtype=torch.int64,
+                device=protein["template_mask"].device,
             )
         for k, v in protein.items():
             if k.startswith("template"):
@@ -1240,8 +1489,8 @@ def crop_to_size_multimer(
     protein, crop_size, shape_schema, seed, spatial_crop_prob, ca_ca_threshold
 ):
     """crop to size."""
-    with data_utils.numpy_seed(seed, key="multimer_crop"):
-        use_spatial_crop = np.random.rand() < spatial_crop_prob
+    with numpy_seed(seed, key="multimer_crop"):
+        use_spatial_crop = np_random().rand() < spatial_crop_prob
     is_distillation = "is_distillation" in protein and protein["is_distillation"] == 1
     if is_distillation:
         return crop_to_size_single(
@@ -1260,8 +1509,8 @@ def get_single_crop_idx(
 
     if num_res < crop_size:
         return torch.arange(num_res)
-    with data_utils.numpy_seed(random_seed):
-        crop_start = int(np.random.randint(0, num_res - crop_size + 1))
+    with numpy_seed(random_seed):
+        crop_start = int(np_random().randint(0, num_res - crop_size + 1))
         return torch.arange(crop_start, crop_start + crop_size)
 
 
@@ -1273,10 +1522,10 @@ def get_crop_sizes_each_chain(
 ) -> torch.Tensor:
     """get crop sizes for contiguous crop"""
     if not use_multinomial:
-        with data_utils.numpy_seed(random_seed, key="multimer_contiguous_perm"):
-            shuffle_idx = np.random.permutation(len(asym_len))
+        with numpy_seed(random_seed, key="multimer_contiguous_perm"):
+            shuffle_idx = np_random().permutation(len(asym_len))
         num_left = asym_len.sum()
-        num_budget = torch.tensor(crop_size)
+        num_budget = torch.tensor(crop_size, device=asym_len.device)
         crop_sizes = [0 for _ in asym_len]
         for j, idx in enumerate(shuffle_idx):
             this_len = asym_len[idx]
@@ -1285,20 +1534,21 @@ def get_crop_sizes_each_chain(
             max_size = min(num_budget, this_len)
             # num res at least we shall keep in this ent
             min_size = min(this_len, max(0, num_budget - num_left))
-            with data_utils.numpy_seed(
+            with numpy_seed(
                 random_seed, j, key="multimer_contiguous_crop_size"
             ):
                 this_crop_size = int(
-                    np.random.randint(low=int(min_size), high=int(max_size) + 1)
+                    np_random().randint(low=int(min_size), high=int(max_size) + 1)
                 )
             num_budget -= this_crop_size
             crop_sizes[idx] = this_crop_size
-        crop_sizes = torch.tensor(crop_sizes)
+        crop_sizes = torch.tensor(crop_sizes, device=asym_len.device)
     else:  # use multinomial
         # TODO: better multimer
         entity_probs = asym_len / torch.sum(asym_len)
-        crop_sizes = torch.from_numpy(
-            np.random.multinomial(crop_size, pvals=entity_probs)
+        crop_sizes = torch.as_tensor(
+            np_random().multinomial(crop_size, pvals=entity_probs.cpu()),
+            device=asym_len.device,
         )
         crop_sizes = torch.min(crop_sizes, asym_len)
     return crop_sizes
@@ -1322,12 +1572,16 @@ def get_contiguous_crop_idx(
         asym_len, crop_size, random_seed, use_multinomial
     )
     crop_idxs = []
-    asym_offset = torch.tensor(0, dtype=torch.int64)
-    with data_utils.numpy_seed(random_seed, key="multimer_contiguous_crop_start_idx"):
+    asym_offset = torch.tensor(0, dtype=torch.int64, device=asym_len.device)
+    with numpy_seed(random_seed, key="multimer_contiguous_crop_start_idx"):
         for l, csz in zip(asym_len, crop_sizes):
-            this_start = np.random.randint(0, int(l - csz) + 1)
+            this_start = np_random().randint(0, int(l - csz) + 1)
             crop_idxs.append(
-                torch.arange(asym_offset + this_start, asym_offset + this_start + csz)
+                torch.arange(
+                    asym_offset + this_start,
+                    asym_offset + this_start + csz,
+                    device=asym_len.device,
+                )
             )
             asym_offset += l
 
@@ -1349,11 +1603,8 @@ def get_spatial_crop_idx(
     if (ca_mask.sum(dim=-1) <= 1).all():
         return get_contiguous_crop_idx(protein, crop_size, random_seed)
 
-    pair_mask = ca_mask[..., None] * ca_mask[..., None, :]
-    ca_distances = get_pairwise_distances(ca_coords)
-
-    interface_candidates = get_interface_candidates(
-        ca_distances, protein["asym_id"], pair_mask, ca_ca_threshold
+    interface_candidates = get_interface_candidates_sparse(
+        ca_coords, protein["asym_id"], ca_mask, ca_ca_threshold
     )
 
     #interface_candidates = get_xl_interface_candidates(
@@ -1362,12 +1613,12 @@ def get_spatial_crop_idx(
 
 
     if torch.any(interface_candidates):
-        with data_utils.numpy_seed(random_seed, key="multimer_spatial_crop"):
-            target_res = int(np.random.choice(interface_candidates))
+        with numpy_seed(random_seed, key="multimer_spatial_crop"):
+            target_res = int(np_random().choice(interface_candidates.cpu()))
     else:
         return get_contiguous_crop_idx(protein, crop_size, random_seed)
 
-    to_target_distances = ca_distances[target_res]
+    to_target_distances = get_distances_to(ca_coords, target_res)
     # set inf to non-position residues
     to_target_distances[~ca_mask] = inf
     break_tie = (
@@ -1386,6 +1637,40 @@ def get_pairwise_distances(coords: torch.Tensor) -> torch.Tensor:
     return torch.sqrt(torch.sum(coord_diff**2, dim=-1))
 
 
+def get_distances_to(coords: torch.Tensor, target: int) -> torch.Tensor:
+    """Row `target` of `get_pairwise_distances(coords)`, computed alone."""
+    coord_diff = coords[target].unsqueeze(-2) - coords
+    return torch.sqrt(torch.sum(coord_diff**2, dim=-1))
+
+
+def get_interface_candidates_sparse(
+    ca_coords: torch.Tensor,
+    asym_id: torch.Tensor,
+    ca_mask: torch.Tensor,
+    ca_ca_threshold,
+) -> torch.Tensor:
+    """`get_interface_candidates` without the dense (num_res, num_res) tensors.
+
+    The residue pairs within the threshold are found with a KD-tree, with a
+    small margin, and their distances are then computed and compared like
+    those of `get_pairwise_distances`, so the candidates are the same.
+    """
+    device = ca_coords.device
+    present = torch.nonzero(ca_mask, as_tuple=True)[0]
+    tree = cKDTree(ca_coords[present].cpu().double().numpy())
+    pairs = tree.query_pairs(ca_ca_threshold * (1 + 1e-4) + 1e-4, output_type="ndarray")
+    pairs = present[torch.as_tensor(pairs, dtype=torch.long, device=device)]
+    first, second = pairs.unbind(dim=-1)
+    coord_diff = ca_coords[first] - ca_coords[second]
+    distances = torch.sqrt(torch.sum(coord_diff**2, dim=-1))
+    is_interface = (
+        (asym_id[first] != asym_id[second])
+        & (distances > 0)
+        & (distances < ca_ca_threshold)
+    )
+    return torch.unique(torch.cat([first[is_interface], second[is_interface]]))
+
+
 def get_interface_candidates(
     ca_distances: torch.Tensor,
     asym_id: torch.Tensor,
@@ -1428,6 +1713,23 @@ def apply_crop_idx(protein, shape_schema, crop_idx):
             continue
         for i, dim_size in enumerate(shape_schema[k]):
             if dim_size == N_RES:
-                v = torch.index_select(v, i, crop_idx)
+                v = torch.index_select(v, i, crop_idx.to(v.device))
         cropped_protein[k] = v
+    if "xl_idx" in cropped_protein:
+        cropped_protein["xl_idx"], cropped_protein["xl_value"] = crop_xl_idx(
+            protein["xl_idx"], protein["xl_value"], crop_idx.to(protein["xl_idx"].device)
+        )
     return cropped_protein
+
+
+def crop_xl_idx(xl_idx, xl_value, crop_idx):
+    """Keep the COO crosslinks with both residues in `crop_idx`, renumbered to the crop."""
+    if xl_idx.shape[0] == 0:
+        return xl_idx, xl_value
+    xl_idx = xl_idx.long()
+    size = int(max(xl_idx.max(), crop_idx.max())) + 1
+    new_pos = torch.full((size,), -1, dtype=torch.long, device=xl_idx.device)
+    new_pos[crop_idx] = torch.arange(len(crop_idx), device=xl_idx.device)
+    xl_idx = new_pos[xl_idx]
+    keep = (xl_idx >= 0).all(dim=-1)
+    return xl_idx[keep], xl_value[keep]
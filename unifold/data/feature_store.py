@@ -0,0 +1,223 @@
+"""Packed, memory-mapped storage for per-chain feature dicts.
+
+A store is a directory holding ``store.json`` and a number of shard files.
+Every entry (e.g. a sequence id) is assigned to a shard by a stable hash of
+its name. A shard file is laid out as
+
+    magic | aligned raw arrays ... | json index | index offset (uint64)
+
+and the json index maps ``entry -> key -> (dtype, shape, offset)``. Arrays are
+returned as read-only views into an ``np.memmap`` of the shard, so only the
+pages of the keys (and rows) that are actually touched are read from disk.
+"""
+
+import json
+import os
+import struct
+import zlib
+from typing import *
+
+import numpy as np
+
+from .data_ops import NumpyDict
+
+
+STORE_SUFFIX = ".store"
+STORE_META = "store.json"
+SHARD_MAGIC = b"UFSTORE1"
+ALIGNMENT = 64
+NESTED_SEP = "/"
+
+# keys stored densely in a narrow dtype, and widened back on load.
+NARROW_KEYS = {"deletion_matrix": np.float32, "deletion_matrix_all_seq": np.float32}
+
+
+def shard_name(shard_idx: int) -> str:
+    return f"shard_{shard_idx:05d}.ufs"
+
+
+def get_shard_idx(entry_id: str, num_shards: int) -> int:
+    return zlib.crc32(entry_id.encode("utf-8")) % num_shards
+
+
+def is_store(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, STORE_META))
+
+
+def _narrow_int_dtype(v: np.ndarray):
+    if v.size == 0:
+        return np.uint8
+    if not np.all(np.mod(v, 1) == 0):
+        return None
+    vmin, vmax = v.min(), v.max()
+    for dtype in (np.uint8, np.int16, np.int32):
+        info = np.iinfo(dtype)
+        if info.min <= vmin and vmax <= info.max:
+            return dtype
+    return None
+
+
+def _flatten(feature: Dict[str, Any], prefix: str = "") -> Dict[str, Any]:
+    flat = {}
+    for k, v in feature.items():
+        if isinstance(v, dict):
+            flat.update(_flatten(v, prefix + k + NESTED_SEP))
+        else:
+            flat[prefix + k] = v
+    return flat
+
+
+def _unflatten(flat: Dict[str, Any]) -> Dict[str, Any]:
+    feature = {}
+    for k, v in flat.items():
+        *parents, leaf = k.split(NESTED_SEP)
+        cur = feature
+        for p in parents:
+            cur = cur.setdefault(p, {})
+        cur[leaf] = v
+    return feature
+
+
+def _encode_array(
+    key: str, value: Any, narrow: bool = True
+) -> Tuple[np.ndarray, Dict[str, Any]]:
+    meta = {}
+    if key.endswith(NESTED_SEP + "shape") and isinstance(value, tuple):
+        meta["as_tuple"] = True
+    v = np.asarray(value)
+    if v.dtype == np.object_:
+        # variable length bytes, e.g. `sequence` and `msa_species_identifiers`.
+        meta["as_object"] = True
+        v = v.astype(np.bytes_)
+    if narrow and key in NARROW_KEYS:
+        narrow_dtype = _narrow_int_dtype(v)
+        if narrow_dtype is not None:
+            meta["load_dtype"] = np.dtype(NARROW_KEYS[key]).str
+            v = v.astype(narrow_dtype)
+    v = np.ascontiguousarray(v)
+    meta["dtype"] = v.dtype.str
+    meta["shape"] = list(v.shape)
+    return v, meta
+
+
+def write_shard(
+    path: str, entries: Iterable[Tuple[str, Dict[str, Any]]], narrow: bool = True
+) -> int:
+    """Write `(entry_id, feature)` pairs into a single shard file.
+
+    With `narrow=False` arrays keep their dtype, so that loading them never copies.
+    """
+    index = {}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(SHARD_MAGIC)
+        for entry_id, feature in entries:
+            entry_index = {}
+            for k, v in _flatten(feature).items():
+                v, meta = _encode_array(k, v, narrow)
+                pad = (-f.tell()) % ALIGNMENT
+                f.write(b"\0" * pad)
+                meta["offset"] = f.tell()
+                f.write(v.tobytes())
+                entry_index[k] = meta
+            index[entry_id] = entry_index
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode("utf-8"))
+        f.write(struct.pack("<Q", index_offset))
+    os.replace(tmp_path, path)
+    return len(index)
+
+
+def write_meta(store_dir: str, num_shards: int, **kwargs) -> None:
+    meta = {"num_shards": num_shards, **kwargs}
+    with open(os.path.join(store_dir, STORE_META), "w") as f:
+        json.dump(meta, f, indent=4)
+
+
+class FeatureShard:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            assert f.read(len(SHARD_MAGIC)) == SHARD_MAGIC, f"bad shard file {path}."
+            f.seek(-8, os.SEEK_END)
+            index_end = f.tell()
+            (index_offset,) = struct.unpack("<Q", f.read(8))
+            f.seek(index_offset)
+            self.index = json.loads(f.read(index_end - index_offset))
+        self._mmap = None
+
+    @property
+    def mmap(self) -> np.memmap:
+        # opened lazily so that the handle is created inside each worker.
+        if self._mmap is None:
+            self._mmap = np.memmap(self.path, dtype=np.uint8, mode="r")
+        return self._mmap
+
+    def __contains__(self, entry_id: str) -> bool:
+        return entry_id in self.index
+
+    def get_array(self, meta: Dict[str, Any]) -> np.ndarray:
+        return np.ndarray(
+            tuple(meta["shape"]),
+            dtype=np.dtype(meta["dtype"]),
+            buffer=self.mmap,
+            offset=meta["offset"],
+        )
+
+    def load(
+        self, entry_id: str, keys: Optional[Iterable[str]] = None, widen: bool = True
+    ) -> NumpyDict:
+        entry_index = self.index[entry_id]
+        if keys is not None:
+            keys = set(keys)
+        flat = {}
+        for k, meta in entry_index.items():
+            if keys is not None and k.split(NESTED_SEP)[0] not in keys:
+                continue
+            v = self.get_array(meta)
+            if widen and "load_dtype" in meta:
+                v = v.astype(meta["load_dtype"])
+            if meta.get("as_object", False):
+                v = v.astype(np.object_)
+            if meta.get("as_tuple", False):
+                v = tuple(int(x) for x in v)
+            flat[k] = v
+        return _unflatten(flat)
+
+
+class FeatureStore:
+    """Read access to a packed feature store directory."""
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, STORE_META), "r") as f:
+            self.meta = json.load(f)
+        self.num_shards = self.meta["num_shards"]
+        self._shards = {}
+
+    def get_shard(self, entry_id: str) -> FeatureShard:
+        shard_idx = get_shard_idx(entry_id, self.num_shards)
+        if shard_idx not in self._shards:
+            self._shards[shard_idx] = FeatureShard(
+                os.path.join(self.store_dir, shard_name(shard_idx))
+            )
+        return self._shards[shard_idx]
+
+    def __contains__(self, entry_id: str) -> bool:
+        return entry_id in self.get_shard(entry_id)
+
+    def load(
+        self, entry_id: str, keys: Optional[Iterable[str]] = None, widen: bool = True
+    ) -> NumpyDict:
+        shard = self.get_shard(entry_id)
+        assert entry_id in shard, f"cannot find {entry_id} in {self.store_dir}."
+        return shard.load(entry_id, keys, widen)
+
+
+_open_stores: Dict[str, FeatureStore] = {}
+
+
+def open_store(store_dir: str) -> FeatureStore:
+    if store_dir not in _open_stores:
+        _open_stores[store_dir] = FeatureStore(store_dir)
+    return _open_stores[store_dir]
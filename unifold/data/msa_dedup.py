@@ -0,0 +1,31 @@
+"""Vectorized lookups of duplicated MSA rows.
+
+Rows are compared through a void view of their bytes, so that `np.unique`
+and `np.isin` sort and match whole rows at once instead of hashing a Python
+object per row.
+"""
+
+import numpy as np
+
+
+def _row_keys(rows: np.ndarray, dtype) -> np.ndarray:
+    rows = np.ascontiguousarray(rows, dtype=dtype)
+    rows = rows.reshape(rows.shape[0], -1)
+    row_dtype = np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))
+    return rows.view(row_dtype).reshape(-1)
+
+
+def isin_rows(rows: np.ndarray, reference: np.ndarray) -> np.ndarray:
+    """Boolean mask of the rows of `rows` that are equal to a row of `reference`."""
+    if len(rows) == 0 or len(reference) == 0 or rows[0].size == 0:
+        return np.zeros(len(rows), dtype=bool)
+    dtype = np.result_type(rows, reference)
+    return np.isin(_row_keys(rows, dtype), _row_keys(reference, dtype))
+
+
+def first_unique_rows(rows: np.ndarray) -> np.ndarray:
+    """Indices of the first occurrence of every distinct row, in increasing order."""
+    if len(rows) == 0 or rows[0].size == 0:
+        return np.arange(min(len(rows), 1))
+    _, first = np.unique(_row_keys(rows, rows.dtype), return_index=True)
+    return np.sort(first)
@@ -19,8 +19,8 @@ from typing import Dict, Iterable, List, Sequence
 
 from .residue_constants import restypes_with_x_and_gap
 from .data_ops import NumpyDict
+from .msa_dedup import isin_rows
 import numpy as np
-import pandas as pd
 import scipy.linalg
 
 
@@ -134,131 +134,123 @@ def pad_features(feature: np.ndarray, feature_name: str) -> np.ndarray:
     return feats_padded
 
 
-def _make_msa_df(chain_features: NumpyDict) -> pd.DataFrame:
-    """Makes dataframe with msa features needed for msa pairing."""
+def _legacy_similarity_order(similarity: np.ndarray) -> np.ndarray:
+    """The order of `DataFrame.sort_values(ascending=False)` on `similarity`.
+
+    That sort is not stable, so the order of tied rows depends on the
+    quicksort of numpy, which is reproduced here.
+    """
+    idx = np.arange(len(similarity))[::-1]
+    return idx[np.argsort(similarity[::-1], kind="quicksort")][::-1]
+
+
+def _species_segments(chain_features: NumpyDict) -> Dict[str, np.ndarray]:
+    """Groups the MSA rows of a chain by species.
+
+    The rows of each species are a contiguous segment of `order`, sorted by
+    decreasing similarity to the query sequence.
+    """
     chain_msa = chain_features["msa_all_seq"]
     query_seq = chain_msa[0]
-    per_seq_similarity = np.sum(query_seq[None] == chain_msa, axis=-1) / float(
+    similarity = np.sum(query_seq[None] == chain_msa, axis=-1) / float(
         len(query_seq)
     )
-    per_seq_gap = np.sum(chain_msa == 21, axis=-1) / float(len(query_seq))
-    msa_df = pd.DataFrame(
-        {
-            "msa_species_identifiers": chain_features[
-                "msa_species_identifiers_all_seq"
-            ],
-            "msa_row": np.arange(
-                len(chain_features["msa_species_identifiers_all_seq"])
-            ),
-            "msa_similarity": per_seq_similarity,
-            "gap": per_seq_gap,
-        }
+    species, code = np.unique(
+        np.asarray(chain_features["msa_species_identifiers_all_seq"]),
+        return_inverse=True,
     )
-    return msa_df
-
-
-def _create_species_dict(msa_df: pd.DataFrame) -> Dict[bytes, pd.DataFrame]:
-    """Creates mapping from species to msa dataframe of that species."""
-    species_lookup = {}
-    for species, species_df in msa_df.groupby("msa_species_identifiers"):
-        species_lookup[species] = species_df
-    return species_lookup
+    code = code.reshape(-1)
+    order = np.lexsort((-similarity, code))
+    counts = np.bincount(code, minlength=len(species))
+    starts = np.cumsum(counts) - counts
+    sorted_code = code[order]
+    tied = (sorted_code[1:] == sorted_code[:-1]) & (
+        similarity[order][1:] == similarity[order][:-1]
+    )
+    has_ties = np.zeros(len(species), dtype=bool)
+    has_ties[sorted_code[1:][tied]] = True
+    return {
+        "species": species,
+        "code": code,
+        "similarity": similarity,
+        "order": order,
+        "starts": starts,
+        "counts": counts,
+        "has_ties": has_ties,
+    }
 
 
-def _match_rows_by_sequence_similarity(
-    this_species_msa_dfs: List[pd.DataFrame],
-) -> List[List[int]]:
-    """Finds MSA sequence pairings across chains based on sequence similarity.
+def _reorder_tied_segments(segments: Dict[str, np.ndarray], species: np.ndarray):
+    # rows within a species segment in their original order, as grouped by pandas.
+    grouped = np.argsort(segments["code"], kind="stable")
+    for s in species:
+        seg = slice(segments["starts"][s], segments["starts"][s] + segments["counts"][s])
+        rows = grouped[seg]
+        segments["order"][seg] = rows[
+            _legacy_similarity_order(segments["similarity"][rows])
+        ]
 
-    Each chain's MSA sequences are first sorted by their sequence similarity to
-    their respective target sequence. The sequences are then paired, starting
-    from the sequences most similar to their target sequence.
 
-    Args:
-        this_species_msa_dfs: a list of dataframes containing MSA features for
-            sequences for a specific species.
+def pair_sequences(examples: List[NumpyDict]) -> Dict[int, np.ndarray]:
+    """Returns indices for paired MSA sequences across chains.
 
-    Returns:
-     A list of lists, each containing M indices corresponding to paired MSA rows,
-     where M is the number of chains.
+    Within each species present in at least two chains (and with at most
+    600 rows in each), the rows of the chains are paired in decreasing order of
+    their similarity to the query sequence. Chains without that species take the
+    padding row (-1).
     """
-    all_paired_msa_rows = []
 
-    num_seqs = [
-        len(species_df) for species_df in this_species_msa_dfs if species_df is not None
-    ]
-    take_num_seqs = np.min(num_seqs)
+    num_examples = len(examples)
 
-    sort_by_similarity = lambda x: x.sort_values(
-        "msa_similarity", axis=0, ascending=False
+    all_segments = [_species_segments(chain_features) for chain_features in examples]
+    common_species = np.unique(np.concatenate([s["species"] for s in all_segments]))
+
+    # per chain and species of `common_species`, the segment of the species.
+    counts = np.zeros((num_examples, len(common_species)), dtype=np.int64)
+    starts = np.zeros((num_examples, len(common_species)), dtype=np.int64)
+    has_ties = np.zeros((num_examples, len(common_species)), dtype=bool)
+    local_species = []
+    for i, segments in enumerate(all_segments):
+        local = np.searchsorted(common_species, segments["species"])
+        counts[i, local] = segments["counts"]
+        starts[i, local] = segments["starts"]
+        has_ties[i, local] = segments["has_ties"]
+        local_species.append(local)
+
+    present = counts > 0
+    num_present = present.sum(0)
+    # Skip the target sequence species, species present in only one chain and
+    # species with too many sequences.
+    paired = (
+        np.array([len(species) > 0 for species in common_species], dtype=bool)
+        & (num_present > 1)
+        & ~np.any(counts > 600, axis=0)
     )
 
-    for species_df in this_species_msa_dfs:
-        if species_df is not None:
-            species_df_sorted = sort_by_similarity(species_df)
-            msa_rows = species_df_sorted.msa_row.iloc[:take_num_seqs].values
-        else:
-            msa_rows = [-1] * take_num_seqs  # take the last 'padding' row
-        all_paired_msa_rows.append(msa_rows)
-    all_paired_msa_rows = list(np.array(all_paired_msa_rows).transpose())
-    return all_paired_msa_rows
-
-
-def pair_sequences(examples: List[NumpyDict]) -> Dict[int, np.ndarray]:
-    """Returns indices for paired MSA sequences across chains."""
-
-    num_examples = len(examples)
-
-    all_chain_species_dict = []
-    common_species = set()
-    for chain_features in examples:
-        msa_df = _make_msa_df(chain_features)
-        species_dict = _create_species_dict(msa_df)
-        all_chain_species_dict.append(species_dict)
-        common_species.update(set(species_dict))
-
-    common_species = sorted(common_species)
-    common_species.remove(b"")  # Remove target sequence species.
-
-    all_paired_msa_rows = [np.zeros(len(examples), int)]
-    all_paired_msa_rows_dict = {k: [] for k in range(num_examples)}
-    all_paired_msa_rows_dict[num_examples] = [np.zeros(len(examples), int)]
-
-    for species in common_species:
-        if not species:
-            continue
-        this_species_msa_dfs = []
-        species_dfs_present = 0
-        for species_dict in all_chain_species_dict:
-            if species in species_dict:
-                this_species_msa_dfs.append(species_dict[species])
-                species_dfs_present += 1
-            else:
-                this_species_msa_dfs.append(None)
-
-        # Skip species that are present in only one chain.
-        if species_dfs_present <= 1:
-            continue
-
-        if np.any(
-            np.array(
-                [
-                    len(species_df)
-                    for species_df in this_species_msa_dfs
-                    if isinstance(species_df, pd.DataFrame)
-                ]
-            )
-            > 600
-        ):
-            continue
-
-        paired_msa_rows = _match_rows_by_sequence_similarity(this_species_msa_dfs)
-        all_paired_msa_rows.extend(paired_msa_rows)
-        all_paired_msa_rows_dict[species_dfs_present].extend(paired_msa_rows)
-    all_paired_msa_rows_dict = {
-        num_examples: np.array(paired_msa_rows)
-        for num_examples, paired_msa_rows in all_paired_msa_rows_dict.items()
-    }
+    for i, segments in enumerate(all_segments):
+        reorder = paired & present[i] & has_ties[i]
+        if np.any(reorder):
+            global_to_local = np.full(len(common_species), -1)
+            global_to_local[local_species[i]] = np.arange(len(local_species[i]))
+            _reorder_tied_segments(segments, global_to_local[reorder])
+
+    # each species yields as many paired rows as its smallest segment.
+    paired_species = np.nonzero(paired)[0]
+    take = np.where(present, counts, np.iinfo(np.int64).max).min(0)[paired_species]
+    row_species = np.repeat(paired_species, take)
+    row_offset = np.arange(len(row_species)) - np.repeat(np.cumsum(take) - take, take)
+    paired_msa_rows = np.full((len(row_species), num_examples), -1, dtype=np.int64)
+    for i, segments in enumerate(all_segments):
+        has_rows = present[i, row_species]
+        position = starts[i, row_species[has_rows]] + row_offset[has_rows]
+        paired_msa_rows[has_rows, i] = segments["order"][position]
+
+    all_paired_msa_rows_dict = {}
+    for k in range(num_examples + 1):
+        rows = list(paired_msa_rows[num_present[row_species] == k])
+        if k == num_examples:
+            rows = [np.zeros(num_examples, int)] + rows
+        all_paired_msa_rows_dict[k] = np.array(rows)
     return all_paired_msa_rows_dict
 
 
@@ -503,17 +495,13 @@ def deduplicate_unpaired_sequences(np_chains: List[NumpyDict]) -> List[NumpyDict
     for chain in np_chains:
         entity_id = int(chain["entity_id"][0])
         if entity_id not in cache_msa_features:
-            sequence_set = set(s.tobytes() for s in chain["msa_all_seq"])
-            keep_rows = []
-            # Go through unpaired MSA seqs and remove any rows that correspond to the
-            # sequences that are already present in the paired MSA.
-            for row_num, seq in enumerate(chain["msa"]):
-                if seq.tobytes() not in sequence_set:
-                    keep_rows.append(row_num)
+            # Remove any unpaired MSA rows that correspond to the sequences that
+            # are already present in the paired MSA.
+            keep_rows = np.nonzero(~isin_rows(chain["msa"], chain["msa_all_seq"]))[0]
             new_msa_features = {}
             for feature_name in feature_names:
                 if feature_name in msa_features:
-                    if keep_rows:
+                    if len(keep_rows) > 0:
                         new_msa_features[feature_name] = chain[feature_name][keep_rows]
                     else:
                         new_shape = list(chain[feature_name].shape)
@@ -1,20 +1,89 @@
 import torch
 import numpy as np
 import math
-from scipy.spatial.distance import pdist, squareform
+from concurrent.futures import ThreadPoolExecutor
 
 # adapted from: https://github.com/sokrypton/GREMLIN_CPP
 
-def get_eff(msa, eff_cutoff=0.8): # eff_cutoff=0.62 for metapsicov
-    if msa.ndim == 3: msa = msa.argmax(-1)    
-    # pairwise identity  
-    msa_sm = 1.0 - squareform(pdist(msa,"hamming"))
+def _one_hot(msa, num_classes):
+    # (N, L) tokens -> (N, L * num_classes) uint8 indicators, whose inner
+    # products are exact counts of identical positions.
+    one_hot = np.zeros((msa.shape[0], msa.shape[1], num_classes), dtype=np.uint8)
+    np.put_along_axis(one_hot, msa[..., None].astype(np.int64), 1, axis=-1)
+    return one_hot.reshape(msa.shape[0], -1)
+
+
+def _count_neighbours(tiles, starts, i, num_seqs, num_res, eff_cutoff):
+    # neighbour counts of the pairs of tile `i` with the tiles j >= i, added to
+    # the rows of both tiles.
+    counts = np.zeros(num_seqs, dtype=np.int64)
+    query = tiles[i].astype(np.float32)
+    for j in range(i, len(tiles)):
+        # float32 for the BLAS matmul; the counts stay exact up to 2^24.
+        matches = (query @ tiles[j].T.astype(np.float32)).astype(np.int64)
+        # the same expression as `1.0 - pdist(msa, "hamming")`.
+        identity = 1.0 - (num_res - matches) / num_res
+        hits = identity >= eff_cutoff
+        counts[starts[i] : starts[i] + len(query)] += hits.sum(-1)
+        if j > i:
+            counts[starts[j] : starts[j] + len(tiles[j])] += hits.sum(0)
+    return counts
+
+
+def get_eff(msa, eff_cutoff=0.8, block_size=512, num_threads=1): # eff_cutoff=0.62 for metapsicov
+    """Sequence weights, the inverse number of rows within `eff_cutoff` identity.
+
+    Identities are counted from one-hot matmuls over the pairs of `block_size`
+    row tiles i <= j, so only the neighbour counts are kept instead of an
+    N x N matrix. The result is identical to thresholding
+    `1.0 - squareform(pdist(msa, "hamming"))`. `num_threads` > 1 spreads the
+    tiles over a thread pool; keep 1 in data loader workers.
+    """
+    if msa.ndim == 3: msa = msa.argmax(-1)
+    num_seqs, num_res = msa.shape
+    num_classes = int(msa.max()) + 1 if msa.size > 0 else 1
+    starts = list(range(0, num_seqs, block_size))
+    tiles = [_one_hot(msa[s : s + block_size], num_classes) for s in starts]
+    count_tile = lambda i: _count_neighbours(
+        tiles, starts, i, num_seqs, num_res, eff_cutoff
+    )
+    if num_threads > 1 and len(tiles) > 1:
+        with ThreadPoolExecutor(min(num_threads, len(tiles))) as pool:
+            counts = sum(pool.map(count_tile, range(len(tiles))))
+    else:
+        counts = sum(count_tile(i) for i in range(len(tiles)))
     # weight for each sequence
-    msa_w = (msa_sm >= eff_cutoff).astype(float)
-    msa_w = 1/np.sum(msa_w,-1)
+    msa_w = 1 / counts.astype(np.float64) if tiles else np.zeros(0)
 
     return msa_w
 
+
+class NeffTracker:
+    """Neff of a growing set of sequences, equal to `get_eff(np.array(seqs)).sum()`.
+
+    `add` compares the new sequence with the ones already in the set and
+    updates their neighbour counts, instead of recomputing all pairwise
+    identities, so growing the set to k sequences costs O(k^2 L), not O(k^3 L).
+    """
+
+    def __init__(self, capacity, num_res, eff_cutoff=0.8, dtype=np.int64):
+        self.seqs = np.empty((capacity, num_res), dtype=dtype)
+        self.counts = np.zeros(capacity, dtype=np.float64)
+        self.size = 0
+        self.eff_cutoff = eff_cutoff
+
+    def add(self, seq):
+        """Add `seq` to the set and return the new Neff."""
+        n = self.size
+        identity = 1.0 - (self.seqs[:n] != seq).sum(-1) / self.seqs.shape[1]
+        matches = identity >= self.eff_cutoff
+        self.counts[:n] += matches
+        self.counts[n] = matches.sum() + (1.0 >= self.eff_cutoff)
+        self.seqs[n] = seq
+        self.size = n + 1
+        return (1 / self.counts[:n + 1]).sum()
+
+
 def subsample_msa(msa, neff=10, eff_cutoff=0.8, cap_msa=True):
     if msa.shape[0] == 1:
         return msa
@@ -56,23 +125,17 @@ def subsample_msa_sequentially(msa, neff=10, eff_cutoff=0.8, cap_msa=True):
     idx = np.arange(msa.shape[0] - 1) + 1
     np.random.shuffle(idx)
 
-    new = [msa[0]]
+    if msa.ndim == 3: msa = msa.argmax(-1)
+    max_size = min(msa.shape[0], 254) if cap_msa else msa.shape[0]
+    tracker = NeffTracker(max_size, msa.shape[1], eff_cutoff=eff_cutoff, dtype=msa.dtype)
+    tracker.add(msa[0])
 
     for i in idx:
-        new.append(msa[i])
+        if len(indices) == max_size:
+            break
+        if tracker.add(msa[i]) > neff:
+            break
         indices.append(i)
-        neff_ = get_eff(np.array(new), eff_cutoff=eff_cutoff).sum()
-
-        if cap_msa:
-            if neff_ > neff or len(new) > 254:
-                new.pop()
-                indices.pop()
-               	break
-        else:
-            if neff_ > neff:
-               	new.pop()
-                indices.pop()
-               	break
 
     return np.array(indices)
 
@@ -81,29 +144,10 @@ def subsample_msa_sequentially(msa, neff=10, eff_cutoff=0.8, cap_msa=True):
 def subsample_msa_sequentially2(msa, neff=10, eff_cutoff=0.8, cap_msa=True):
     if msa.shape[0] == 1:
         return msa
-    
-    new = [msa[0]]
-    
-    msa = msa[1:]
-    
-    idx = np.arange(msa.shape[0])
-    np.random.shuffle(idx)
-    msa = msa[idx]
-    
-    for m in msa:
-        new.append(m)
-        neff_ = get_eff(np.array(new), eff_cutoff=eff_cutoff).sum()
-        
-        if cap_msa:
-            if neff_ > neff or len(new) > 254:
-                new.pop()
-                break
-        else:
-            if neff_ > neff:
-                new.pop()
-                break
-            
-    return np.array(new)
+
+    # the same shuffle and picks as `subsample_msa_sequentially`.
+    indices = subsample_msa_sequentially(msa, neff=neff, eff_cutoff=eff_cutoff, cap_msa=cap_msa)
+    return msa[indices]
 
 
 def subsample_msa_random(msa, neff=10, eff_cutoff=0.8):
@@ -0,0 +1,120 @@
+"""Overlap the I/O stage of upcoming samples with the processing of the current one.
+
+Each data loader worker owns a small thread pool that runs `load()` (reading
+and decompressing the feature pickles) for the indices the worker is going to
+be asked for next, while the calling thread runs the CPU transforms of the
+current sample. Only `load()` is run in the background: it does not touch the
+global numpy random state, which `sample_chain` and `process` rely on.
+"""
+
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import *
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def _get_worker_info() -> Tuple[int, int]:
+    info = torch.utils.data.get_worker_info()
+    if info is None:
+        return 0, 1
+    return info.id, info.num_workers
+
+
+class Prefetcher:
+    def __init__(self, depth: int, num_threads: int = 2, log_interval: int = 500):
+        self.depth = depth
+        self.num_threads = num_threads
+        self.log_interval = log_interval
+        self.plan = None
+        self.batch_size = 1
+        self._pid = None
+
+    def _init_process(self) -> None:
+        # thread pools do not survive fork, create one in each worker.
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._pool = ThreadPoolExecutor(max_workers=self.num_threads)
+        self._futures: "OrderedDict[int, Future]" = OrderedDict()
+        self._last_idx = None
+        self._stats = {"hit": 0, "wait": 0, "miss": 0, "wait_time": 0.0}
+
+    def set_plan(self, indices: Iterable[int], batch_size: int) -> None:
+        """Order in which indices are requested on this rank, see `UnifoldDataset.prefetch`."""
+        self.plan = list(indices)
+        self.plan_pos = {idx: pos for pos, idx in enumerate(self.plan)}
+        self.batch_size = batch_size
+
+    def upcoming(self, idx: int) -> List[int]:
+        """Indices this worker is expected to be asked for after `idx`."""
+        self._init_process()
+        if self.plan is not None and idx in self.plan_pos:
+            # the data loader hands batches to its workers round-robin.
+            _, num_workers = _get_worker_info()
+            batch = self.plan_pos[idx] // self.batch_size
+            ret = []
+            for k in range(1, self.depth + 1):
+                start = (batch + k * num_workers) * self.batch_size
+                ret.extend(self.plan[start : start + self.batch_size])
+            return ret
+        # no plan, guess from the stride between consecutive requests.
+        last_idx, self._last_idx = self._last_idx, idx
+        if last_idx is None or idx <= last_idx:
+            return []
+        stride = idx - last_idx
+        return [idx + k * stride for k in range(1, self.depth + 1)]
+
+    def submit(self, idx: int, fn: Callable[[], Any]) -> None:
+        self._init_process()
+        if idx in self._futures:
+            return
+        self._futures[idx] = self._pool.submit(fn)
+        # drop stale predictions, so that memory stays bounded.
+        while len(self._futures) > 4 * max(self.depth, 1):
+            _, future = self._futures.popitem(last=False)
+            future.cancel()
+
+    def get(self, idx: int, fn: Callable[[], Any]) -> Any:
+        self._init_process()
+        future = self._futures.pop(idx, None)
+        if future is None or future.cancelled():
+            self._stats["miss"] += 1
+            ret = fn()
+        elif future.done():
+            self._stats["hit"] += 1
+            ret = future.result()
+        else:
+            self._stats["wait"] += 1
+            t0 = time.perf_counter()
+            ret = future.result()
+            self._stats["wait_time"] += time.perf_counter() - t0
+        self._maybe_log()
+        return ret
+
+    def stats(self) -> Dict[str, float]:
+        self._init_process()
+        return dict(self._stats)
+
+    def _maybe_log(self) -> None:
+        s = self._stats
+        total = s["hit"] + s["wait"] + s["miss"]
+        if self.log_interval <= 0 or total % self.log_interval != 0:
+            return
+        worker_id, _ = _get_worker_info()
+        logger.info(
+            "prefetch worker {}: {} samples, {:.1%} ready, {:.1%} starved "
+            "(waited {:.1f}s in total), {:.1%} not prefetched".format(
+                worker_id,
+                total,
+                s["hit"] / total,
+                s["wait"] / total,
+                s["wait_time"],
+                s["miss"] / total,
+            )
+        )
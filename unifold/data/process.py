@@ -1,3 +1,6 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import torch
@@ -16,6 +19,7 @@ def nonensembled_fns(common_cfg, mode_cfg):
         [
             data_ops.cast_to_64bit_ints,
             data_ops.correct_msa_restypes,
+            data_ops.compact_msa_features,
             data_ops.squeeze_features,
             data_ops.randomly_replace_msa_with_unknown(0.0),
             data_ops.make_seq_mask,
@@ -157,12 +161,25 @@ def ensembled_fns(common_cfg, mode_cfg):
             operators.append(data_ops.crop_extra_msa(max_extra_msa))
     else:
         operators.append(data_ops.delete_extra_msa)
+    operators.append(data_ops.gather_all_msa_rows)
     # operators.append(data_operators.select_feat(common_cfg.recycling_features))
     return operators
 
 
-def process_features(tensors, common_cfg, mode_cfg):
-    """Based on the config, apply filters and transformations to the data."""
+def process_nonensembled(tensors, common_cfg, mode_cfg):
+    """The stage of `process_features` that is shared by all ensembles and recycles."""
+    is_distillation = bool(tensors.get("is_distillation", 0))
+    multimer_mode = common_cfg.is_multimer
+    nonensembled = nonensembled_fns(common_cfg, mode_cfg)
+
+    if mode_cfg.supervised and (not multimer_mode or is_distillation):
+        nonensembled.extend(label_transform_fn(has_label_transforms(tensors)))
+
+    return compose(nonensembled)(tensors)
+
+
+def process_ensembled(tensors, common_cfg, mode_cfg):
+    """The stage of `process_features` that samples each ensemble and recycle, then crops."""
     is_distillation = bool(tensors.get("is_distillation", 0))
     multimer_mode = common_cfg.is_multimer
     crop_and_fix_size_seed = int(tensors["crop_and_fix_size_seed"])
@@ -188,19 +205,13 @@ def process_features(tensors, common_cfg, mode_cfg):
             d = data_ops.select_feat(common_cfg.recycling_features)(d)
             return d
 
-    nonensembled = nonensembled_fns(common_cfg, mode_cfg)
-
-    if mode_cfg.supervised and (not multimer_mode or is_distillation):
-        nonensembled.extend(label_transform_fn())
-
-    tensors = compose(nonensembled)(tensors)
-
     num_recycling = int(tensors["num_recycling_iters"]) + 1
     num_ensembles = mode_cfg.num_ensembles
 
     ensemble_tensors = map_fn(
         lambda x: wrap_ensemble_fn(tensors, x),
         torch.arange(num_recycling * num_ensembles),
+        num_workers=mode_cfg.get("ensemble_workers", 0),
     )
     tensors = compose(crop_fn)(tensors)
     # add a dummy dim to align with recycling features
@@ -209,6 +220,80 @@ def process_features(tensors, common_cfg, mode_cfg):
     return tensors
 
 
+def process_features(tensors, common_cfg, mode_cfg, nonensembled_cache=None, cache_key=None):
+    """Based on the config, apply filters and transformations to the data.
+
+    With a `NonensembledCache` and a `cache_key` naming the target, the
+    non-ensembled stage is reused from earlier calls with other seeds.
+    """
+    if nonensembled_cache is None or cache_key is None:
+        tensors = process_nonensembled(tensors, common_cfg, mode_cfg)
+    else:
+        tensors = nonensembled_cache.get_or_process(
+            cache_key, tensors, common_cfg, mode_cfg
+        )
+    return process_ensembled(tensors, common_cfg, mode_cfg)
+
+
+# set per seed before `process_features`, and passed through the non-ensembled stage.
+SEED_FEATURES = [
+    "num_recycling_iters",
+    "use_clamped_fape",
+    "is_distillation",
+    "crop_and_fix_size_seed",
+]
+
+
+class NonensembledCache:
+    """Outputs of `process_nonensembled` for the last few targets.
+
+    The stage draws no random numbers unless MSA rows are randomly deleted or
+    templates are subsampled, so its output only depends on the target and on
+    the few config fields below, and can be shared by all seeds and models of
+    a target.
+    """
+
+    def __init__(self, maxsize: int = 1):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def is_deterministic(mode_cfg) -> bool:
+        return not mode_cfg.random_delete_msa and not mode_cfg.subsample_templates
+
+    @staticmethod
+    def config_key(common_cfg, mode_cfg):
+        return (
+            common_cfg.is_multimer,
+            common_cfg.v2_feature,
+            common_cfg.use_templates,
+            common_cfg.use_template_torsion_angles,
+            mode_cfg.max_templates,
+            mode_cfg.supervised,
+        )
+
+    def get_or_process(self, cache_key, tensors, common_cfg, mode_cfg):
+        if not self.is_deterministic(mode_cfg):
+            return process_nonensembled(tensors, common_cfg, mode_cfg)
+        is_distillation = bool(tensors.get("is_distillation", 0))
+        key = (cache_key, is_distillation, self.config_key(common_cfg, mode_cfg))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            cached = self._cache[key]
+        else:
+            cached = process_nonensembled(dict(tensors), common_cfg, mode_cfg)
+            self._cache[key] = cached
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        # the ensembled stage may write into its inputs, hand out copies.
+        ret = {k: v.clone() for k, v in cached.items()}
+        ret.update({k: tensors[k] for k in SEED_FEATURES if k in tensors})
+        return ret
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+
 @data_ops.curry1
 def compose(x, fs):
     for f in fs:
@@ -216,39 +301,65 @@ def compose(x, fs):
     return x
 
 
-def pad_then_stack(
-    values,
-):
-    if len(values[0].shape) >= 1:
-        size = max(v.shape[0] for v in values)
-        new_values = []
-        for v in values:
-            if v.shape[0] < size:
-                res = values[0].new_zeros(size, *v.shape[1:])
-                res[:v.shape[0], ...] = v
-            else:
-                res = v
-            new_values.append(res)
+class StackedFeatures:
+    """Features of `num` samples written into preallocated stacked tensors.
+
+    The stacked tensors are allocated from the first sample written. Like
+    stacking, shorter leading dimensions are zero padded to the longest one.
+    """
+
+    def __init__(self, num):
+        self.num = num
+        self.features = None
+        self.lock = threading.Lock()
+
+    def set(self, i, sample):
+        with self.lock:
+            if self.features is None:
+                self.features = {
+                    k: v.new_zeros(self.num, *v.shape) for k, v in sample.items()
+                }
+            for k, out in self.features.items():
+                v = sample[k]
+                if v.dim() == 0:
+                    out[i] = v
+                    continue
+                if v.shape[0] > out.shape[1]:
+                    grown = out.new_zeros(self.num, *v.shape)
+                    grown[:, : out.shape[1]] = out
+                    self.features[k] = out = grown
+                out[i, : v.shape[0]] = v
+
+
+def map_fn(fun, x, num_workers=0):
+    """Stack the features returned by `fun` for each element of `x`.
+
+    With `num_workers > 0`, the calls run on a thread pool. Each call then draws
+    from its own numpy `RandomState`, seeded in order from the global state,
+    so the result does not depend on the scheduling of the threads (but is not
+    the one of the serial loop).
+    """
+    stacked = StackedFeatures(len(x))
+    if num_workers > 0:
+        seeds = np.random.randint(1 << 31, size=len(x))
+
+        def run(i):
+            with data_ops.thread_random_state(seeds[i]):
+                stacked.set(i, fun(x[i]))
+
+        with ThreadPoolExecutor(num_workers) as pool:
+            list(pool.map(run, range(len(x))))
     else:
-        new_values = values
-    return torch.stack(new_values, dim=0)
-
-def map_fn(fun, x):
-    ensembles = [fun(elem) for elem in x]
-    features = ensembles[0].keys()
-    ensembled_dict = {}
-    for feat in features:
-        ensembled_dict[feat] = pad_then_stack(
-            [dict_i[feat] for dict_i in ensembles]
-        )
-    return ensembled_dict
+        for i, elem in enumerate(x):
+            stacked.set(i, fun(elem))
+    return stacked.features
 
 
 def process_single_label(label: dict, num_ensemble: Optional[int] = None) -> dict:
     assert "aatype" in label
     assert "all_atom_positions" in label
     assert "all_atom_mask" in label
-    label = compose(label_transform_fn())(label)
+    label = compose(label_transform_fn(has_label_transforms(label)))(label)
     if num_ensemble is not None:
         label = {
             k: torch.stack([v for _ in range(num_ensemble)]) for k, v in label.items()
@@ -260,7 +371,52 @@ def process_labels(labels_list, num_ensemble: Optional[int] = None):
     return [process_single_label(l, num_ensemble) for l in labels_list]
 
 
-def label_transform_fn():
+# outputs of `label_transform_fn`, which only depend on the ground truth structure.
+LABEL_TRANSFORM_KEYS = [
+    "residx_atom14_to_atom37",
+    "residx_atom37_to_atom14",
+    "atom14_atom_exists",
+    "atom37_atom_exists",
+    "atom14_gt_exists",
+    "atom14_gt_positions",
+    "atom14_alt_gt_positions",
+    "atom14_alt_gt_exists",
+    "atom14_atom_is_ambiguous",
+    "rigidgroups_gt_frames",
+    "rigidgroups_gt_exists",
+    "rigidgroups_group_exists",
+    "rigidgroups_group_is_ambiguous",
+    "rigidgroups_alt_gt_frames",
+    "torsion_angles_sin_cos",
+    "alt_torsion_angles_sin_cos",
+    "torsion_angles_mask",
+    "pseudo_beta",
+    "pseudo_beta_mask",
+    "true_frame_tensor",
+    "frame_mask",
+    "chi_angles_sin_cos",
+    "chi_mask",
+]
+
+
+def has_label_transforms(label: dict) -> bool:
+    return all(k in label for k in LABEL_TRANSFORM_KEYS)
+
+
+def compute_label_transforms(label: dict) -> dict:
+    """Run `label_transform_fn` on a numpy label, see `scripts/precompute_label_transforms.py`."""
+    tensors = {
+        k: torch.tensor(label[k])
+        for k in ["aatype", "all_atom_positions", "all_atom_mask"]
+    }
+    with torch.no_grad():
+        tensors = compose(label_transform_fn())(tensors)
+    return {k: tensors[k].numpy() for k in LABEL_TRANSFORM_KEYS}
+
+
+def label_transform_fn(precomputed: bool = False):
+    if precomputed:
+        return [data_ops.cast_label_dtypes]
     return [
         data_ops.make_atom14_masks,
         data_ops.make_atom14_positions,
@@ -19,6 +19,7 @@ import collections
 
 from unifold.data import residue_constants, msa_pairing
 import numpy as np
+from .msa_dedup import isin_rows
 from .utils import correct_template_restypes
 
 FeatureDict = MutableMapping[str, np.ndarray]
@@ -302,7 +303,7 @@ def convert_monomer_features(monomer_features: FeatureDict) -> FeatureDict:
         elif feature_name == "template_all_atom_masks":
             feature_name = "template_all_atom_mask"
         elif feature_name == "msa":
-            feature = feature.astype(np.uint8)
+            feature = feature.astype(np.uint8, copy=False)
 
         if feature_name.endswith("_mask"):
             feature = feature.astype(np.float32)
@@ -413,11 +414,7 @@ def post_process(np_example):
 
 
 def merge_msas(msa, del_mat, new_msa, new_del_mat):
-    cur_msa_set = set([tuple(m) for m in msa])
-    new_rows = []
-    for i, s in enumerate(new_msa):
-        if tuple(s) not in cur_msa_set:
-            new_rows.append(i)
+    new_rows = np.nonzero(~isin_rows(new_msa, msa))[0]
     ret_msa = np.concatenate([msa, new_msa[new_rows]], axis=0)
     ret_del_mat = np.concatenate([del_mat, new_del_mat[new_rows]], axis=0)
     return ret_msa, ret_del_mat
@@ -0,0 +1,226 @@
+"""A feature cache shared by all data loader workers on a node.
+
+Entries are written once, in the shard format of `feature_store`, into a
+directory that should live on a memory backed file system (``/dev/shm``).
+Every worker maps the same pages, and gets read-only zero-copy views of the
+cached arrays. The directory is bounded by a byte budget with LRU eviction,
+where the recency of an entry is its file mtime. Hit / miss / eviction counts
+are kept per process and added every `STATS_FLUSH_EVERY` lookups to a small
+memory-mapped stats file, so that they are node-wide too.
+"""
+
+import fcntl
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from typing import *
+
+import numpy as np
+
+from . import feature_store
+from .data_ops import NumpyDict
+from .utils import LazyMsa
+
+ENTRY_SUFFIX = ".ufs"
+TMP_SUFFIX = ".tmp"
+LAZY_MSA_KEY = "lazy_msa"
+STATS_KEYS = ("hits", "misses", "evictions")
+STATS_FLUSH_EVERY = 64
+
+
+def _to_storable(feature: NumpyDict) -> NumpyDict:
+    feature = dict(feature)
+    if isinstance(feature.get("msa"), LazyMsa):
+        lazy_msa = feature.pop("msa")
+        feature[LAZY_MSA_KEY] = {
+            "msa": lazy_msa.msa,
+            "deletion_matrix": lazy_msa.deletion_matrix,
+        }
+    return feature
+
+
+def _from_storable(feature: NumpyDict) -> NumpyDict:
+    if LAZY_MSA_KEY in feature:
+        lazy_msa = feature.pop(LAZY_MSA_KEY)
+        feature["msa"] = LazyMsa(lazy_msa["msa"], lazy_msa["deletion_matrix"])
+    return feature
+
+
+class SharedFeatureCache:
+    """Node-wide LRU cache of feature dicts, keyed by any hashable repr-able key.
+
+    Only holds paths and the budget, so it is cheap to pickle into workers.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        self.entry_dir = os.path.join(cache_dir, "entries")
+        self.lock_path = os.path.join(cache_dir, "lock")
+        self.stats_path = os.path.join(cache_dir, "stats")
+        os.makedirs(self.entry_dir, exist_ok=True)
+        self._reset_counts()
+        with self._locked():
+            if not os.path.isfile(self.stats_path):
+                np.zeros(len(STATS_KEYS), dtype=np.int64).tofile(self.stats_path)
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _reset_counts(self) -> None:
+        self._pid = os.getpid()
+        self._counts = np.zeros(len(STATS_KEYS), dtype=np.int64)
+
+    def _count(self, key: str, n: int = 1) -> None:
+        if self._pid != os.getpid():
+            # a copy pickled into a worker; the counts are the parent's.
+            self._reset_counts()
+        self._counts[STATS_KEYS.index(key)] += n
+        if self._counts.sum() >= STATS_FLUSH_EVERY:
+            with self._locked():
+                self._flush_counts()
+
+    def _flush_counts(self) -> None:
+        # with the lock held.
+        if self._pid != os.getpid() or not self._counts.any():
+            return
+        stats = np.memmap(self.stats_path, dtype=np.int64, mode="r+")
+        stats += self._counts
+        stats.flush()
+        self._counts[:] = 0
+
+    def _entry_path(self, key: Any) -> str:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.entry_dir, digest + ENTRY_SUFFIX)
+
+    def _list_entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        for e in os.scandir(self.entry_dir):
+            if e.name.endswith(ENTRY_SUFFIX):
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+        return entries
+
+    def _list_tmp(self) -> Tuple[List[Tuple[int, str]], List[Tuple[int, str]]]:
+        """(size, path) of the partly written entries, of live and of dead writers."""
+        live, stale = [], []
+        for e in os.scandir(self.entry_dir):
+            if not e.name.endswith(TMP_SUFFIX):
+                continue
+            try:
+                size = e.stat().st_size
+            except FileNotFoundError:
+                continue
+            # <digest>.ufs.<pid>.<thread>.tmp
+            pid = int(e.name.split(".")[2])
+            try:
+                os.kill(pid, 0)
+                alive = True
+            except ProcessLookupError:
+                alive = False
+            except PermissionError:
+                alive = True
+            (live if alive else stale).append((size, e.path))
+        return live, stale
+
+    def _remove_stale_tmp(self) -> int:
+        """Remove the entries left by dead writers; returns the bytes still being written."""
+        live, stale = self._list_tmp()
+        for _, path in stale:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return sum(size for size, _ in live)
+
+    def _load(self, path: str) -> Optional[NumpyDict]:
+        try:
+            shard = feature_store.FeatureShard(path)
+            feature = shard.load("0")
+        except FileNotFoundError:
+            # evicted by another worker in the meantime.
+            return None
+        return _from_storable(feature)
+
+    def get(self, key: Any) -> Optional[NumpyDict]:
+        path = self._entry_path(key)
+        feature = self._load(path) if os.path.isfile(path) else None
+        if feature is None:
+            self._count("misses")
+            return None
+        try:
+            os.utime(path)  # bump recency for LRU.
+        except FileNotFoundError:
+            pass
+        self._count("hits")
+        return feature
+
+    def put(self, key: Any, feature: NumpyDict) -> NumpyDict:
+        """Cache `feature`, and return it as views into the cache if possible."""
+        path = self._entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}{TMP_SUFFIX}"
+        feature_store.write_shard(tmp_path, [("0", _to_storable(feature))], narrow=False)
+        size = os.path.getsize(tmp_path)
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return feature
+
+        num_evicted = 0
+        with self._locked():
+            self._flush_counts()
+            if os.path.isfile(path):  # another worker was faster.
+                os.remove(tmp_path)
+            else:
+                entries = sorted(self._list_entries())
+                # entries being written by other workers use the budget too,
+                # our own `tmp_path` is `size`.
+                used = sum(e[1] for e in entries) + self._remove_stale_tmp() - size
+                for _, entry_size, entry_path in entries:
+                    if used + size <= self.max_bytes:
+                        break
+                    os.remove(entry_path)
+                    used -= entry_size
+                    num_evicted += 1
+                os.replace(tmp_path, path)
+        if num_evicted:
+            self._count("evictions", num_evicted)
+
+        cached = self._load(path)
+        return cached if cached is not None else feature
+
+    def get_or_load(self, key: Any, load_fn: Callable[[], NumpyDict]) -> NumpyDict:
+        feature = self.get(key)
+        if feature is None:
+            feature = self.put(key, load_fn())
+        return feature
+
+    def stats(self) -> Dict[str, int]:
+        """Node-wide stats; other processes may hold up to `STATS_FLUSH_EVERY` unflushed counts."""
+        with self._locked():
+            self._flush_counts()
+        stats = np.fromfile(self.stats_path, dtype=np.int64)
+        ret = {k: int(v) for k, v in zip(STATS_KEYS, stats)}
+        entries = self._list_entries()
+        ret["entries"] = len(entries)
+        ret["bytes"] = sum(e[1] for e in entries)
+        total = ret["hits"] + ret["misses"]
+        ret["hit_rate"] = ret["hits"] / total if total > 0 else 0.0
+        return ret
+
+    def clear(self) -> None:
+        with self._locked():
+            for _, _, path in self._list_entries():
+                os.remove(path)
+            self._remove_stale_tmp()
+            self._reset_counts()
+            np.zeros(len(STATS_KEYS), dtype=np.int64).tofile(self.stats_path)
@@ -3,11 +3,13 @@ import functools
 import gzip
 import json
 import numpy as np
+import os
 import pickle
 from scipy import sparse as sp
 from typing import *
 
 from . import residue_constants as rc
+from . import feature_store
 from .data_ops import NumpyDict
 
 
@@ -21,6 +23,7 @@ def lru_cache(maxsize=16, typed=False, copy=False, deepcopy=False):
             def wrapper(*args, **kwargs):
                 return copy_lib.deepcopy(cached_func(*args, **kwargs))
 
+            wrapper.cache_clear = cached_func.cache_clear
             return wrapper
 
     elif copy:
@@ -32,6 +35,7 @@ def lru_cache(maxsize=16, typed=False, copy=False, deepcopy=False):
             def wrapper(*args, **kwargs):
                 return copy_lib.copy(cached_func(*args, **kwargs))
 
+            wrapper.cache_clear = cached_func.cache_clear
             return wrapper
 
     else:
@@ -55,7 +59,7 @@ def load_pickle_safe(path: str) -> Dict[str, Any]:
 
 
 @lru_cache(maxsize=8, copy=True)
-def load_pickle(path: str) -> Dict[str, Any]:
+def load_pickle(path: str, uncompress: bool = True) -> Dict[str, Any]:
     def load(path):
         assert path.endswith(".pkl") or path.endswith(
             ".pkl.gz"
@@ -65,10 +69,97 @@ def load_pickle(path: str) -> Dict[str, Any]:
             return pickle.load(f)
 
     ret = load(path)
-    ret = uncompress_features(ret)
+    if uncompress:
+        ret = uncompress_features(ret)
+    return ret
+
+
+def load_features(
+    data_dir: str,
+    name: str,
+    suffix: str,
+    keys: Optional[Iterable[str]] = None,
+    uncompress: bool = True,
+) -> Dict[str, Any]:
+    """Load `name` from a packed feature store, or from `<name>.<suffix>.pkl.gz`.
+
+    With `uncompress=False` the deletion matrix is left in its stored form
+    (sparse for pickles, narrow ints for stores), see `LazyMsa`.
+    """
+    if feature_store.is_store(data_dir):
+        return feature_store.open_store(data_dir).load(name, keys, widen=uncompress)
+    ret = load_pickle(
+        os.path.join(data_dir, f"{name}.{suffix}.pkl.gz"), uncompress=uncompress
+    )
+    if keys is not None:
+        ret = {k: v for k, v in ret.items() if k in keys}
     return ret
 
 
+def make_sample_cdf(sample_prob: Sequence[float]) -> np.ndarray:
+    """Cumulative distribution of `sample_prob`, to be built once for `weighted_choice`."""
+    cdf = np.cumsum(np.asarray(sample_prob, dtype=np.float64))
+    if len(cdf) > 0:
+        cdf /= cdf[-1]
+    return cdf
+
+
+def weighted_choice(cdf: np.ndarray) -> int:
+    """Draw an index with the probabilities of `cdf` in O(log N).
+
+    This consumes the global numpy random state exactly like (and returns the
+    same index as) `np.random.choice(len(cdf), p=sample_prob)`, which rebuilds
+    the cdf on every call.
+    """
+    return int(cdf.searchsorted(np.random.random_sample(), side="right"))
+
+
+def links_to_coo(
+    r1: np.ndarray,
+    r2: np.ndarray,
+    value: np.ndarray,
+    num_res: int,
+    dtype=np.float32,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Non-zero cells of `links_to_matrix`, as `(K, 2)` indices and `(K,)` values."""
+    r1 = np.asarray(r1, dtype=np.int64)
+    r2 = np.asarray(r2, dtype=np.int64)
+    value = np.asarray(value).astype(dtype)
+    pair = np.minimum(r1, r2) * num_res + np.maximum(r1, r2)
+    _, last = np.unique(pair[::-1], return_index=True)
+    last = len(pair) - 1 - last
+    r1, r2, value = r1[last], r2[last], value[last]
+    off_diag = r1 != r2
+    xl_idx = np.concatenate(
+        [np.stack([r1, r2], axis=-1), np.stack([r2, r1], axis=-1)[off_diag]]
+    )
+    xl_value = np.concatenate([value, value[off_diag]])
+    nonzero = xl_value != 0
+    return xl_idx[nonzero], xl_value[nonzero]
+
+
+def links_to_matrix(
+    r1: np.ndarray,
+    r2: np.ndarray,
+    value: np.ndarray,
+    num_res: int,
+    dtype=np.float32,
+) -> np.ndarray:
+    """Scatter `value` of the residue pairs `(r1, r2)` symmetrically into a `(num_res, num_res, 1)` matrix.
+
+    If several links hit the same pair, the last one wins, as when writing
+    them one at a time.
+    """
+    xl_idx, xl_value = links_to_coo(r1, r2, value, num_res, dtype)
+    output = np.zeros((num_res, num_res, 1), dtype=dtype)
+    output[xl_idx[:, 0], xl_idx[:, 1], 0] = xl_value
+    return output
+
+
+def empty_xl_coo() -> Tuple[np.ndarray, np.ndarray]:
+    return np.zeros((0, 2), dtype=np.int64), np.zeros((0,), dtype=np.float32)
+
+
 def correct_template_restypes(feature):
     """Correct template restype to have the same order as residue_constants."""
     feature = np.argmax(feature, axis=-1).astype(np.int32)
@@ -85,15 +176,65 @@ def convert_all_seq_feature(feature: NumpyDict) -> NumpyDict:
     return {make_all_seq_key(k): v for k, v in feature.items()}
 
 
-def to_dense_matrix(spmat_dict: NumpyDict):
+def to_dense_matrix(spmat_dict: NumpyDict, rows: Optional[np.ndarray] = None):
+    if rows is None:
+        spmat = sp.coo_matrix(
+            (spmat_dict["data"], (spmat_dict["row"], spmat_dict["col"])),
+            shape=spmat_dict["shape"],
+            dtype=np.float32,
+        )
+        return spmat.toarray()
+    # only densify the requested rows, in the requested order.
+    num_rows, num_cols = spmat_dict["shape"]
+    row_map = np.full(num_rows, -1, dtype=np.int64)
+    row_map[rows] = np.arange(len(rows))
+    new_row = row_map[spmat_dict["row"]]
+    keep = new_row >= 0
     spmat = sp.coo_matrix(
-        (spmat_dict["data"], (spmat_dict["row"], spmat_dict["col"])),
-        shape=spmat_dict["shape"],
+        (spmat_dict["data"][keep], (new_row[keep], spmat_dict["col"][keep])),
+        shape=(len(rows), num_cols),
         dtype=np.float32,
     )
     return spmat.toarray()
 
 
+class LazyMsa:
+    """An MSA whose rows are only decoded and densified when they are taken.
+
+    `msa` may be a decoded array or a memmap view, `deletion_matrix` either a
+    (memmapped) dense integer array or the sparse dict of `compress_features`.
+    """
+
+    def __init__(self, msa: np.ndarray, deletion_matrix: Union[np.ndarray, dict]):
+        self.msa = msa
+        self.deletion_matrix = deletion_matrix
+
+    @staticmethod
+    def from_features(feature: NumpyDict) -> NumpyDict:
+        """Replace `msa` and the deletion matrix of `feature` by a `LazyMsa`."""
+        for k in ["sparse_deletion_matrix_int", "deletion_matrix_int", "deletion_matrix"]:
+            if k in feature:
+                feature["msa"] = LazyMsa(feature["msa"], feature.pop(k))
+                break
+        return feature
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return tuple(self.msa.shape)
+
+    def take(self, rows: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return `msa` and float32 `deletion_matrix` of the given (or all) rows."""
+        msa = np.asarray(self.msa) if rows is None else self.msa[rows]
+        if isinstance(self.deletion_matrix, dict):
+            deletion_matrix = to_dense_matrix(self.deletion_matrix, rows)
+        else:
+            deletion_matrix = (
+                self.deletion_matrix if rows is None else self.deletion_matrix[rows]
+            )
+            deletion_matrix = deletion_matrix.astype(np.float32)
+        return msa, deletion_matrix
+
+
 FEATS_DTYPE = {"msa": np.int32}
 
 
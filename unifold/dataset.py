@@ -4,10 +4,19 @@ import ml_collections as mlc
 import numpy as np
 import copy
 import torch
+from functools import partial
 from typing import *
-from unifold.data import utils
+from unifold.data import data_ops, utils, feature_store
+from unifold.data.shared_cache import SharedFeatureCache
+from unifold.data.prefetch import Prefetcher
 from unifold.data.data_ops import NumpyDict, TorchDict
-from unifold.data.process import process_features, process_labels
+from unifold.data.process import (
+    process_features,
+    process_labels,
+    NonensembledCache,
+    has_label_transforms,
+    LABEL_TRANSFORM_KEYS,
+)
 from unifold.data.process_multimer import (
     pair_and_merge,
     add_assembly_features,
@@ -51,6 +60,14 @@ def make_data_config(
     return cfg, feature_names
 
 
+def get_data_dir(data_path: str, name: str) -> str:
+    """Prefer a packed feature store `<name>.store` over the pickle tree `<name>`."""
+    store_dir = os.path.join(data_path, name + feature_store.STORE_SUFFIX)
+    if feature_store.is_store(store_dir):
+        return store_dir
+    return os.path.join(data_path, name)
+
+
 def process_label(all_atom_positions: np.ndarray, operation: Operation) -> np.ndarray:
     if operation == "I":
         return all_atom_positions
@@ -60,6 +77,35 @@ def process_label(all_atom_positions: np.ndarray, operation: Operation) -> np.nd
     return all_atom_positions @ rot.T + trans
 
 
+def process_label_transforms(label: NumpyDict, operation: Operation) -> NumpyDict:
+    """Apply a symmetry operation to the precomputed outputs of `label_transform_fn`.
+
+    Torsion angles and masks are invariant; positions and frames are moved
+    rigidly. Only entries masked out in the losses may differ from running the
+    transforms on the moved positions.
+    """
+    if operation == "I":
+        return label
+    rot, trans = operation
+    rot = np.array(rot).reshape(3, 3)
+    trans = np.array(trans).reshape(3)
+    for k, mask_key in [
+        ("atom14_gt_positions", "atom14_gt_exists"),
+        ("atom14_alt_gt_positions", "atom14_alt_gt_exists"),
+        ("pseudo_beta", None),
+    ]:
+        pos = label[k] @ rot.T + trans
+        if mask_key is not None:
+            pos = pos * label[mask_key][..., None]
+        label[k] = pos.astype(np.float32)
+    for k in ["rigidgroups_gt_frames", "rigidgroups_alt_gt_frames", "true_frame_tensor"]:
+        frames = np.array(label[k])
+        frames[..., :3, :3] = rot @ label[k][..., :3, :3]
+        frames[..., :3, 3] = label[k][..., :3, 3] @ rot.T + trans
+        label[k] = frames.astype(np.float32)
+    return label
+
+
 @utils.lru_cache(maxsize=8, copy=True)
 def load_single_feature(
     sequence_id: str,
@@ -68,16 +114,19 @@ def load_single_feature(
     is_monomer: bool = False,
 ) -> NumpyDict:
 
-    monomer_feature = utils.load_pickle(
-        os.path.join(monomer_feature_dir, f"{sequence_id}.feature.pkl.gz")
+    # a single chain without uniprot msa is never paired or merged, so its msa
+    # rows can be decoded after random_delete_msa chooses them, see `take_lazy_msa`.
+    lazy_msa = is_monomer and uniprot_msa_dir is None
+    monomer_feature = utils.load_features(
+        monomer_feature_dir, sequence_id, "feature", uncompress=not lazy_msa
     )
     monomer_feature = convert_monomer_features(monomer_feature)
     chain_feature = {**monomer_feature}
+    if lazy_msa:
+        chain_feature = utils.LazyMsa.from_features(chain_feature)
 
     if uniprot_msa_dir is not None:
-        all_seq_feature = utils.load_pickle(
-            os.path.join(uniprot_msa_dir, f"{sequence_id}.uniprot.pkl.gz")
-        )
+        all_seq_feature = utils.load_features(uniprot_msa_dir, sequence_id, "uniprot")
         if is_monomer:
             chain_feature["msa"], chain_feature["deletion_matrix"] = merge_msas(
                 chain_feature["msa"],
@@ -97,21 +146,39 @@ def load_single_feature(
     return chain_feature
 
 
+def load_single_feature_shared(
+    feature_cache: SharedFeatureCache,
+    sequence_id: str,
+    monomer_feature_dir: str,
+    uniprot_msa_dir: Optional[str] = None,
+    is_monomer: bool = False,
+) -> NumpyDict:
+    key = (sequence_id, monomer_feature_dir, uniprot_msa_dir, is_monomer)
+    # bypass the per-process lru cache, the shared cache replaces it.
+    load_fn = lambda: load_single_feature.__wrapped__(*key)
+    return dict(feature_cache.get_or_load(key, load_fn))
+
+
 def load_single_label(
     label_id: str,
     label_dir: str,
     symmetry_operation: Optional[Operation] = None,
 ) -> NumpyDict:
-    label = utils.load_pickle(os.path.join(label_dir, f"{label_id}.label.pkl.gz"))
+    label = utils.load_features(
+        label_dir,
+        label_id,
+        "label",
+        keys=["aatype", "all_atom_positions", "all_atom_mask", "resolution"]
+        + LABEL_TRANSFORM_KEYS,
+    )
+    if not has_label_transforms(label):
+        label = {k: v for k, v in label.items() if k not in LABEL_TRANSFORM_KEYS}
     if symmetry_operation is not None:
         label["all_atom_positions"] = process_label(
             label["all_atom_positions"], symmetry_operation
         )
-    label = {
-        k: v
-        for k, v in label.items()
-        if k in ["aatype", "all_atom_positions", "all_atom_mask", "resolution"]
-    }
+        if has_label_transforms(label):
+            label = process_label_transforms(label, symmetry_operation)
     return label
 
 
@@ -123,12 +190,21 @@ def load(
     label_dir: Optional[str] = None,
     symmetry_operations: Optional[List[Operation]] = None,
     is_monomer: bool = False,
+    feature_cache: Optional[SharedFeatureCache] = None,
 ) -> NumpyExample:
 
-    all_chain_features = [
-        load_single_feature(s, monomer_feature_dir, uniprot_msa_dir, is_monomer)
-        for s in sequence_ids
-    ]
+    if feature_cache is not None:
+        all_chain_features = [
+            load_single_feature_shared(
+                feature_cache, s, monomer_feature_dir, uniprot_msa_dir, is_monomer
+            )
+            for s in sequence_ids
+        ]
+    else:
+        all_chain_features = [
+            load_single_feature(s, monomer_feature_dir, uniprot_msa_dir, is_monomer)
+            for s in sequence_ids
+        ]
 
     if label_ids is not None:
         # load labels
@@ -140,6 +216,12 @@ def load(
             load_single_label(l, label_dir, o)
             for l, o in zip(label_ids, symmetry_operations)
         ]
+        # precomputed label transforms are only used if all chains have them.
+        precomputed = all(has_label_transforms(l) for l in all_chain_labels)
+        if not precomputed:
+            for l in all_chain_labels:
+                for k in LABEL_TRANSFORM_KEYS:
+                    l.pop(k, None)
         # update labels into features to calculate spatial cropping etc.
         [f.update(l) for f, l in zip(all_chain_features, all_chain_labels)]
 
@@ -147,13 +229,15 @@ def load(
 
     # get labels back from features, as add_assembly_features may alter the order of inputs.
     if label_ids is not None:
-        all_chain_labels = [
-            {
-                k: f[k]
-                for k in ["aatype", "all_atom_positions", "all_atom_mask", "resolution"]
-            }
-            for f in all_chain_features
-        ]
+        label_keys = ["aatype", "all_atom_positions", "all_atom_mask", "resolution"]
+        if precomputed:
+            label_keys += LABEL_TRANSFORM_KEYS
+        all_chain_labels = [{k: f[k] for k in label_keys} for f in all_chain_features]
+        if precomputed and not is_monomer:
+            # only needed by the labels, keep them out of pair_and_merge.
+            for f in all_chain_features:
+                for k in LABEL_TRANSFORM_KEYS:
+                    f.pop(k)
     else:
         all_chain_labels = None
 
@@ -168,6 +252,22 @@ def load(
     return all_chain_features, all_chain_labels
 
 
+def take_lazy_msa(features: NumpyDict, common_cfg, mode_cfg) -> NumpyDict:
+    """Decode the rows of a `LazyMsa` that survive `random_delete_msa`.
+
+    Must be called at the point where `random_delete_msa` would draw its rows
+    in `process_features`, so that the same random numbers are consumed.
+    """
+    lazy_msa = features["msa"]
+    keep_index = None
+    if mode_cfg.random_delete_msa:
+        keep_index = data_ops.get_random_delete_msa_idx(
+            *lazy_msa.shape, common_cfg.random_delete_msa
+        )
+    features["msa"], features["deletion_matrix"] = lazy_msa.take(keep_index)
+    return features
+
+
 def process(
     config,
     mode: str,
@@ -196,12 +296,16 @@ def process(
 
     num_res = int(features["seq_length"])
     cfg, feature_names = make_data_config(config, mode=mode, num_res=num_res)
+    if cfg[mode].supervised and has_label_transforms(features):
+        feature_names += LABEL_TRANSFORM_KEYS
 
     if labels is not None:
         features["resolution"] = labels[0]["resolution"].reshape(-1)
     with data_utils.numpy_seed(seed, data_idx, key="protein_feature"):
         features["crop_and_fix_size_seed"] = np.random.randint(0, 63355)
         features = utils.filter(features, desired_keys=feature_names)
+        if isinstance(features["msa"], utils.LazyMsa):
+            features = take_lazy_msa(features, cfg.common, cfg[mode])
         features = {k: torch.tensor(v) for k, v in features.items()}
         with torch.no_grad():
             features = process_features(features, cfg.common, cfg[mode])
@@ -216,9 +320,8 @@ def process(
 def calculate_offsets(asym_ids):
     """A function that calculate the offset when preparing cross link data"""
     asym_ids = asym_ids.detach().cpu().numpy()
-    unique_asym_ids = np.unique(asym_ids)
-    seq_lens = [np.sum(asym_ids==u) for u in unique_asym_ids]
-    return np.cumsum([0] + seq_lens)
+    _, seq_lens = np.unique(asym_ids, return_counts=True)
+    return np.cumsum([0] + list(seq_lens))
 
 def create_xl_features(xl_pickle,offsets,**kwargs):
     """
@@ -229,20 +332,18 @@ def create_xl_features(xl_pickle,offsets,**kwargs):
     descriptions = [kwargs['chain_id_map'][k].description for k in kwargs['chain_id_map']] 
     results = []
     for i, chain1 in enumerate(descriptions):
+        if chain1 not in xl_pickle:
+            continue
         for j, chain2 in enumerate(descriptions):
-            links = []
-            if chain1 in xl_pickle:
-                if chain2 in xl_pickle[chain1]:
-                    for start,end,fdr in xl_pickle[chain1][chain2]:
-                        start += offsets[i]
-                        end += offsets[j]
-                        links.append((start,end,fdr))
-                    
-                    if len(links)>0:
-                        links = torch.tensor(links)
-                        results.append(links)
-    
-    return [] if len(results) ==0 else torch.cat(results,dim=0)
+            if chain2 not in xl_pickle[chain1]:
+                continue
+            links = np.array(xl_pickle[chain1][chain2], dtype=np.float64).reshape(-1, 3)
+            if len(links) > 0:
+                links[:, 0] += offsets[i]
+                links[:, 1] += offsets[j]
+                results.append(links)
+
+    return [] if len(results) ==0 else torch.from_numpy(np.concatenate(results).astype(np.float32))
 
 
 def process_xl_input(features,**kwargs):
@@ -252,21 +353,25 @@ def process_xl_input(features,**kwargs):
     xl= create_xl_features(xl_pickle,offsets,**kwargs)
     return xl
 
+def bucketize_xl_links(xl):
+    """Shuffle the links, and put the FDR of each into its bin"""
+    bins = torch.arange(0,1.05,0.05)
+    xl = xl[torch.randperm(len(xl))]
+    fdr_bins = torch.bucketize(1 - xl[:, 2], bins).numpy()
+    residues = xl[:, :2].long().numpy()
+    return residues[:, 0], residues[:, 1], fdr_bins
+
 def bin_xl(xl,num_res):
     """
     Put each link from the xl tensors to its bin
     Adapted from {Kolja Stahl and Oliver Brock and Juri Rappsilber, 2023, Modelling protein complexes with crosslinking mass spectrometry and deep learning
     https://github.com/Rappsilber-Laboratory/AlphaLink2/blob/b1cc971f6b0606316852e5fc27b0509e1b15490d/unifold/dataset.py#L166
     """
-    bins = torch.arange(0,1.05,0.05)
-    xl = xl[torch.randperm(len(xl))]
-    output = np.zeros((num_res,num_res,1))
-    for i, (r1,r2,fdr) in enumerate(xl):
-        r1 = int(r1.item())
-        r2 = int(r2.item())    
-        output[r1,r2,0] = output[r2,r1,0] = torch.bucketize(1-fdr, bins)
-    
-    return output
+    return utils.links_to_matrix(*bucketize_xl_links(xl), num_res)
+
+def bin_xl_sparse(xl,num_res):
+    """Same as `bin_xl`, as COO indices and bins of the non-zero entries"""
+    return utils.links_to_coo(*bucketize_xl_links(xl), num_res)
 
 def process_ap(
     config,
@@ -277,8 +382,14 @@ def process_ap(
     batch_idx: Optional[int] = None,
     is_distillation: bool = False,
     crosslinks: str = None,
+    nonensembled_cache: Optional[NonensembledCache] = None,
     **kwargs
 ) -> TorchExample:
+    """`process` for a single AlphaPulldown target.
+
+    Pass the same `nonensembled_cache` when predicting the target with several
+    seeds; it must not be shared with other targets.
+    """
 
     if mode == "train":
         assert batch_idx is not None
@@ -310,7 +421,9 @@ def process_ap(
     ).reshape(1,-1)
         cfg.common.use_template = True
         with torch.no_grad():
-            features = process_features(features, cfg.common, cfg[mode])
+            features = process_features(
+                features, cfg.common, cfg[mode], nonensembled_cache, cache_key="target"
+            )
 
     if labels is not None:
         labels = [{k: torch.tensor(v) for k, v in l.items()} for l in labels]
@@ -323,12 +436,13 @@ def process_ap(
                               chain_id_map=kwargs['chain_id_map'])
         
         if len(xl) == 0:
-            xl = np.zeros((num_res,num_res,1))
+            xl_idx, xl_value = utils.empty_xl_coo()
         else:
-            xl = bin_xl(xl,num_res)
-        features['xl'] = torch.unsqueeze(torch.tensor(xl),0)
+            xl_idx, xl_value = bin_xl_sparse(xl,num_res)
     else:
-        features['xl'] =  torch.tensor(np.zeros((num_res,num_res,1)))
+        xl_idx, xl_value = utils.empty_xl_coo()
+    features['xl_idx'] = torch.unsqueeze(torch.from_numpy(xl_idx),0)
+    features['xl_value'] = torch.unsqueeze(torch.from_numpy(xl_value),0)
     return features, labels
 
 
@@ -387,8 +501,8 @@ class UnifoldDataset(UnicoreDataset):
                 len(self.sample_weight), len(self.seq_sample_weight)
             )
         )
-        self.feature_path = os.path.join(self.path, "pdb_features")
-        self.label_path = os.path.join(self.path, "pdb_labels")
+        self.feature_path = get_data_dir(self.path, "pdb_features")
+        self.label_path = get_data_dir(self.path, "pdb_labels")
         sd_sample_weight_path = os.path.join(
             self.path, json_prefix + "sd_train_sample_weight.json"
         )
@@ -397,8 +511,8 @@ class UnifoldDataset(UnicoreDataset):
             logger.info(
                 "load {} self-distillation samples.".format(len(self.sd_sample_weight))
             )
-            self.sd_feature_path = os.path.join(self.path, "sd_features")
-            self.sd_label_path = os.path.join(self.path, "sd_labels")
+            self.sd_feature_path = get_data_dir(self.path, "sd_features")
+            self.sd_label_path = get_data_dir(self.path, "sd_labels")
         else:
             self.sd_sample_weight = None
         self.batch_size = (
@@ -412,28 +526,54 @@ class UnifoldDataset(UnicoreDataset):
             else len(self.sample_weight)
         )
         self.mode = mode
-        self.num_seq, self.seq_keys, self.seq_sample_prob = self.cal_sample_weight(
+        self.num_seq, self.seq_keys, self.seq_sample_cdf = self.cal_sample_weight(
             self.seq_sample_weight
         )
-        self.num_chain, self.chain_keys, self.sample_prob = self.cal_sample_weight(
+        self.num_chain, self.chain_keys, self.sample_cdf = self.cal_sample_weight(
             self.sample_weight
         )
         if self.sd_sample_weight is not None:
             (
                 self.sd_num_chain,
                 self.sd_chain_keys,
-                self.sd_sample_prob,
+                self.sd_sample_cdf,
             ) = self.cal_sample_weight(self.sd_sample_weight)
         self.config = config.data
         self.seed = seed
         self.sd_prob = args.sd_prob
+        shared_cache_size = getattr(args, "shared_cache_size", 0)
+        if shared_cache_size > 0:
+            self.feature_cache = SharedFeatureCache(
+                args.shared_cache_dir, shared_cache_size * (1024**3)
+            )
+            logger.info(
+                "use shared feature cache of {} GB in {}.".format(
+                    shared_cache_size, args.shared_cache_dir
+                )
+            )
+        else:
+            self.feature_cache = None
+        prefetch_depth = getattr(args, "prefetch_depth", 0)
+        if prefetch_depth > 0:
+            self.prefetcher = Prefetcher(prefetch_depth, args.prefetch_threads)
+        else:
+            self.prefetcher = None
+        self.local_batch_size = args.batch_size
+
+    @property
+    def supports_prefetch(self):
+        return self.prefetcher is not None
+
+    def prefetch(self, indices):
+        # called by the epoch iterator with the order of indices on this rank.
+        self.prefetcher.set_plan(indices, self.local_batch_size)
 
     def cal_sample_weight(self, sample_weight):
         prot_keys = list(sample_weight.keys())
         sum_weight = sum(sample_weight.values())
         sample_prob = [sample_weight[k] / sum_weight for k in prot_keys]
         num_prot = len(prot_keys)
-        return num_prot, prot_keys, sample_prob
+        return num_prot, prot_keys, utils.make_sample_cdf(sample_prob)
 
     def sample_chain(self, idx, sample_by_seq=False):
         is_distillation = False
@@ -445,18 +585,16 @@ class UnifoldDataset(UnicoreDataset):
                     else False
                 )
                 if is_distillation:
-                    prot_idx = np.random.choice(
-                        self.sd_num_chain, p=self.sd_sample_prob
-                    )
+                    prot_idx = utils.weighted_choice(self.sd_sample_cdf)
                     label_name = self.sd_chain_keys[prot_idx]
                     seq_name = label_name
                 else:
                     if not sample_by_seq:
-                        prot_idx = np.random.choice(self.num_chain, p=self.sample_prob)
+                        prot_idx = utils.weighted_choice(self.sample_cdf)
                         label_name = self.chain_keys[prot_idx]
                         seq_name = self.inverse_multi_label[label_name]
                     else:
-                        seq_idx = np.random.choice(self.num_seq, p=self.seq_sample_prob)
+                        seq_idx = utils.weighted_choice(self.seq_sample_cdf)
                         seq_name = self.seq_keys[seq_idx]
                         label_name = np.random.choice(self.multi_label[seq_name])
         else:
@@ -464,7 +602,7 @@ class UnifoldDataset(UnicoreDataset):
             seq_name = self.inverse_multi_label[label_name]
         return seq_name, label_name, is_distillation
 
-    def __getitem__(self, idx):
+    def get_load_kwargs(self, idx):
         sequence_id, label_id, is_distillation = self.sample_chain(
             idx, sample_by_seq=True
         )
@@ -473,13 +611,7 @@ class UnifoldDataset(UnicoreDataset):
             if not is_distillation
             else (self.sd_feature_path, self.sd_label_path)
         )
-        features, _ = load_and_process(
-            self.config,
-            self.mode,
-            self.seed,
-            batch_idx=(idx // self.batch_size),
-            data_idx=idx,
-            is_distillation=is_distillation,
+        return is_distillation, dict(
             sequence_ids=[sequence_id],
             monomer_feature_dir=feature_dir,
             uniprot_msa_dir=None,
@@ -487,7 +619,41 @@ class UnifoldDataset(UnicoreDataset):
             label_dir=label_dir,
             symmetry_operations=None,
             is_monomer=True,
+            feature_cache=self.feature_cache,
         )
+
+    def load_and_process_idx(self, idx):
+        is_distillation, load_kwargs = self.get_load_kwargs(idx)
+        if self.prefetcher is None:
+            return load_and_process(
+                self.config,
+                self.mode,
+                self.seed,
+                batch_idx=(idx // self.batch_size),
+                data_idx=idx,
+                is_distillation=is_distillation,
+                **load_kwargs,
+            )
+        # sample_chain uses the global numpy random state, so it runs here and
+        # only the loading of the upcoming samples runs in the background.
+        for next_idx in self.prefetcher.upcoming(idx):
+            if next_idx < len(self):
+                _, next_load_kwargs = self.get_load_kwargs(next_idx)
+                self.prefetcher.submit(next_idx, partial(load, **next_load_kwargs))
+        features, labels = self.prefetcher.get(idx, partial(load, **load_kwargs))
+        return process(
+            self.config,
+            self.mode,
+            features,
+            labels,
+            self.seed,
+            batch_idx=(idx // self.batch_size),
+            data_idx=idx,
+            is_distillation=is_distillation,
+        )
+
+    def __getitem__(self, idx):
+        features, _ = self.load_and_process_idx(idx)
         return features
 
     def __len__(self):
@@ -533,19 +699,19 @@ class UnifoldMultimerDataset(UnifoldDataset):
             open(os.path.join(self.data_path, json_prefix + "pdb_assembly.json"))
         )
         self.pdb_chains = self.get_chains(self.inverse_multi_label)
-        self.monomer_feature_path = os.path.join(self.data_path, "pdb_features")
-        self.uniprot_msa_path = os.path.join(self.data_path, "pdb_uniprots")
-        self.label_path = os.path.join(self.data_path, "pdb_labels")
+        self.monomer_feature_path = get_data_dir(self.data_path, "pdb_features")
+        self.uniprot_msa_path = get_data_dir(self.data_path, "pdb_uniprots")
+        self.label_path = get_data_dir(self.data_path, "pdb_labels")
         self.max_chains = args.max_chains
         if self.mode == "train":
             self.pdb_chains, self.sample_weight = self.filter_pdb_by_max_chains(
                 self.pdb_chains, self.pdb_assembly, self.sample_weight, self.max_chains,self.inverse_multi_label
             )
-            self.num_chain, self.chain_keys, self.sample_prob = self.cal_sample_weight(
+            self.num_chain, self.chain_keys, self.sample_cdf = self.cal_sample_weight(
                 self.sample_weight
             )
 
-    def __getitem__(self, idx):
+    def get_load_kwargs(self, idx):
         seq_id, label_id, is_distillation = self.sample_chain(idx)
         is_distillation = False
         if is_distillation:
@@ -577,13 +743,7 @@ class UnifoldMultimerDataset(UnifoldDataset):
                 self.label_path,
             )
 
-        return load_and_process(
-            self.config,
-            self.mode,
-            self.seed,
-            batch_idx=(idx // self.batch_size),
-            data_idx=idx,
-            is_distillation=is_distillation,
+        return is_distillation, dict(
             sequence_ids=sequence_ids,
             monomer_feature_dir=monomer_feature_path,
             uniprot_msa_dir=uniprot_msa_path,
@@ -591,8 +751,12 @@ class UnifoldMultimerDataset(UnifoldDataset):
             label_dir=label_path,
             symmetry_operations=symmetry_operations,
             is_monomer=False,
+            feature_cache=self.feature_cache,
         )
 
+    def __getitem__(self, idx):
+        return self.load_and_process_idx(idx)
+
     @staticmethod
     def collater(samples):
         # first dim is recyling. bsz is at the 2nd dim
@@ -7,7 +7,7 @@ import torch
 from typing import *
 from unifold.data import utils
 from unifold.data.data_ops import NumpyDict, TorchDict
-from unifold.data.process import process_features, process_labels
+from unifold.data.process import process_features, process_labels, NonensembledCache
 from unifold.data.process_multimer import (
     pair_and_merge,
     add_assembly_features,
@@ -152,38 +152,26 @@ def prepare_crosslinks(tp, chain_ids, offsets, lengths):
             seen.add((chain1,chain2))
             seen.add((chain2,chain1))
 
-            links = []
-
-            for ii, jj in tp[chain1][chain2]:
-                ii += offsets[i]
-                jj += offsets[j]
-                if chain1 == chain2 and abs(ii - jj) < 6:
-                    continue
-                links.append((ii,jj))
+            links = np.array(tp[chain1][chain2], dtype=np.int64).reshape(-1, 2)
+            links = links + np.array([offsets[i], offsets[j]], dtype=np.int64)
+            if chain1 == chain2:
+                links = links[np.abs(links[:, 0] - links[:, 1]) >= 6]
 
             if len(links) == 0:
                 continue
 
-            links = torch.tensor(links)
-
-            result.append(links)
+            result.append(torch.from_numpy(links))
 
 
     return [] if len(result) == 0 else torch.cat(result,dim=0)
 
 def bucketize_xl(xl,size):
     buckets = torch.arange(0,1.05,0.05)
-
-    n = size
-    xl_ = np.zeros((n,n,1))
-
-    for i, (r1,r2) in enumerate(xl):
-        r1 = int(r1.item())
-        r2 = int(r2.item())
-
-        xl_[r1,r2,0] = xl_[r2,r1,0] = torch.bucketize(1-fdr, buckets)
-
-    return xl_
+    # links without a false discovery rate are taken as certain.
+    fdr = xl[:, 2].float() if xl.shape[1] > 2 else torch.zeros(len(xl))
+    fdr_buckets = torch.bucketize(1 - fdr, buckets).numpy()
+    residues = xl[:, :2].long().numpy()
+    return utils.links_to_coo(residues[:, 0], residues[:, 1], fdr_buckets, size)
 
 def load(
     sequence_ids: List[str],
@@ -217,10 +205,10 @@ def load(
     size = np.sum(asym_len)
    
     if len(tp) == 0:
-        xl = np.zeros((size,size,1))
+        xl_idx, xl_value = utils.empty_xl_coo()
         print("no crosslinks",assembly,len(tp))
     else:
-        xl = bucketize_xl(tp)
+        xl_idx, xl_value = bucketize_xl(tp, size)
 
     if is_monomer:
         all_chain_features = all_chain_features[0]
@@ -229,7 +217,8 @@ def load(
         all_chain_features = post_process(all_chain_features)
     all_chain_features["asym_len"] = asym_len
 
-    all_chain_features['xl'] = xl
+    all_chain_features['xl_idx'] = xl_idx
+    all_chain_features['xl_value'] = xl_value
 
     return all_chain_features, None
 
@@ -243,7 +232,16 @@ def process(
     batch_idx: Optional[int] = None,
     data_idx: Optional[int] = None,
     is_distillation: bool = False,
+    nonensembled_cache: Optional[NonensembledCache] = None,
+    cache_key: Optional[str] = None,
+    feature_device: Optional[str] = None,
 ) -> TorchExample:
+    """Process the features of a target into the model inputs.
+
+    With `feature_device`, the filtered features are moved to that device
+    before the pipeline runs; it runs on the CPU otherwise. Pass the same
+    `nonensembled_cache` when predicting the target with several seeds.
+    """
 
     if mode == "train":
         assert batch_idx is not None
@@ -269,9 +267,13 @@ def process(
     with data_utils.numpy_seed(seed, data_idx, key="protein_feature"):
         features["crop_and_fix_size_seed"] = np.random.randint(0, 63355)
         features = utils.filter(features, desired_keys=feature_names)
-        features = {k: torch.tensor(v) for k, v in features.items()}
+        features = {
+            k: torch.tensor(v, device=feature_device) for k, v in features.items()
+        }
         with torch.no_grad():
-            features = process_features(features, cfg.common, cfg[mode])
+            features = process_features(
+                features, cfg.common, cfg[mode], nonensembled_cache, cache_key
+            )
 
     if labels is not None:
         labels = [{k: torch.tensor(v) for k, v in l.items()} for l in labels]
@@ -281,6 +283,31 @@ def process(
     return features, labels
 
 
+# features of the last predicted target, keyed by `target_cache_key`: multi-seed
+# prediction calls `load_and_process` for the same target again and again.
+loaded_targets = {}
+
+
+def target_cache_key(load_kwargs, is_monomer, feature_device):
+    """Key of a predicted target, with the modification times of its files.
+
+    A target directory featurized again under the same path gets a new key.
+    """
+    paths = [load_kwargs.get("crosslinks")]
+    for s in load_kwargs["sequence_ids"]:
+        paths.append(
+            os.path.join(load_kwargs["monomer_feature_dir"], f"{s}.feature.pkl.gz")
+        )
+        if load_kwargs.get("uniprot_msa_dir") is not None:
+            paths.append(
+                os.path.join(load_kwargs["uniprot_msa_dir"], f"{s}.uniprot.pkl.gz")
+            )
+    mtimes = [
+        os.path.getmtime(p) if p and os.path.isfile(p) else None for p in paths
+    ]
+    return repr((sorted(load_kwargs.items()), is_monomer, feature_device, mtimes))
+
+
 def load_and_process(
     config: mlc.ConfigDict,
     mode: str,
@@ -288,6 +315,8 @@ def load_and_process(
     batch_idx: Optional[int] = None,
     data_idx: Optional[int] = None,
     is_distillation: bool = False,
+    feature_device: Optional[str] = None,
+    nonensembled_cache: Optional[NonensembledCache] = None,
     **load_kwargs,
 ):
     is_monomer = (
@@ -295,9 +324,32 @@ def load_and_process(
         if "is_monomer" not in load_kwargs
         else load_kwargs.pop("is_monomer")
     )
-    features, labels = load(**load_kwargs, mode=mode, is_monomer=is_monomer)
+    cache_key = None
+    if mode == "predict":
+        cache_key = target_cache_key(load_kwargs, is_monomer, feature_device)
+    if cache_key is not None and cache_key in loaded_targets:
+        features, labels = loaded_targets[cache_key]
+        features = dict(features)
+    else:
+        if cache_key is not None:
+            # the chain features are cached by path only.
+            load_single_feature.cache_clear()
+        features, labels = load(**load_kwargs, mode=mode, is_monomer=is_monomer)
+        if cache_key is not None:
+            loaded_targets.clear()
+            loaded_targets[cache_key] = (dict(features), labels)
     features, labels = process(
-        config, mode, features, labels, seed, batch_idx, data_idx, is_distillation
+        config,
+        mode,
+        features,
+        labels,
+        seed,
+        batch_idx,
+        data_idx,
+        is_distillation,
+        nonensembled_cache=nonensembled_cache,
+        cache_key=cache_key,
+        feature_device=feature_device,
     )
     #print(features.keys())
     #print("MSA size", features["msa_feat"].shape, features["template_aatype"].shape, features["xl"].shape)
@@ -367,10 +419,10 @@ class UnifoldDataset(UnicoreDataset):
         )
 
         self.mode = mode
-        self.num_seq, self.seq_keys, self.seq_sample_prob = self.cal_sample_weight(
+        self.num_seq, self.seq_keys, self.seq_sample_cdf = self.cal_sample_weight(
             self.seq_sample_weight
         )
-        self.num_chain, self.chain_keys, self.sample_prob = self.cal_sample_weight(
+        self.num_chain, self.chain_keys, self.sample_cdf = self.cal_sample_weight(
             self.sample_weight
         )
 
@@ -382,7 +434,7 @@ class UnifoldDataset(UnicoreDataset):
             (
                 self.sd_num_chain,
                 self.sd_chain_keys,
-                self.sd_sample_prob,
+                self.sd_sample_cdf,
             ) = self.cal_sample_weight(self.sd_sample_weight)
         self.config = config.data
         self.seed = seed
@@ -393,7 +445,7 @@ class UnifoldDataset(UnicoreDataset):
         sum_weight = sum(sample_weight.values())
         sample_prob = [sample_weight[k] / sum_weight for k in prot_keys]
         num_prot = len(prot_keys)
-        return num_prot, prot_keys, sample_prob
+        return num_prot, prot_keys, utils.make_sample_cdf(sample_prob)
 
     def sample_chain(self, idx, sample_by_seq=False):
         is_distillation = False
@@ -405,18 +457,16 @@ class UnifoldDataset(UnicoreDataset):
                     else False
                 )
                 if is_distillation:
-                    prot_idx = np.random.choice(
-                        self.sd_num_chain, p=self.sd_sample_prob
-                    )
+                    prot_idx = utils.weighted_choice(self.sd_sample_cdf)
                     label_name = self.sd_chain_keys[prot_idx]
                     seq_name = label_name
                 else:
                     if not sample_by_seq:
-                        prot_idx = np.random.choice(self.num_chain, p=self.sample_prob)
+                        prot_idx = utils.weighted_choice(self.sample_cdf)
                         label_name = self.chain_keys[prot_idx]
                         seq_name = self.inverse_multi_label[label_name]
                     else:
-                        seq_idx = np.random.choice(self.num_seq, p=self.seq_sample_prob)
+                        seq_idx = utils.weighted_choice(self.seq_sample_cdf)
                         seq_name = self.seq_keys[seq_idx]
                         label_name = np.random.choice(self.multi_label[seq_name])
         else:
@@ -513,7 +563,7 @@ class UnifoldMultimerDataset(UnifoldDataset):
             self.pdb_chains, self.sample_weight = self.filter_pdb_by_max_chains(
                 self.pdb_chains, self.pdb_assembly, self.sample_weight, self.max_chains
             )
-            self.num_chain, self.chain_keys, self.sample_prob = self.cal_sample_weight(
+            self.num_chain, self.chain_keys, self.sample_cdf = self.cal_sample_weight(
                 self.sample_weight
             )
 
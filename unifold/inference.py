@@ -1,7 +1,6 @@
 import argparse
 import gzip
 import logging
-import math
 import numpy as np
 import os
 
@@ -9,45 +8,29 @@ import time
 import torch
 import json
 import pickle
+from unifold.chunk_tuner import (
+    DEFAULT_CACHE_PATH,
+    ChunkSizeTuner,
+    automatic_chunk_size,
+)
 from unifold.config import model_config
 from unifold.modules.alphafold import AlphaFold
 from unifold.data import residue_constants, protein
+from unifold.data.process import NonensembledCache
 from unifold.dataset_inference import load_and_process, UnifoldDataset
 from unicore.utils import (
     tensor_tree_map,
 )
 
-def get_device_mem(device):
-    if device != "cpu" and torch.cuda.is_available():
-        cur_device = torch.cuda.current_device()
-        prop = torch.cuda.get_device_properties("cuda:{}".format(cur_device))
-        total_memory_in_GB = prop.total_memory / 1024 / 1024 / 1024
-        return total_memory_in_GB
-    else:
-        return 40
-
-def automatic_chunk_size(seq_len, device, is_bf16):
-    total_mem_in_GB = get_device_mem(device)
-    factor = math.sqrt(total_mem_in_GB/40.0*(0.55 * is_bf16 + 0.45))*0.95
-    if seq_len < int(1024*factor):
-        chunk_size = 256
-        block_size = None
-    elif seq_len < int(2048*factor):
-        chunk_size = 128
-        block_size = None
-    elif seq_len < int(3072*factor):
-        chunk_size = 64
-        block_size = None
-    elif seq_len < int(4096*factor):
-        chunk_size = 32
-        block_size = 512
-    else:
-        chunk_size = 4
-        block_size = 256
-    return chunk_size, block_size
-
 def load_feature_for_one_target(
-    config, data_folder, crosslinks, seed=0, is_multimer=False, use_uniprot=False
+    config,
+    data_folder,
+    crosslinks,
+    seed=0,
+    is_multimer=False,
+    use_uniprot=False,
+    feature_device=None,
+    nonensembled_cache=None,
 ):
     if not is_multimer:
         uniprot_msa_dir = None
@@ -70,6 +53,8 @@ def load_feature_for_one_target(
         uniprot_msa_dir=uniprot_msa_dir,
         is_monomer=(not is_multimer),
         crosslinks=crosslinks,
+        feature_device=feature_device,
+        nonensembled_cache=nonensembled_cache,
     )
     batch = UnifoldDataset.collater([batch])
     return batch
@@ -81,31 +66,78 @@ RELAX_STIFFNESS = 10.0
 RELAX_EXCLUDE_RESIDUES = []
 RELAX_MAX_OUTER_ITERATIONS = 3
 
+# reported by the model when recycling stops early.
+RECYCLE_OUTPUTS = [
+    "recycle_early_stop_tolerance",
+    "min_recycling_iters",
+    "max_recycling_iters",
+    "num_recycling_iters",
+    "recycle_change",
+]
 
-def main(args):
+
+def make_config(args):
     config = model_config(args.model_name)
     config.data.common.max_recycling_iters = args.max_recycling_iters
     config.globals.max_recycling_iters = args.max_recycling_iters
     config.data.predict.num_ensembles = args.num_ensembles
-    is_multimer = config.model.is_multimer
+    config.globals.recycle_early_stop_tolerance = args.recycle_early_stop_tolerance
+    config.globals.min_recycling_iters = args.min_recycling_iters
+    config.globals.backbone_only_recycles = args.backbone_only_recycles
+    if args.chunk_sizes:
+        for item in args.chunk_sizes.split(","):
+            op, size = item.split("=")
+            assert op in config.globals.chunk_sizes, f"unknown op {op} in --chunk_sizes."
+            config.globals.chunk_sizes[op] = int(size)
     if args.sample_templates:
         # enable template samples for diversity
         config.data.predict.subsample_templates = True
+    return config
+
+
+def load_model(config, param_path, model_device, bf16=False):
     model = AlphaFold(config)
 
-    print("start to load params {}".format(args.param_path))
-    state_dict = torch.load(args.param_path)["ema"]["params"]
+    print("start to load params {}".format(param_path))
+    state_dict = torch.load(param_path)["ema"]["params"]
     state_dict = {".".join(k.split(".")[1:]): v for k, v in state_dict.items()}
     model.load_state_dict(state_dict)
-    model = model.to(args.model_device)
+    model = model.to(model_device)
     model.eval()
     model.inference_mode()
-    if args.bf16:
+    if bf16:
         model.bfloat16()
+    return model
 
-    # data path is based on target_name
-    data_dir = os.path.join(args.data_dir, args.target_name)
-    output_dir = os.path.join(args.output_dir, args.target_name)
+
+def make_chunk_size_fn(args, config, model):
+    """`ChunkSizeTuner.get` with `--autotune_chunk_size`, else None for the default."""
+    if not args.autotune_chunk_size:
+        return None
+    tuner = ChunkSizeTuner(
+        model,
+        config.data,
+        args.model_device,
+        cache_path=args.chunk_size_cache,
+        bucket_size=getattr(args, "bucket_size", 128),
+    )
+    return tuner.get
+
+
+def predict_target(
+    args, config, model, data_dir, output_dir, crosslinks, chunk_size_fn=None
+):
+    """Predict `args.times` seeds of the target in `data_dir`, writing each result as it finishes.
+
+    `crosslinks` is the path of the target's crosslink pickle.
+    `chunk_size_fn(seq_len)` returns the chunk and block size of the model,
+    `automatic_chunk_size` by default. Returns the plddt and ptm scores.
+    """
+    if chunk_size_fn is None:
+        chunk_size_fn = lambda seq_len: automatic_chunk_size(
+            seq_len, args.model_device, args.bf16
+        )
+    is_multimer = config.model.is_multimer
     os.system("mkdir -p {}".format(output_dir))
     cur_param_path_postfix = os.path.split(args.param_path)[-1]
     name_postfix = ""
@@ -118,26 +150,27 @@ def main(args):
     if args.num_ensembles != 2:
         name_postfix += "_e" + str(args.num_ensembles)
 
-    print("start to predict {}".format(args.target_name))
+    print("start to predict {}".format(data_dir))
     plddts = {}
     ptms = {}
+    recycles = {}
+    # shared by the seeds of this target only.
+    nonensembled_cache = NonensembledCache()
     for seed in range(args.times):
         cur_seed = hash((args.data_random_seed, seed)) % 100000
         batch = load_feature_for_one_target(
             config,
             data_dir,
-            args.crosslinks,
+            crosslinks,
             cur_seed,
             is_multimer=is_multimer,
             use_uniprot=args.use_uniprot,
+            feature_device=args.feature_device,
+            nonensembled_cache=nonensembled_cache,
         )
         seq_len = batch["aatype"].shape[-1]
         # faster prediction with large chunk/block size
-        chunk_size, block_size = automatic_chunk_size(
-                                    seq_len,
-                                    args.model_device,
-                                    args.bf16
-                                )
+        chunk_size, block_size = chunk_size_fn(seq_len)
         model.globals.chunk_size = chunk_size
         model.globals.block_size = block_size
 
@@ -159,7 +192,7 @@ def main(args):
                 return x
 
         if not args.save_raw_output:
-            score = ["plddt", "ptm", "iptm", "iptm+ptm"]
+            score = ["plddt", "ptm", "iptm", "iptm+ptm"] + RECYCLE_OUTPUTS
             out = {
                     k: v for k, v in raw_out.items()
                     if k.startswith("final_") or k in score
@@ -190,6 +223,9 @@ def main(args):
         plddts[cur_save_name] = str(mean_plddt)
         if is_multimer:
             ptms[cur_save_name] = str(np.mean(out["iptm+ptm"]))
+        if "num_recycling_iters" in out:
+            recycles[cur_save_name] = {k: float(out[k]) for k in RECYCLE_OUTPUTS}
+            print("recycles", recycles[cur_save_name])
         with open(os.path.join(output_dir, cur_save_name + '.pdb'), "w") as f:
             f.write(protein.to_pdb(cur_protein))
         if args.save_raw_output:
@@ -205,10 +241,26 @@ def main(args):
         print("ptms", ptms)
         ptm_fname = score_name + "_ptm.json"
         json.dump(ptms, open(os.path.join(output_dir, ptm_fname), "w"), indent=4)
+    if recycles:
+        recycle_fname = score_name + "_recycles.json"
+        json.dump(recycles, open(os.path.join(output_dir, recycle_fname), "w"), indent=4)
+    return plddts, ptms
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+def main(args):
+    config = make_config(args)
+    model = load_model(config, args.param_path, args.model_device, args.bf16)
+
+    # data path is based on target_name
+    data_dir = os.path.join(args.data_dir, args.target_name)
+    output_dir = os.path.join(args.output_dir, args.target_name)
+    chunk_size_fn = make_chunk_size_fn(args, config, model)
+    predict_target(
+        args, config, model, data_dir, output_dir, args.crosslinks, chunk_size_fn
+    )
+
+
+def add_arguments(parser):
     parser.add_argument(
         "--model_device",
         type=str,
@@ -216,6 +268,15 @@ if __name__ == "__main__":
         help="""Name of the device on which to run the model. Any valid torch
              device name is accepted (e.g. "cpu", "cuda:0")""",
     )
+    parser.add_argument(
+        "--feature_device",
+        type=str,
+        default="cpu",
+        help="""Device on which the input features are processed, e.g. the
+             model device to skip most of the CPU work for large targets.
+             The features only match the CPU ones up to rounding and to the
+             BERT mask samples""",
+    )
     parser.add_argument(
         "--model_name",
         type=str,
@@ -259,16 +320,60 @@ if __name__ == "__main__":
         type=int,
         default=3,
     )
+    parser.add_argument(
+        "--recycle_early_stop_tolerance",
+        type=float,
+        default=0.0,
+        help="""Stop recycling once the RMS change of the CA distances between
+             two recycles is below this (in Angstrom). 0 runs all the recycles""",
+    )
+    parser.add_argument(
+        "--min_recycling_iters",
+        type=int,
+        default=0,
+        help="Recycles run before stopping early",
+    )
+    parser.add_argument(
+        "--backbone_only_recycles",
+        action="store_true",
+        help="""Only compute the backbone in the structure module of the
+             recycles before the last one, which are only used for the
+             recycled pseudo-beta positions""",
+    )
     parser.add_argument(
         "--num_ensembles",
         type=int,
         default=1,
     )
+    parser.add_argument(
+        "--autotune_chunk_size",
+        action="store_true",
+        help="""Profile the chunk and block sizes once per length bucket on
+             the model device instead of using the length table""",
+    )
+    parser.add_argument(
+        "--chunk_size_cache",
+        type=str,
+        default=DEFAULT_CACHE_PATH,
+        help="Json file keeping the profiled chunk and block sizes",
+    )
+    parser.add_argument(
+        "--chunk_sizes",
+        type=str,
+        default="",
+        help="""Chunk sizes of single ops of the stacks, overriding the global
+             one, e.g. "tri_att=32,opm=64". The ops are msa_row, msa_col,
+             opm, tri_att, tri_mul (a block size) and transition""",
+    )
     parser.add_argument("--sample_templates", action="store_true")
     parser.add_argument("--use_uniprot", action="store_true")
     parser.add_argument("--bf16", action="store_true")
     parser.add_argument("--save_raw_output", action="store_true")
+    return parser
+
 
+if __name__ == "__main__":
+    parser = add_arguments(argparse.ArgumentParser())
     args = parser.parse_args()
 
     if args.model_device == "cpu" and torch.cuda.is_available():
@@ -0,0 +1,268 @@
+"""A long-lived prediction service that keeps the models resident.
+
+Targets are submitted through a spool directory. A client writes a json
+request into ``<spool_dir>/queue`` (write to a temporary name, then rename):
+
+    {"target_name": "T1", "data_dir": "...", "output_dir": "...",
+     "crosslinks": "...", "num_res": 250}
+
+Only ``target_name`` is required; the directories default to
+``--data_dir/<target_name>`` and ``--output_dir/<target_name>``,
+``crosslinks`` to ``crosslinks.pkl.gz`` (relative paths are taken from the
+data directory), and ``num_res`` is read from the features if absent. Requests are grouped by
+their length rounded up to ``--bucket_size``: the bucket of the oldest
+request is served first, together with every other queued request of the
+same bucket, and the chunk sizes are decided once per bucket. Structures are
+written as each seed finishes, and a finished request is moved to
+``done/`` (or ``failed/``) with its scores, which are also appended to
+``results.jsonl``.
+
+``--model_name`` and ``--param_path`` take comma separated lists, to keep
+several model variants loaded; every target is predicted with all of them.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import time
+import traceback
+
+import numpy as np
+import torch
+
+from unifold.data import utils
+from unifold.inference import (
+    add_arguments,
+    automatic_chunk_size,
+    load_model,
+    make_chunk_size_fn,
+    make_config,
+    predict_target,
+)
+
+logger = logging.getLogger(__name__)
+
+SPOOL_SUBDIRS = ("queue", "running", "done", "failed")
+
+
+def get_num_res(data_dir):
+    chains_path = os.path.join(data_dir, "chains.txt")
+    if os.path.isfile(chains_path):
+        sequence_ids = open(chains_path).readline().split()
+    else:
+        sequence_ids = ["A"]
+    num_res = 0
+    for sequence_id in sequence_ids:
+        feature = utils.load_pickle(
+            os.path.join(data_dir, f"{sequence_id}.feature.pkl.gz")
+        )
+        num_res += int(np.asarray(feature["seq_length"]).reshape(-1)[0])
+    return num_res
+
+
+class SpoolQueue:
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        for d in SPOOL_SUBDIRS:
+            os.makedirs(os.path.join(spool_dir, d), exist_ok=True)
+        # requests left by a previous run that did not finish.
+        for name in os.listdir(self.path("running")):
+            os.replace(self.path("running", name), self.path("queue", name))
+
+    def path(self, *names):
+        return os.path.join(self.spool_dir, *names)
+
+    def pending(self):
+        names = [n for n in os.listdir(self.path("queue")) if n.endswith(".json")]
+        entries = []
+        for name in names:
+            try:
+                mtime = os.path.getmtime(self.path("queue", name))
+            except FileNotFoundError:
+                continue
+            entries.append((mtime, name))
+        return [name for _, name in sorted(entries)]
+
+    def claim(self, name):
+        try:
+            os.replace(self.path("queue", name), self.path("running", name))
+        except FileNotFoundError:
+            return None
+        with open(self.path("running", name)) as f:
+            return json.load(f)
+
+    def age(self, name):
+        return time.time() - os.path.getmtime(self.path("queue", name))
+
+    def reject(self, name, error):
+        """Move a request that cannot be served to ``failed/``, with `error`."""
+        try:
+            os.replace(self.path("queue", name), self.path("running", name))
+        except FileNotFoundError:
+            return
+        try:
+            with open(self.path("running", name)) as f:
+                request = json.load(f)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            request = {}
+        request["error"] = error
+        self.finish(name, request, "failed")
+
+    def finish(self, name, request, status):
+        with open(self.path(status, name), "w") as f:
+            json.dump(request, f, indent=4)
+        os.remove(self.path("running", name))
+        with open(self.path("results.jsonl"), "a") as f:
+            f.write(json.dumps({"request": name, "status": status, **request}) + "\n")
+
+
+class InferenceServer:
+    def __init__(self, args):
+        self.args = args
+        model_names = args.model_name.split(",")
+        param_paths = args.param_path.split(",")
+        assert len(model_names) == len(param_paths), "one param path per model name."
+        self.variants = []
+        for model_name, param_path in zip(model_names, param_paths):
+            variant_args = argparse.Namespace(**vars(args))
+            variant_args.model_name = model_name
+            variant_args.param_path = param_path
+            config = make_config(variant_args)
+            model = load_model(config, param_path, args.model_device, args.bf16)
+            tuned_chunk_size = make_chunk_size_fn(variant_args, config, model)
+            self.variants.append((variant_args, config, model, tuned_chunk_size))
+        self.queue = SpoolQueue(args.spool_dir)
+        self.chunk_sizes = {}
+        self.num_res = {}
+
+    def get_bucket(self, request):
+        data_dir = self.get_data_dir(request)
+        if "num_res" in request:
+            num_res = int(request["num_res"])
+        elif data_dir in self.num_res:
+            num_res = self.num_res[data_dir]
+        else:
+            num_res = self.num_res[data_dir] = get_num_res(data_dir)
+        return int(math.ceil(num_res / self.args.bucket_size)) * self.args.bucket_size
+
+    def get_chunk_size(self, bucket):
+        if bucket not in self.chunk_sizes:
+            self.chunk_sizes[bucket] = automatic_chunk_size(
+                bucket, self.args.model_device, self.args.bf16
+            )
+        return self.chunk_sizes[bucket]
+
+    def get_data_dir(self, request):
+        return request.get(
+            "data_dir", os.path.join(self.args.data_dir, request["target_name"])
+        )
+
+    def get_crosslinks(self, request):
+        return os.path.join(
+            self.get_data_dir(request), request.get("crosslinks", "crosslinks.pkl.gz")
+        )
+
+    def get_output_dir(self, request):
+        return request.get(
+            "output_dir", os.path.join(self.args.output_dir, request["target_name"])
+        )
+
+    def next_group(self):
+        """Requests of the bucket of the oldest queued request, oldest first."""
+        pending = []
+        for name in self.queue.pending():
+            try:
+                with open(self.queue.path("queue", name)) as f:
+                    request = json.load(f)
+                pending.append((name, self.get_bucket(request)))
+            except Exception:
+                error = traceback.format_exc()
+                try:
+                    age = self.queue.age(name)
+                except FileNotFoundError:
+                    continue
+                if age < self.args.poll_interval:
+                    # may still be being written; retried on the next scan.
+                    logger.warning(f"skipping request {name}:\n{error}")
+                    continue
+                logger.error(f"rejecting request {name}:\n{error}")
+                self.queue.reject(name, error)
+        if not pending:
+            return None, []
+        bucket = pending[0][1]
+        return bucket, [name for name, b in pending if b == bucket]
+
+    def serve_one(self, name, bucket):
+        request = self.queue.claim(name)
+        if request is None:
+            return
+        data_dir = self.get_data_dir(request)
+        output_dir = self.get_output_dir(request)
+        crosslinks = request["crosslinks"] = self.get_crosslinks(request)
+        t = time.perf_counter()
+        try:
+            results = {}
+            for variant_args, config, model, tuned_chunk_size in self.variants:
+                if tuned_chunk_size is not None:
+                    chunk_size_fn = lambda seq_len: tuned_chunk_size(bucket)
+                else:
+                    chunk_size_fn = lambda seq_len: self.get_chunk_size(bucket)
+                plddts, ptms = predict_target(
+                    variant_args,
+                    config,
+                    model,
+                    data_dir,
+                    output_dir,
+                    crosslinks,
+                    chunk_size_fn,
+                )
+                results[variant_args.model_name] = {"plddt": plddts, "ptm": ptms}
+            request["results"] = results
+            status = "done"
+        except Exception:
+            request["error"] = traceback.format_exc()
+            logger.error(f"failed to predict {name}:\n{request['error']}")
+            status = "failed"
+        request["bucket"] = bucket
+        request["time"] = time.perf_counter() - t
+        self.queue.finish(name, request, status)
+        logger.info(f"{status} {name} (bucket {bucket}) in {request['time']:.1f}s")
+
+    def serve(self):
+        logger.info(f"serving {self.args.spool_dir}")
+        while True:
+            bucket, names = self.next_group()
+            if not names:
+                if self.args.exit_when_idle:
+                    return
+                time.sleep(self.args.poll_interval)
+                continue
+            for name in names:
+                self.serve_one(name, bucket)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = add_arguments(argparse.ArgumentParser())
+    parser.add_argument("--spool_dir", type=str, required=True)
+    parser.add_argument(
+        "--bucket_size",
+        type=int,
+        default=128,
+        help="requests are grouped by their length rounded up to this",
+    )
+    parser.add_argument("--poll_interval", type=float, default=5.0)
+    parser.add_argument("--exit_when_idle", action="store_true")
+    args = parser.parse_args()
+
+    if args.model_device == "cpu" and torch.cuda.is_available():
+        logging.warning(
+            """The model is being run on CPU. Consider specifying
+            --model_device for better performance"""
+        )
+
+    InferenceServer(args).serve()
@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 
 from .common import (
+    ChunkSizes,
     residual,
 )
 
@@ -39,6 +40,34 @@ from .attentions import (
 )
 
 
+def ca_distances(x):
+    """Pairwise CA distances of atom37 positions, in float32."""
+    ca = x[..., residue_constants.atom_order["CA"], :].float()
+    return torch.cdist(ca, ca)
+
+
+def recycle_change(ca_dist, ca_dist_prev, mask):
+    """RMS change of the CA distances between two recycles, per batch element."""
+    mask = mask.float()
+    pair_mask = mask[..., :, None] * mask[..., None, :]
+    sq_diff = (ca_dist - ca_dist_prev) ** 2 * pair_mask
+    return torch.sqrt(
+        sq_diff.sum(dim=(-1, -2)) / (pair_mask.sum(dim=(-1, -2)) + 1e-6)
+    )
+
+
+# atom14 index of the backbone rigid group atoms, the same for all residue types.
+BACKBONE_ATOM14_IDX = {"N": 0, "CA": 1, "C": 2, "CB": 4}
+
+
+def backbone_atom14_to_atom37(positions):
+    """Atom37 positions of the atoms placed by `StructureModule(backbone_only=True)`."""
+    out = positions.new_zeros(*positions.shape[:-2], residue_constants.atom_type_num, 3)
+    for name, atom14_idx in BACKBONE_ATOM14_IDX.items():
+        out[..., residue_constants.atom_order[name], :] = positions[..., atom14_idx, :]
+    return out
+
+
 class AlphaFold(nn.Module):
     def __init__(self, config):
         super(AlphaFold, self).__init__()
@@ -142,6 +171,14 @@ class AlphaFold(nn.Module):
             setattr(module, "inference", True)
         self.apply(set_inference_mode)
 
+    def chunk_sizes(self):
+        """Per-op chunk sizes: the ones set in `globals.chunk_sizes`, else the global ones."""
+        chunk_sizes = ChunkSizes.uniform(self.globals.chunk_size, self.globals.block_size)
+        overrides = self.globals.get("chunk_sizes", None) or {}
+        return chunk_sizes.replace(
+            **{k: v for k, v in dict(overrides).items() if v is not None}
+        )
+
     def __convert_input_dtype__(self, batch):
         for key in batch:
             # only convert features with mask
@@ -184,6 +221,7 @@ class AlphaFold(nn.Module):
             chunk_size=self.globals.chunk_size,
             block_size=self.globals.block_size,
             return_mean=not self.enable_template_pointwise_attention,
+            chunk_sizes=self.chunk_sizes(),
         )
         return t
 
@@ -330,6 +368,7 @@ class AlphaFold(nn.Module):
                 msa_mask=feats["extra_msa_mask"],
                 chunk_size=self.globals.chunk_size,
                 block_size=self.globals.block_size,
+                chunk_sizes=self.chunk_sizes(),
                 pair_mask=pair_mask,
                 msa_row_attn_mask=extra_msa_row_mask,
                 msa_col_attn_mask=None,
@@ -348,7 +387,12 @@ class AlphaFold(nn.Module):
         )
 
 
-        z += self.xl_embedder(feats["xl"] * 10) # increase signal
+        if "xl_idx" in feats:
+            z = self.xl_embedder.forward_sparse(
+                z, feats["xl_idx"], feats["xl_value"] * 10
+            ) # increase signal
+        else:
+            z += self.xl_embedder(feats["xl"] * 10) # increase signal
 
         m, z, s = self.evoformer(
             m,
@@ -361,12 +405,37 @@ class AlphaFold(nn.Module):
             tri_end_attn_mask=tri_end_attn_mask,
             chunk_size=self.globals.chunk_size,
             block_size=self.globals.block_size,
+            chunk_sizes=self.chunk_sizes(),
         )
         return m, z, s, msa_mask, m_1_prev_emb, z_prev_emb
 
+    def structure_module_outputs(self, outputs, feats):
+        outputs["sm"] = self.structure_module(
+            outputs["single"],
+            outputs["pair"],
+            feats["aatype"],
+            mask=feats["seq_mask"],
+        )
+        outputs["final_atom_positions"] = atom14_to_atom37(
+            outputs["sm"]["positions"], feats
+        )
+        outputs["final_atom_mask"] = feats["atom37_atom_exists"]
+        outputs["pred_frame_tensor"] = outputs["sm"]["frames"][-1]
+        return outputs
+
     def iteration_evoformer_structure_module(
-        self, batch, m_1_prev, z_prev, x_prev, cycle_no, num_recycling, num_ensembles=1
+        self,
+        batch,
+        m_1_prev,
+        z_prev,
+        x_prev,
+        cycle_no,
+        num_recycling,
+        num_ensembles=1,
+        backbone_only=False,
     ):
+        """With `backbone_only`, the structure module only computes the backbone
+        positions that are recycled, and the outputs have no structure."""
         z, s = 0, 0
         n_seq = batch["msa_feat"].shape[-3]
         assert num_ensembles >= 1
@@ -399,27 +468,28 @@ class AlphaFold(nn.Module):
             outputs["delta_pair"] = delta_pair
             outputs["msa_norm_mask"] = msa_mask
 
-        outputs["sm"] = self.structure_module(
-            s,
-            z,
-            feats["aatype"],
-            mask=feats["seq_mask"],
-        )
-        outputs["final_atom_positions"] = atom14_to_atom37(
-            outputs["sm"]["positions"], feats
-        )
-        outputs["final_atom_mask"] = feats["atom37_atom_exists"]
-        outputs["pred_frame_tensor"] = outputs["sm"]["frames"][-1]
+        if backbone_only:
+            positions = self.structure_module(
+                s,
+                z,
+                feats["aatype"],
+                mask=feats["seq_mask"],
+                backbone_only=True,
+            )["positions"]
+            atom_positions = backbone_atom14_to_atom37(positions)
+        else:
+            outputs = self.structure_module_outputs(outputs, feats)
+            atom_positions = outputs["final_atom_positions"]
 
         # use float32 for numerical stability
         if (not getattr(self, "inference", False)):
             m_1_prev = m[..., 0, :, :].float()
             z_prev = z.float()
-            x_prev = outputs["final_atom_positions"].float()
+            x_prev = atom_positions.float()
         else:
             m_1_prev = m[..., 0, :, :]
             z_prev = z
-            x_prev = outputs["final_atom_positions"]
+            x_prev = atom_positions
 
         return outputs, m_1_prev, z_prev, x_prev
 
@@ -439,6 +509,17 @@ class AlphaFold(nn.Module):
             # don't use ensemble during training
             assert num_ensembles == 1
 
+        # stop recycling once the CA distances change by less than the tolerance.
+        early_stop_tolerance = 0.0
+        if not self.training:
+            early_stop_tolerance = self.globals.get("recycle_early_stop_tolerance", 0.0)
+        min_iters = self.globals.get("min_recycling_iters", 0) + 1
+        ca_dist_prev, change = None, None
+        # intermediate recycles only need the backbone for the recycled positions.
+        backbone_only_recycles = getattr(self, "inference", False) and self.globals.get(
+            "backbone_only_recycles", False
+        )
+
         # convert dtypes in batch
         batch = self.__convert_input_dtype__(batch)
         for cycle_no in range(num_iters):
@@ -457,11 +538,41 @@ class AlphaFold(nn.Module):
                     cycle_no=cycle_no,
                     num_recycling=num_iters,
                     num_ensembles=num_ensembles,
+                    backbone_only=backbone_only_recycles and not is_final_iter,
                 )
-            if not is_final_iter:
-                del outputs
+            if early_stop_tolerance > 0:
+                ca_dist = ca_distances(x_prev)
+                if ca_dist_prev is not None:
+                    change = recycle_change(ca_dist, ca_dist_prev, batch["seq_mask"][0])
+                    if cycle_no + 1 >= min_iters and bool(
+                        (change < early_stop_tolerance).all()
+                    ):
+                        is_final_iter = True
+                ca_dist_prev = ca_dist
+            if is_final_iter:
+                if "sm" not in outputs:
+                    # stopped early after a backbone only iteration.
+                    idx = (cycle_no + 1) * num_ensembles - 1
+                    feats = tensor_tree_map(
+                        lambda t: t[min(t.shape[0] - 1, idx), ...], batch
+                    )
+                    outputs = self.structure_module_outputs(outputs, feats)
+                break
+            del outputs
 
         if "asym_id" in batch:
             outputs["asym_id"] = batch["asym_id"][0, ...]
+        if early_stop_tolerance > 0:
+            batch_shape = batch["seq_mask"].shape[1:-1]
+            new_full = lambda v: batch["seq_mask"].new_full(
+                batch_shape, v, dtype=torch.float32
+            )
+            outputs["recycle_early_stop_tolerance"] = new_full(early_stop_tolerance)
+            outputs["min_recycling_iters"] = new_full(min_iters - 1)
+            outputs["max_recycling_iters"] = new_full(num_iters - 1)
+            outputs["num_recycling_iters"] = new_full(cycle_no)
+            outputs["recycle_change"] = (
+                change if change is not None else new_full(float("nan"))
+            )
         outputs.update(self.aux_heads(outputs))
         return outputs
@@ -2,7 +2,7 @@ from functools import partialmethod
 from typing import Optional, List
 import torch
 import torch.nn as nn
-from .common import Linear, chunk_layer
+from .common import Linear, chunk_layer, fused_bias_dropout_add_inference
 from unicore.utils import (
     permute_final_dims,
 )
@@ -186,6 +186,7 @@ class MSAAttention(nn.Module):
         mask: Optional[torch.Tensor] = None,
         bias: Optional[torch.Tensor] = None,
         chunk_size: int = None,
+        residual: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
 
         return chunk_layer(
@@ -193,6 +194,8 @@ class MSAAttention(nn.Module):
             {"m": m, "mask": mask, "bias": bias},
             chunk_size=chunk_size,
             num_batch_dims=len(m.shape[:-2]),
+            out=residual,
+            out_bias=self.get_output_bias() if residual is not None else None,
         )
 
     @torch.jit.ignore
@@ -228,6 +231,7 @@ class MSAAttention(nn.Module):
         z: Optional[torch.Tensor] = None,
         attn_mask: Optional[torch.Tensor] = None,
         chunk_size: Optional[int] = None,
+        residual: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
 
         bias = None
@@ -240,17 +244,19 @@ class MSAAttention(nn.Module):
             )
 
         if chunk_size is not None:
-            m = self._chunk(m, attn_mask, bias, chunk_size)
+            return self._chunk(m, attn_mask, bias, chunk_size, residual)
+
+        attn_chunk_size = 2560
+        if m.shape[-3] <= attn_chunk_size:
+            m = self._attn_forward(m, attn_mask, bias)
         else:
-            attn_chunk_size = 2560
-            if m.shape[-3] <= attn_chunk_size:
-                m = self._attn_forward(m, attn_mask, bias)
-            else:
-                # reduce the peak memory cost in extra_msa_stack
-                return self._attn_chunk_forward(
-                    m, attn_mask, bias, chunk_size=attn_chunk_size
-                )
+            # reduce the peak memory cost in extra_msa_stack
+            m = self._attn_chunk_forward(
+                m, attn_mask, bias, chunk_size=attn_chunk_size
+            )
 
+        if residual is not None:
+            m = fused_bias_dropout_add_inference(m, self.get_output_bias(), residual)
         return m
 
     def get_output_bias(self):
@@ -285,9 +291,14 @@ class MSAColumnAttention(MSAAttention):
         m: torch.Tensor,
         attn_mask: Optional[torch.Tensor] = None,
         chunk_size: Optional[int] = None,
+        residual: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         m = m.transpose(-2, -3)
-        m = super().forward(m, attn_mask=attn_mask, chunk_size=chunk_size)
+        if residual is not None:
+            residual = residual.transpose(-2, -3)
+        m = super().forward(
+            m, attn_mask=attn_mask, chunk_size=chunk_size, residual=residual
+        )
         m = m.transpose(-2, -3)
 
         return m
@@ -319,12 +330,14 @@ class MSAColumnGlobalAttention(nn.Module):
         m: torch.Tensor,
         mask: torch.Tensor,
         chunk_size: int,
+        residual: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         return chunk_layer(
             self._attn_forward,
             {"m": m, "mask": mask},
             chunk_size=chunk_size,
             num_batch_dims=len(m.shape[:-2]),
+            out=residual,
         )
 
     def _attn_forward(self, m, mask):
@@ -336,15 +349,21 @@ class MSAColumnGlobalAttention(nn.Module):
         m: torch.Tensor,
         mask: Optional[torch.Tensor] = None,
         chunk_size: Optional[int] = None,
+        residual: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
 
         m = m.transpose(-2, -3)
         mask = mask.transpose(-1, -2)
+        if residual is not None:
+            residual = residual.transpose(-2, -3)
 
         if chunk_size is not None:
-            m = self._chunk(m, mask, chunk_size)
+            m = self._chunk(m, mask, chunk_size, residual)
         else:
             m = self._attn_forward(m, mask=mask)
+            if residual is not None:
+                residual += m
+                m = residual
 
         m = m.transpose(-2, -3)
         return m
@@ -378,12 +397,15 @@ class TriangleAttention(nn.Module):
         mask: Optional[torch.Tensor] = None,
         bias: Optional[torch.Tensor] = None,
         chunk_size: int = None,
+        residual: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         return chunk_layer(
             self.mha,
             {"q": x, "k": x, "v": x, "mask": mask, "bias": bias},
             chunk_size=chunk_size,
             num_batch_dims=len(x.shape[:-2]),
+            out=residual,
+            out_bias=self.get_output_bias() if residual is not None else None,
         )
 
     def forward(
@@ -391,9 +413,12 @@ class TriangleAttention(nn.Module):
         x: torch.Tensor,
         attn_mask: Optional[torch.Tensor] = None,
         chunk_size: Optional[int] = None,
+        residual: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         if not self.starting:
             x = x.transpose(-2, -3)
+            if residual is not None:
+                residual = residual.transpose(-2, -3)
 
         x = self.layer_norm(x)
         triangle_bias = (
@@ -401,9 +426,13 @@ class TriangleAttention(nn.Module):
         )
 
         if chunk_size is not None:
-            x = self._chunk(x, attn_mask, triangle_bias, chunk_size)
+            x = self._chunk(x, attn_mask, triangle_bias, chunk_size, residual)
         else:
             x = self.mha(q=x, k=x, v=x, mask=attn_mask, bias=triangle_bias)
+            if residual is not None:
+                x = fused_bias_dropout_add_inference(
+                    x, self.get_output_bias(), residual
+                )
 
         if not self.starting:
             x = x.transpose(-2, -3)
@@ -1,3 +1,4 @@
+import dataclasses
 from functools import partial
 from typing import Optional, Any, Callable, List, Dict, Iterable
 
@@ -88,24 +89,30 @@ class Transition(nn.Module):
         self,
         x: torch.Tensor,
         chunk_size: int,
+        residual: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
         return chunk_layer(
             self._transition,
             {"x": x},
             chunk_size=chunk_size,
             num_batch_dims=len(x.shape[:-2]),
+            out=residual,
         )
 
     def forward(
         self,
         x: torch.Tensor,
         chunk_size: Optional[int] = None,
+        residual: Optional[torch.Tensor] = None,
     ) -> torch.Tensor:
 
         if chunk_size is not None:
-            x = self._chunk(x, chunk_size)
+            x = self._chunk(x, chunk_size, residual)
         else:
             x = self._transition(x=x)
+            if residual is not None:
+                residual += x
+                x = residual
 
         return x
 
@@ -242,6 +249,28 @@ def bias_dropout_residual(module, residual, x, dropout_shared_dim, prob, trainin
         return fused_bias_dropout_add_inference(x, bias, residual)
 
 
+def chunk_residual(module, x, training, **kwargs):
+    """`residual(x, module(x, **kwargs), training)`.
+
+    At inference, `module` adds its output to `x` in place, chunk by chunk,
+    so the full output is never allocated.
+    """
+    if training:
+        return residual(x, module(x, **kwargs), training)
+    return module(x, residual=x, **kwargs)
+
+
+def chunk_bias_dropout_residual(
+    module, x, dropout_shared_dim, prob, training, **kwargs
+):
+    """`bias_dropout_residual` of `module(x, **kwargs)`, see `chunk_residual`."""
+    if training:
+        return bias_dropout_residual(
+            module, x, module(x, **kwargs), dropout_shared_dim, prob, training
+        )
+    return module(x, residual=x, **kwargs)
+
+
 @torch.jit.script
 def fused_bias_gated_dropout_add(
     x: torch.Tensor,
@@ -295,6 +324,37 @@ def tri_mul_residual(
         return residual
 
 
+@dataclasses.dataclass(frozen=True)
+class ChunkSizes:
+    """Chunk sizes of each kind of op of the Evoformer, extra MSA and template stacks.
+
+    `tri_mul` is the block size of the triangle multiplications, the others
+    are chunk sizes. None runs the op in one piece.
+    """
+
+    msa_row: Optional[int] = None
+    msa_col: Optional[int] = None
+    opm: Optional[int] = None
+    tri_att: Optional[int] = None
+    tri_mul: Optional[int] = None
+    transition: Optional[int] = None
+
+    @classmethod
+    def uniform(cls, chunk_size: Optional[int], block_size: Optional[int] = None):
+        """The sizes of a single global `chunk_size` and `block_size`."""
+        return cls(
+            msa_row=chunk_size,
+            msa_col=chunk_size,
+            opm=chunk_size,
+            tri_att=chunk_size,
+            tri_mul=block_size,
+            transition=chunk_size,
+        )
+
+    def replace(self, **sizes) -> "ChunkSizes":
+        return dataclasses.replace(self, **sizes)
+
+
 class SimpleModuleList(nn.ModuleList):
     def __repr__(self):
         return str(len(self)) + " X ...\n" + self[0].__repr__()
@@ -305,8 +365,16 @@ def chunk_layer(
     inputs: Dict[str, Any],
     chunk_size: int,
     num_batch_dims: int,
+    out: Optional[torch.Tensor] = None,
+    out_bias: Optional[torch.Tensor] = None,
 ) -> Any:
-    # TODO: support inplace add to output
+    """Runs `layer` on chunks of the flattened batch dims of `inputs`.
+
+    If `out` is given, the output plus `out_bias` is added to it in place and
+    `out` is returned. Each chunk is added as soon as it is computed, so the
+    full output is never allocated. A chunk of `out` is only written after
+    the same chunk of the inputs has been read, so `out` may be an input.
+    """
     if not (len(inputs) > 0):
         raise ValueError("Must provide at least one input")
 
@@ -342,37 +410,73 @@ def chunk_layer(
         return t
 
     flat_inputs = tensor_tree_map(_flat_inputs, inputs)
+    # inputs are flat dicts of tensors but for a few callers, slice those
+    # directly rather than mapping over the tree for every chunk.
+    is_flat = all(type(v) is torch.Tensor for v in flat_inputs.values())
+
+    flat_out = None
+    if out is not None:
+        try:
+            flat_out = out.view((flat_batch_dim,) + out.shape[num_batch_dims:])
+        except RuntimeError:
+            # batch dims of a transposed `out` that do not merge; the output
+            # is computed in full and added at the end.
+            pass
+
+    def select_chunk(t, chunk_start, chunk_end):
+        if t.shape[0] == 1:
+            return t[0:1]
+        else:
+            return t[chunk_start:chunk_end]
 
-    out = None
+    result = None
     for i in range(num_chunks):
         chunk_start = i * chunk_size
         chunk_end = min((i + 1) * chunk_size, flat_batch_dim)
 
-        def select_chunk(t):
-            if t.shape[0] == 1:
-                return t[0:1]
-            else:
-                return t[chunk_start:chunk_end]
-
-        chunkes = tensor_tree_map(select_chunk, flat_inputs)
+        if is_flat:
+            chunkes = {
+                k: select_chunk(v, chunk_start, chunk_end)
+                for k, v in flat_inputs.items()
+            }
+        else:
+            chunkes = tensor_tree_map(
+                partial(select_chunk, chunk_start=chunk_start, chunk_end=chunk_end),
+                flat_inputs,
+            )
 
         output_chunk = layer(**chunkes)
 
-        if out is None:
-            out = tensor_tree_map(
+        if flat_out is not None:
+            if out_bias is not None:
+                flat_out[chunk_start:chunk_end] += out_bias + output_chunk
+            else:
+                flat_out[chunk_start:chunk_end] += output_chunk
+            continue
+
+        if result is None:
+            result = tensor_tree_map(
                 lambda t: t.new_zeros((flat_batch_dim,) + t.shape[1:]), output_chunk
             )
 
         out_type = type(output_chunk)
         if out_type is tuple:
-            for x, y in zip(out, output_chunk):
+            for x, y in zip(result, output_chunk):
                 x[chunk_start:chunk_end] = y
         elif out_type is torch.Tensor:
-            out[chunk_start:chunk_end] = output_chunk
+            result[chunk_start:chunk_end] = output_chunk
         else:
             raise ValueError("Not supported")
 
-    reshape = lambda t: t.view(orig_batch_dims + t.shape[1:])
-    out = tensor_tree_map(reshape, out)
+    if flat_out is not None:
+        return out
 
-    return out
+    reshape = lambda t: t.view(orig_batch_dims + t.shape[1:])
+    result = tensor_tree_map(reshape, result)
+
+    if out is not None:
+        if out_bias is not None:
+            return fused_bias_dropout_add_inference(result, out_bias, out)
+        out += result
+        return out
+    return result
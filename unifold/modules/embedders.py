@@ -295,3 +295,26 @@ class XLEmbedder(nn.Module):
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         return self.linear(x.type(self.linear.weight.dtype))
+
+    def forward_sparse(
+        self, z: torch.Tensor, xl_idx: torch.Tensor, xl_value: torch.Tensor
+    ) -> torch.Tensor:
+        """Add the embedding of COO crosslinks to `z` in place.
+
+        Same as `z += self(xl)` for the dense `xl`: every pair gets the bias,
+        and only the linked pairs get their weighted value on top of it.
+        """
+        n, c = z.shape[-2:]
+        if not z.is_contiguous():
+            z = z.contiguous()
+        z += self.linear.bias.type(z.dtype)
+        if xl_idx.shape[-2] == 0:
+            return z
+        batch_size = z.numel() // (n * n * c)
+        xl_idx = xl_idx.reshape(batch_size, -1, 2).long()
+        offset = torch.arange(batch_size, device=z.device)[:, None] * (n * n)
+        index = (offset + xl_idx[..., 0] * n + xl_idx[..., 1]).reshape(-1)
+        weight = self.linear.weight[:, 0]
+        value = xl_value.reshape(-1, 1).type(weight.dtype) * weight
+        z.view(-1, c).index_add_(0, index, value.type(z.dtype))
+        return z
@@ -4,12 +4,14 @@ from typing import Tuple, Optional
 from functools import partial
 
 from .common import (
+    ChunkSizes,
     Linear,
     Transition,
     OuterProductMean,
     SimpleModuleList,
     residual,
-    bias_dropout_residual,
+    chunk_residual,
+    chunk_bias_dropout_residual,
     tri_mul_residual,
 )
 from .attentions import (
@@ -130,88 +132,104 @@ class EvoformerIteration(nn.Module):
         tri_end_attn_mask: torch.Tensor,
         chunk_size: Optional[int] = None,
         block_size: Optional[int] = None,
+        chunk_sizes: Optional[ChunkSizes] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # per-op sizes, if given, take over the global chunk and block size.
+        if chunk_sizes is None:
+            chunk_sizes = ChunkSizes.uniform(chunk_size, block_size)
 
         if self.outer_product_mean_first:
             z = residual(
-                z, self.outer_product_mean(m, mask=msa_mask, chunk_size=chunk_size),
+                z,
+                self.outer_product_mean(m, mask=msa_mask, chunk_size=chunk_sizes.opm),
                 self.training
             )
 
-        m = bias_dropout_residual(
+        m = chunk_bias_dropout_residual(
             self.msa_att_row,
             m,
-            self.msa_att_row(
-                m, z=z, attn_mask=msa_row_attn_mask, chunk_size=chunk_size
-            ),
             self.row_dropout_share_dim,
             self.msa_dropout,
             self.training,
+            z=z,
+            attn_mask=msa_row_attn_mask,
+            chunk_size=chunk_sizes.msa_row,
         )
         if self._is_extra_msa_stack:
-            m = residual(
-                m, self.msa_att_col(m, mask=msa_mask, chunk_size=chunk_size),
-                self.training
+            m = chunk_residual(
+                self.msa_att_col,
+                m,
+                self.training,
+                mask=msa_mask,
+                chunk_size=chunk_sizes.msa_col,
             )
         else:
-            m = bias_dropout_residual(
+            m = chunk_bias_dropout_residual(
                 self.msa_att_col,
                 m,
-                self.msa_att_col(m, attn_mask=msa_col_attn_mask, chunk_size=chunk_size),
                 self.col_dropout_share_dim,
                 self.msa_dropout,
                 self.training,
+                attn_mask=msa_col_attn_mask,
+                chunk_size=chunk_sizes.msa_col,
             )
-        m = residual(
-            m, self.msa_transition(m, chunk_size=chunk_size),
-            self.training
+        m = chunk_residual(
+            self.msa_transition,
+            m,
+            self.training,
+            chunk_size=chunk_sizes.transition,
         )
         if not self.outer_product_mean_first:
             z = residual(
-                z, self.outer_product_mean(m, mask=msa_mask, chunk_size=chunk_size),
+                z,
+                self.outer_product_mean(m, mask=msa_mask, chunk_size=chunk_sizes.opm),
                 self.training
             )
 
         z = tri_mul_residual(
             self.tri_mul_out,
             z,
-            self.tri_mul_out(z, mask=pair_mask, block_size=block_size),
+            self.tri_mul_out(z, mask=pair_mask, block_size=chunk_sizes.tri_mul),
             self.row_dropout_share_dim,
             self.pair_dropout,
             self.training,
-            block_size=block_size,
+            block_size=chunk_sizes.tri_mul,
         )
 
         z = tri_mul_residual(
             self.tri_mul_in,
             z,
-            self.tri_mul_in(z, mask=pair_mask, block_size=block_size),
+            self.tri_mul_in(z, mask=pair_mask, block_size=chunk_sizes.tri_mul),
             self.row_dropout_share_dim,
             self.pair_dropout,
             self.training,
-            block_size=block_size,
+            block_size=chunk_sizes.tri_mul,
         )
 
-        z = bias_dropout_residual(
+        z = chunk_bias_dropout_residual(
             self.tri_att_start,
             z,
-            self.tri_att_start(z, attn_mask=tri_start_attn_mask, chunk_size=chunk_size),
             self.row_dropout_share_dim,
             self.pair_dropout,
             self.training,
+            attn_mask=tri_start_attn_mask,
+            chunk_size=chunk_sizes.tri_att,
         )
 
-        z = bias_dropout_residual(
+        z = chunk_bias_dropout_residual(
             self.tri_att_end,
             z,
-            self.tri_att_end(z, attn_mask=tri_end_attn_mask, chunk_size=chunk_size),
             self.col_dropout_share_dim,
             self.pair_dropout,
             self.training,
+            attn_mask=tri_end_attn_mask,
+            chunk_size=chunk_sizes.tri_att,
         )
-        z = residual(
-            z, self.pair_transition(z, chunk_size=chunk_size),
-            self.training
+        z = chunk_residual(
+            self.pair_transition,
+            z,
+            self.training,
+            chunk_size=chunk_sizes.transition,
         )
         return m, z
 
@@ -283,6 +301,7 @@ class EvoformerStack(nn.Module):
         tri_end_attn_mask: torch.Tensor,
         chunk_size: int,
         block_size: int,
+        chunk_sizes: Optional[ChunkSizes] = None,
     ) -> Tuple[torch.Tensor, torch.Tensor, Optional[torch.Tensor]]:
         blocks = [
             partial(
@@ -294,7 +313,8 @@ class EvoformerStack(nn.Module):
                 tri_start_attn_mask=tri_start_attn_mask,
                 tri_end_attn_mask=tri_end_attn_mask,
                 chunk_size=chunk_size,
-                block_size=block_size
+                block_size=block_size,
+                chunk_sizes=chunk_sizes,
             )
             for b in self.blocks
         ]
@@ -366,6 +386,7 @@ class ExtraMSAStack(EvoformerStack):
         tri_end_attn_mask: torch.Tensor = None,
         chunk_size: int = None,
         block_size: int = None,
+        chunk_sizes: Optional[ChunkSizes] = None,
     ) -> torch.Tensor:
         _, z, _ = super().forward(
             m,
@@ -377,6 +398,7 @@ class ExtraMSAStack(EvoformerStack):
             tri_start_attn_mask=tri_start_attn_mask,
             tri_end_attn_mask=tri_end_attn_mask,
             chunk_size=chunk_size,
-            block_size=block_size
+            block_size=block_size,
+            chunk_sizes=chunk_sizes,
         )
         return z
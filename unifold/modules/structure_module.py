@@ -466,7 +466,11 @@ class StructureModule(nn.Module):
         z,
         aatype,
         mask=None,
+        backbone_only=False,
     ):
+        """With `backbone_only`, only the backbone frames are updated, and only
+        the positions of the atoms of the backbone rigid group are returned.
+        """
         if mask is None:
             mask = s.new_ones(s.shape[:-1])
 
@@ -503,9 +507,6 @@ class StructureModule(nn.Module):
                 self.bb_update(s), pre_rot_mat=backb_to_global.get_rots()
             )
 
-            # initial_s is always used to update the backbone
-            unnormalized_angles, angles = self.angle_resnet(s, initial_s)
-
             # convert quaternion to rotation matrix
             backb_to_global = Frame(
                 Rotation(
@@ -513,6 +514,12 @@ class StructureModule(nn.Module):
                 ),
                 quat_encoder.get_trans(),
             )
+            if backbone_only:
+                continue
+
+            # initial_s is always used to update the backbone
+            unnormalized_angles, angles = self.angle_resnet(s, initial_s)
+
             if i == self.num_blocks - 1:
                 all_frames_to_global = self.torsion_angles_to_frames(
                     backb_to_global.scale_translation(self.trans_scale_factor),
@@ -539,6 +546,14 @@ class StructureModule(nn.Module):
                 quat_encoder = quat_encoder.stop_rot_gradient()
                 backb_to_global = backb_to_global.stop_rot_gradient()
 
+        if backbone_only:
+            frames = backb_to_global.scale_translation(self.trans_scale_factor)
+            return {
+                "frames": frames.to_tensor_4x4(),
+                "positions": self.backbone_atom14_pos(frames, aatype),
+                "single": s,
+            }
+
         outputs = dict_multimap(torch.stack, outputs)
         outputs["sidechain_frames"] = all_frames_to_global.to_tensor_4x4()
         outputs["positions"] = pred_positions
@@ -579,6 +594,13 @@ class StructureModule(nn.Module):
         self._init_residue_constants(alpha.dtype, alpha.device)
         return torsion_angles_to_frames(frame, alpha, aatype, self.default_frames)
 
+    def backbone_atom14_pos(self, frame, aatype):
+        """Atom14 positions of the backbone rigid group atoms (N, CA, C, CB), others are zero."""
+        self._init_residue_constants(frame.get_rots().dtype, frame.get_rots().device)
+        atom_mask = self.atom_mask * (self.group_idx == 0)
+        pred_positions = frame[..., None].apply(self.lit_positions[aatype, ...])
+        return pred_positions * atom_mask[aatype, ...].unsqueeze(-1)
+
     def frames_and_literature_positions_to_atom14_pos(self, frame, aatype):
         self._init_residue_constants(frame.get_rots().dtype, frame.get_rots().device)
         return frames_and_literature_positions_to_atom14_pos(
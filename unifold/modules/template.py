@@ -7,9 +7,11 @@ import torch.nn as nn
 
 from .attentions import Attention
 from .common import (
+    ChunkSizes,
     SimpleModuleList,
     residual,
-    bias_dropout_residual,
+    chunk_residual,
+    chunk_bias_dropout_residual,
     tri_mul_residual,
 )
 from .common import Linear, Transition, chunk_layer
@@ -162,93 +164,95 @@ class TemplatePairStackBlock(nn.Module):
         tri_end_attn_mask: torch.Tensor,
         chunk_size: Optional[int] = None,
         block_size: Optional[int] = None,
+        chunk_sizes: Optional[ChunkSizes] = None,
     ):
+        # per-op sizes, if given, take over the global chunk and block size.
+        if chunk_sizes is None:
+            chunk_sizes = ChunkSizes.uniform(chunk_size, block_size)
         if self.tri_attn_first:
-            s = bias_dropout_residual(
+            s = chunk_bias_dropout_residual(
                 self.tri_att_start,
                 s,
-                self.tri_att_start(
-                    s, attn_mask=tri_start_attn_mask, chunk_size=chunk_size
-                ),
                 self.row_dropout_share_dim,
                 self.dropout,
                 self.training,
+                attn_mask=tri_start_attn_mask,
+                chunk_size=chunk_sizes.tri_att,
             )
 
-            s = bias_dropout_residual(
+            s = chunk_bias_dropout_residual(
                 self.tri_att_end,
                 s,
-                self.tri_att_end(s, attn_mask=tri_end_attn_mask, chunk_size=chunk_size),
                 self.col_dropout_share_dim,
                 self.dropout,
                 self.training,
+                attn_mask=tri_end_attn_mask,
+                chunk_size=chunk_sizes.tri_att,
             )
             s = tri_mul_residual(
                 self.tri_mul_out,
                 s,
-                self.tri_mul_out(s, mask=mask, block_size=block_size),
+                self.tri_mul_out(s, mask=mask, block_size=chunk_sizes.tri_mul),
                 self.row_dropout_share_dim,
                 self.dropout,
                 self.training,
-                block_size=block_size,
+                block_size=chunk_sizes.tri_mul,
             )
 
             s = tri_mul_residual(
                 self.tri_mul_in,
                 s,
-                self.tri_mul_in(s, mask=mask, block_size=block_size),
+                self.tri_mul_in(s, mask=mask, block_size=chunk_sizes.tri_mul),
                 self.row_dropout_share_dim,
                 self.dropout,
                 self.training,
-                block_size=block_size,
+                block_size=chunk_sizes.tri_mul,
             )
         else:
             s = tri_mul_residual(
                 self.tri_mul_out,
                 s,
-                self.tri_mul_out(s, mask=mask, block_size=block_size),
+                self.tri_mul_out(s, mask=mask, block_size=chunk_sizes.tri_mul),
                 self.row_dropout_share_dim,
                 self.dropout,
                 self.training,
-                block_size=block_size,
+                block_size=chunk_sizes.tri_mul,
             )
 
             s = tri_mul_residual(
                 self.tri_mul_in,
                 s,
-                self.tri_mul_in(s, mask=mask, block_size=block_size),
+                self.tri_mul_in(s, mask=mask, block_size=chunk_sizes.tri_mul),
                 self.row_dropout_share_dim,
                 self.dropout,
                 self.training,
-                block_size=block_size,
+                block_size=chunk_sizes.tri_mul,
             )
 
-            s = bias_dropout_residual(
+            s = chunk_bias_dropout_residual(
                 self.tri_att_start,
                 s,
-                self.tri_att_start(
-                    s, attn_mask=tri_start_attn_mask, chunk_size=chunk_size
-                ),
                 self.row_dropout_share_dim,
                 self.dropout,
                 self.training,
+                attn_mask=tri_start_attn_mask,
+                chunk_size=chunk_sizes.tri_att,
             )
 
-            s = bias_dropout_residual(
+            s = chunk_bias_dropout_residual(
                 self.tri_att_end,
                 s,
-                self.tri_att_end(s, attn_mask=tri_end_attn_mask, chunk_size=chunk_size),
                 self.col_dropout_share_dim,
                 self.dropout,
                 self.training,
+                attn_mask=tri_end_attn_mask,
+                chunk_size=chunk_sizes.tri_att,
             )
-        s = residual(
+        s = chunk_residual(
+            self.pair_transition,
             s,
-            self.pair_transition(
-                s,
-                chunk_size=chunk_size,
-            ),
-            self.training
+            self.training,
+            chunk_size=chunk_sizes.transition,
         )
         return s
 
@@ -296,6 +300,7 @@ class TemplatePairStack(nn.Module):
         chunk_size: int,
         block_size: int,
         return_mean: bool,
+        chunk_sizes: Optional[ChunkSizes] = None,
     ):
         def one_template(i):
             (s,) = checkpoint_sequential(
@@ -307,6 +312,7 @@ class TemplatePairStack(nn.Module):
                         tri_end_attn_mask=tri_end_attn_mask,
                         chunk_size=chunk_size,
                         block_size=block_size,
+                        chunk_sizes=chunk_sizes,
                     )
                     for b in self.blocks
                 ],
@@ -17,6 +17,7 @@
 import os
 from typing import Any, Mapping, MutableMapping, Optional, Sequence, Union
 from absl import logging
+from unifold.data import msa_dedup
 from unifold.data import residue_constants
 from unifold.msa import msa_identifiers
 from unifold.msa import parsers
@@ -50,6 +51,11 @@ def make_sequence_features(
     return features
 
 
+_HHBLITS_AA_TO_ID_TABLE = np.full(256, -1, dtype=np.int32)
+for _res, _id in residue_constants.HHBLITS_AA_TO_ID.items():
+    _HHBLITS_AA_TO_ID_TABLE[ord(_res)] = _id
+
+
 def make_msa_features(msas: Sequence[parsers.Msa]) -> FeatureDict:
     """Constructs a feature dict of MSA features."""
     if not msas:
@@ -58,17 +64,26 @@ def make_msa_features(msas: Sequence[parsers.Msa]) -> FeatureDict:
     int_msa = []
     deletion_matrix = []
     species_ids = []
-    seen_sequences = set()
+    seen_sequences = []
     for msa_index, msa in enumerate(msas):
         if not msa:
             raise ValueError(f"MSA {msa_index} must contain at least one sequence.")
-        for sequence_index, sequence in enumerate(msa.sequences):
-            if sequence in seen_sequences:
-                continue
-            seen_sequences.add(sequence)
-            int_msa.append(
-                [residue_constants.HHBLITS_AA_TO_ID[res] for res in sequence]
-            )
+        sequences = np.frombuffer(
+            "".join(msa.sequences).encode("ascii"), dtype=np.uint8
+        ).reshape(len(msa.sequences), -1)
+        # keep the first occurrence of every sequence over all the MSAs.
+        keep = msa_dedup.first_unique_rows(sequences)
+        if seen_sequences:
+            keep = keep[
+                ~msa_dedup.isin_rows(sequences[keep], np.concatenate(seen_sequences))
+            ]
+        seen_sequences.append(sequences[keep])
+
+        ids = _HHBLITS_AA_TO_ID_TABLE[sequences[keep]]
+        if np.any(ids < 0):
+            raise KeyError(chr(sequences[keep][ids < 0][0]))
+        int_msa.append(ids)
+        for sequence_index in keep:
             deletion_matrix.append(msa.deletion_matrix[sequence_index])
             identifiers = msa_identifiers.get_identifiers(
                 msa.descriptions[sequence_index]
@@ -76,10 +91,11 @@ def make_msa_features(msas: Sequence[parsers.Msa]) -> FeatureDict:
             species_ids.append(identifiers.species_id.encode("utf-8"))
 
     num_res = len(msas[0].sequences[0])
+    int_msa = np.concatenate(int_msa, axis=0)
     num_alignments = len(int_msa)
     features = {}
     features["deletion_matrix_int"] = np.array(deletion_matrix, dtype=np.int32)
-    features["msa"] = np.array(int_msa, dtype=np.int32)
+    features["msa"] = int_msa.astype(np.int32)
     features["num_alignments"] = np.array([num_alignments] * num_res, dtype=np.int32)
     features["msa_species_identifiers"] = np.array(species_ids, dtype=np.object_)
     return features
@@ -112,6 +112,7 @@ class UFSymmetry(AlphaFold):    # inherit the main model. alterations implemente
                 msa_mask=feats["extra_msa_mask"],
                 chunk_size=self.globals.chunk_size,
                 block_size=self.globals.block_size,
+                chunk_sizes=self.chunk_sizes(),
                 pair_mask=pair_mask,
                 msa_row_attn_mask=extra_msa_row_mask,
                 msa_col_attn_mask=None,
@@ -154,6 +155,7 @@ class UFSymmetry(AlphaFold):    # inherit the main model. alterations implemente
             tri_end_attn_mask=tri_end_attn_mask,
             chunk_size=self.globals.chunk_size,
             block_size=self.globals.block_size,
+            chunk_sizes=self.chunk_sizes(),
         )
         return m, z, s, msa_mask, pair_mask, m_1_prev_emb, z_prev_emb
 
@@ -41,6 +41,28 @@ class AlphafoldTask(UnicoreTask):
             type=float,
             default=0.75,
         )
+        parser.add_argument(
+            "--shared-cache-size",
+            type=float,
+            default=0,
+            help="size in GB of the feature cache shared by all data workers on a node, 0 to disable",
+        )
+        parser.add_argument(
+            "--shared-cache-dir",
+            type=str,
+            default="/dev/shm/unifold_feature_cache",
+        )
+        parser.add_argument(
+            "--prefetch-depth",
+            type=int,
+            default=0,
+            help="number of upcoming batches each data worker loads in the background, 0 to disable",
+        )
+        parser.add_argument(
+            "--prefetch-threads",
+            type=int,
+            default=2,
+        )
 
     def __init__(self, args):
         super().__init__(args)